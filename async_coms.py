@@ -0,0 +1,223 @@
+import asyncio
+import inspect
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from buffers import Blob
+from correlation import RemoteError
+from message import Message, MessageBuilder
+from message_coms import MessageComs
+from routing import Route
+import streaming
+
+
+class AsyncMessageComs(MessageComs):
+    """MessageComs driven by an asyncio event loop instead of threads.
+
+    The transport's file descriptor is registered with the running loop and
+    events are decoded as soon as it becomes readable. ``async def``
+    handlers run as tasks, plain handlers run inline on the loop, so one
+    loop can serve thousands of concurrent requests without extra threads.
+    Chunked stream senders still use a background thread.
+    """
+
+    def __init__(self, name: str, group: Optional[str] = None, **kwargs):
+        kwargs["workers"] = 0
+        super().__init__(name, group, **kwargs)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._fd: Optional[int] = None
+        self._tasks: set = set()
+        self._requests: Dict[str, Tuple[asyncio.Future, str, float]] = {}   # req_id → (future, peer, sent)
+        self._in_flight: Dict[str, int] = {}
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._running = True
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.start()
+        self._fd = self.transport.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+        # Drain whatever arrived before the reader was registered
+        self._on_readable()
+
+    async def stop(self):
+        self._running = False
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for future, _, _ in list(self._requests.values()):
+            if not future.done():
+                future.set_exception(RuntimeError("MessageComs stopped"))
+        self._streams.stop()
+        self._pending.stop()
+        if self._batcher is not None:
+            self._batcher.stop()
+        # Waits for running process handlers; off the loop, which delivers their replies
+        await self._loop.run_in_executor(None, self._process_pool.shutdown)
+        self._shm_out.stop()
+        self.transport.stop()
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.stop()
+        if self.tracer is not None and self.trace_path:
+            self.tracer.export(self.trace_path)
+
+    def _on_readable(self):
+        while self._running:
+            event = self.transport.recv(timeout=0)
+            if event is None:
+                break
+            for item in self._handle_event(event):
+                self._dispatch(*item)
+        self._send_shm_releases()
+        self._expire_blob_fetches()
+
+    def send(self, msg: Message, stream: Optional[bool] = None) -> "asyncio.Future":
+        """Send msg now and return a future that completes once it is on the wire.
+
+        For plain messages the future is already done; for chunked streams it
+        completes with the OutgoingStream after the last chunk is sent. Not
+        awaiting it is fine (Message.respond does not). May be called from
+        other threads, e.g. by handlers run in an executor; the future is then
+        settled on the loop.
+        """
+        loop = self._loop
+        if loop is None:
+            raise RuntimeError("AsyncMessageComs.start() has not been awaited")
+        outgoing = super().send(msg, stream)
+        future = loop.create_future()
+        if outgoing is not None:
+            outgoing.add_done_callback(lambda s: loop.call_soon_threadsafe(self._settle_stream, future, s))
+        elif threading.get_ident() == self._loop_thread:
+            future.set_result(None)
+        else:
+            loop.call_soon_threadsafe(future.set_result, None)
+        return future
+
+    @staticmethod
+    def _settle_stream(future: asyncio.Future, outgoing: streaming.OutgoingStream):
+        if future.done():
+            return
+        if outgoing.error is not None:
+            future.set_exception(outgoing.error)
+        else:
+            future.set_result(outgoing)
+
+    def request(self, key: str, data: dict, destination: str, timeout: Optional[float] = 30.0,
+                blob: Optional[Blob] = None) -> "asyncio.Future":
+        """Whisper a request; await the returned future for the reply Message.
+
+        Timeouts are loop timers, so outstanding requests cost no threads.
+        """
+        msg = (
+            MessageBuilder(self)
+            .with_type("whisper")
+            .with_key(key)
+            .with_destination(destination)
+            .with_json_data(data)
+            .with_binary_blob(blob)
+            .build()
+        )
+        req_id = msg.req_id
+        future = self._loop.create_future()
+        self._requests[req_id] = (future, destination, self._loop.time())
+        self._in_flight[destination] = self._in_flight.get(destination, 0) + 1
+        future.add_done_callback(lambda f: self._request_done(req_id, destination))
+        if timeout is not None:
+            handle = self._loop.call_later(timeout, self._expire, req_id)
+            future.add_done_callback(lambda f: handle.cancel())
+        try:
+            MessageComs.send(self, msg)
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _request_done(self, req_id: str, destination: str):
+        self._requests.pop(req_id, None)
+        remaining = self._in_flight.get(destination, 1) - 1
+        if remaining:
+            self._in_flight[destination] = remaining
+        else:
+            self._in_flight.pop(destination, None)
+
+    def _outstanding(self, peer_id: str) -> int:
+        return self._in_flight.get(peer_id, 0)
+
+    def _expire(self, req_id: str):
+        entry = self._requests.get(req_id)
+        if entry is not None and not entry[0].done():
+            entry[0].set_exception(asyncio.TimeoutError(f"No reply to request {req_id}"))
+
+    def _on_reply(self, msg: Message):
+        started = time.perf_counter_ns()
+        reply_to = msg.json_data.get("reply_to")
+        entry = self._requests.get(reply_to)
+        if entry is None or entry[0].done() or entry[1] != msg.destination:
+            return super()._on_reply(msg)
+        rtt = self._loop.time() - entry[2]
+        self._observe_rtt(entry[1], rtt)
+        error = msg.json_data.get("error")
+        if error is not None:
+            entry[0].set_exception(RemoteError(error))
+        else:
+            entry[0].set_result(msg)
+        if msg.trace is not None:
+            self._trace_reply(msg, started, rtt)
+
+    def _forget_peer(self, peer_id: str):
+        super()._forget_peer(peer_id)
+        for future, destination, _ in list(self._requests.values()):
+            if destination == peer_id and not future.done():
+                future.set_exception(RuntimeError(f"Peer {peer_id} left"))
+
+    def _invoke(self, route: Route, msg: Message, sender: str):
+        if route.executor != "process":
+            return super()._invoke(route, msg, sender)
+        task = asyncio.ensure_future(self._invoke_in_process(route, msg, sender))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _invoke_in_process(self, route: Route, msg: Message, sender: str):
+        # submit() may block for a free slot, and copies the blob, so it runs off-loop;
+        # the reply and the metrics come back onto the loop
+        started = time.perf_counter_ns()
+        call_soon = self._loop.call_soon_threadsafe
+        try:
+            future = await self._loop.run_in_executor(None, self._process_pool.submit, route.handler, msg,
+                                                      sender, call_soon)
+        except Exception as e:
+            msg.fail(e)
+            return
+        future.add_done_callback(lambda f: call_soon(self._process_handler_done, f, msg, sender, started))
+
+    def _run_handler(self, handler: Callable, msg: Message, sender: str):
+        if inspect.iscoroutinefunction(handler):
+            coro = self._run_async_handler(handler, msg, sender)
+        elif msg.stream is not None:
+            # Iterating a stream blocks until this loop feeds it chunks, so run it off-loop
+            coro = self._loop.run_in_executor(None, super()._run_handler, handler, msg, sender)
+        else:
+            return super()._run_handler(handler, msg, sender)
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_async_handler(self, handler: Callable, msg: Message, sender: str):
+        started = time.perf_counter_ns()
+        try:
+            result = await handler(msg, sender)
+            self.metrics.observe("handler", time.perf_counter_ns() - started, msg.key, sender)
+            if msg.trace is not None:
+                self._span(msg, "handler", started, sender)
+            if result is not None:
+                msg.respond(result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.metrics.count("handler_errors", msg.key, sender)
+            msg.fail(e)
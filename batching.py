@@ -0,0 +1,85 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+import wire
+
+BATCH_FEATURE = "batch"
+DEFAULT_BATCH_DELAY_US = 500
+MAX_BATCHED_SIZE = 64 * 1024   # Messages larger than this are sent on their own
+
+
+class SendBatcher:
+    """Coalesces small outgoing messages per destination into multi-part batches.
+
+    A destination's batch is sent once it holds max_messages messages or
+    its oldest message has waited max_delay seconds, whichever comes first.
+    The destination is a peer UUID, or None for the group shout.
+    """
+
+    def __init__(self, send_frames: Callable[[Optional[str], Sequence[bytes]], None],
+                 max_messages: int, max_delay: float = DEFAULT_BATCH_DELAY_US / 1e6):
+        self._send_frames = send_frames
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()   # Keeps batches to one destination in order
+        self._pending: Dict[Optional[str], List[Sequence[bytes]]] = {}
+        self._deadlines: Dict[Optional[str], float] = {}
+        self._running = True
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+
+    def add(self, dest: Optional[str], frames: Sequence[bytes]):
+        with self._cond:
+            batch = self._pending.setdefault(dest, [])
+            batch.append(frames)
+            if len(batch) == 1:
+                self._deadlines[dest] = time.monotonic() + self.max_delay
+                self._cond.notify()
+            full = len(batch) >= self.max_messages
+        if full:
+            self.flush(dest)
+
+    def flush(self, dest: Optional[str]):
+        with self._flush_lock:
+            with self._cond:
+                batch = self._pending.pop(dest, None)
+                self._deadlines.pop(dest, None)
+            if batch:
+                self._send(dest, batch)
+
+    def flush_all(self):
+        with self._cond:
+            dests = list(self._pending)
+        for dest in dests:
+            self.flush(dest)
+
+    def _send(self, dest: Optional[str], batch: List[Sequence[bytes]]):
+        frames = batch[0] if len(batch) == 1 else wire.pack_batch(batch)
+        try:
+            self._send_frames(dest, frames)
+        except Exception as e:
+            print(f"[MessageComs] Failed to send batch of {len(batch)} to {dest}: {e}")
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        self.flush_all()
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    now = time.monotonic()
+                    due = [dest for dest, deadline in self._deadlines.items() if deadline <= now]
+                    if due:
+                        break
+                    timeout = min(self._deadlines.values()) - now if self._deadlines else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+            for dest in due:
+                self.flush(dest)
@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import threading
+import time
+import timeit
+from typing import Callable, Dict, Optional
+
+from message import Message, MessageBuilder
+from message_coms import MessageComs
+from metrics import Histogram
+from transport import LoopbackHub, LoopbackTransport
+import wire
+
+# Benchmark suite
+#
+# "run" times the hot paths (micro: ns per call) and request/reply over a
+# pair of nodes (macro: msgs/s and latency percentiles per message size
+# and worker count), and writes the results as a JSON baseline. "compare"
+# diffs two baselines and exits non-zero on regressions, for use in CI.
+# Macro benchmarks use the in-process loopback transport unless
+# --transport zyre is given, so the suite runs without a network.
+GROUP_NAME = "mktl-bench"
+ROLE_SIZES = {"small": 0, "medium": 1024 * 1024, "large": 10 * 1024 * 1024, "x-large": 50 * 1024 * 1024}
+ROLE_COUNTS = {"small": 5000, "medium": 200, "large": 40, "x-large": 10}   # Requests per run; --quick does a fifth
+WORKER_COUNTS = [1, 2, 4]
+DEFAULT_WORKERS = 2
+DEFAULT_THRESHOLD = 0.15    # Relative slowdown that counts as a regression
+TRANSPORTS = {"loopback", "zyre"}
+
+LOWER, HIGHER = "lower", "higher"   # Which direction is better for a result
+
+
+def result(value: float, unit: str, better: str = LOWER) -> dict:
+    return {"value": value, "unit": unit, "better": better}
+
+
+def time_per_call(fn: Callable[[], object], repeat: int = 5, min_time: float = 0.2) -> float:
+    """Best-of-repeat nanoseconds per call of fn."""
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def _make_node(name: str, hub: Optional[LoopbackHub], workers: int = DEFAULT_WORKERS) -> MessageComs:
+    transport = LoopbackTransport(name, hub) if hub is not None else None
+    return MessageComs(name=name, group=GROUP_NAME, transport=transport, workers=workers, verbose=False)
+
+
+def micro_benchmarks() -> Dict[str, dict]:
+    results = {}
+    coms = _make_node("micro", LoopbackHub())
+    builder = lambda: (MessageBuilder(coms).with_type("whisper").with_key("perf.echo")
+                       .with_destination(b"peer").with_json_data({"sent_time": 1.0}).build())
+    msg = builder()
+    text = msg.to_json()
+    frames = wire.encode(msg, wire.FORMAT_BIN1)
+
+    results["micro.builder_build"] = result(time_per_call(builder), "ns/op")
+    results["micro.to_json"] = result(time_per_call(msg.to_json), "ns/op")
+    results["micro.from_json"] = result(time_per_call(lambda: Message.from_json(text, coms)), "ns/op")
+    results["micro.wire_encode_bin1"] = result(time_per_call(lambda: wire.encode(msg, wire.FORMAT_BIN1)), "ns/op")
+    results["micro.wire_decode_bin1"] = result(time_per_call(lambda: wire.decode(frames, coms=coms)), "ns/op")
+
+    try:
+        from zyre_transport import build_zmsg, destroy_zmsg
+    except (ImportError, OSError) as e:
+        print(f"[bench] Skipping micro.zmsg_build_destroy: {e}", file=sys.__stdout__)
+    else:
+        results["micro.zmsg_build_destroy"] = result(time_per_call(lambda: destroy_zmsg(build_zmsg(frames))),
+                                                     "ns/op")
+
+    # A shout to a registered handler: routing and the handler call, without a reply to send
+    coms.register_handler("perf.echo", lambda m, sender: None)
+    shout = MessageBuilder(coms).with_type("shout").with_key("perf.echo").with_json_data({}).build()
+    results["micro.dispatch"] = result(time_per_call(lambda: coms._dispatch(shout, "peer")), "ns/op")
+    coms.transport.stop()
+    return results
+
+
+def request_reply(size: int, workers: int, count: int, window: int, transport: str = "loopback") -> dict:
+    """Time count echo requests of size-byte blobs, window of them in flight at once."""
+    hub = LoopbackHub() if transport == "loopback" else None
+    server = _make_node("bench-server", hub, workers)
+    client = _make_node("bench-client", hub)
+    server.register_handler("perf.echo", lambda msg, sender: {"echoed": True})
+    blob = b"x" * size if size else None
+    latency = Histogram()
+    slots = threading.Semaphore(window)
+    done = threading.Event()
+    lock = threading.Lock()
+    remaining = [count]
+
+    def finished(future, started):
+        elapsed = time.perf_counter_ns() - started
+        with lock:
+            if future.exception() is None:
+                latency.record(elapsed)
+            remaining[0] -= 1
+            if not remaining[0]:
+                done.set()
+        slots.release()
+
+    server.start()
+    client.start()
+    try:
+        deadline = time.time() + 30
+        while server.uuid not in client._peer_keys or client.uuid not in server._peer_keys:
+            if time.time() > deadline:
+                raise RuntimeError("Benchmark nodes did not discover each other")
+            time.sleep(0.01)
+
+        started_all = time.perf_counter()
+        for _ in range(count):
+            slots.acquire()
+            started = time.perf_counter_ns()
+            future = client.request("perf.echo", {}, server.uuid, timeout=60, blob=blob)
+            future.add_done_callback(lambda f, s=started: finished(f, s))
+        done.wait()
+        elapsed = time.perf_counter() - started_all
+    finally:
+        client.stop()
+        server.stop()
+    return {"msgs_per_s": count / elapsed, "errors": count - latency.count, **latency.summary(1e-9)}
+
+
+def macro_benchmarks(quick: bool, transport: str) -> Dict[str, dict]:
+    results = {}
+    runs = [(role, DEFAULT_WORKERS) for role in ROLE_SIZES]
+    runs += [("small", workers) for workers in WORKER_COUNTS if workers != DEFAULT_WORKERS]
+    for role, workers in runs:
+        size = ROLE_SIZES[role]
+        count = ROLE_COUNTS[role] // 5 if quick else ROLE_COUNTS[role]
+        window = 64 if size < 1024 * 1024 else 4
+        stats = request_reply(size, workers, count, window, transport)
+        prefix = f"macro.{role}.w{workers}"
+        results[f"{prefix}.msgs_per_s"] = result(stats["msgs_per_s"], "msg/s", HIGHER)
+        for q in ("p50", "p99", "p99.9"):
+            results[f"{prefix}.{q}"] = result(stats[q], "s")
+        print(f"[bench] {prefix}: {stats['msgs_per_s']:.0f} msg/s, p50 {stats['p50'] * 1e3:.3f} ms, "
+              f"p99 {stats['p99'] * 1e3:.3f} ms over {count} requests", file=sys.__stdout__)
+    return results
+
+
+def run(args) -> dict:
+    if args.transport not in TRANSPORTS:
+        raise ValueError(f"Invalid transport: {args.transport}. Must be one of {TRANSPORTS}")
+    results = {}
+    # MessageComs logs to stdout; keep it out of the benchmark output
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.only in (None, "micro"):
+            results.update(micro_benchmarks())
+        if args.only in (None, "macro"):
+            results.update(macro_benchmarks(args.quick, args.transport))
+    for name, entry in sorted(results.items()):
+        print(f"{name:<40} {entry['value']:>14.6g} {entry['unit']}")
+    baseline = {
+        "meta": {"time": time.time(), "python": platform.python_version(), "machine": platform.machine(),
+                 "platform": platform.platform(), "transport": args.transport, "quick": args.quick},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(baseline, f, indent=1)
+        print(f"Wrote {args.output}")
+    return baseline
+
+
+def compare(baseline: dict, current: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """Results that got worse by more than threshold, as (name, old, new, change)."""
+    regressions = []
+    for name, new in sorted(current["results"].items()):
+        old = baseline["results"].get(name)
+        if old is None or not old["value"]:
+            continue
+        change = new["value"] / old["value"] - 1
+        worse = change > threshold if new["better"] == LOWER else change < -threshold
+        flag = "REGRESSION" if worse else ""
+        print(f"{name:<40} {old['value']:>14.6g} {new['value']:>14.6g} {change:>+8.1%} {flag}")
+        if worse:
+            regressions.append((name, old["value"], new["value"], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Messaging benchmarks and regression checks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--only", choices=["micro", "macro"])
+    run_parser.add_argument("--quick", action="store_true", help="Fewer messages, for a fast check")
+    run_parser.add_argument("--transport", default="loopback", choices=sorted(TRANSPORTS))
+    run_parser.add_argument("-o", "--output", help="Write results as a JSON baseline")
+    compare_parser = commands.add_parser("compare", help="Flag regressions against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run(args)
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1)
+    print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
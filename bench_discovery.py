@@ -0,0 +1,73 @@
+import argparse
+import contextlib
+import io
+import time
+
+from message_coms import MessageComs
+from transport import LoopbackHub, LoopbackTransport
+
+GROUP_NAME = "mktl-perf"
+KEYS_PER_NODE = ["peer.hello", "perf.echo", "camera.expose", "camera.readout"]
+
+
+class CountingHub(LoopbackHub):
+    """LoopbackHub that counts the messages each receiver has to parse."""
+
+    def __init__(self):
+        super().__init__("bench")
+        self.delivered = 0
+
+    def whisper(self, sender, peer_id, frames):
+        self.delivered += 1
+        super().whisper(sender, peer_id, frames)
+
+    def shout(self, sender, group, frames):
+        with self._lock:
+            self.delivered += len(self._groups.get(group, ())) - 1
+        super().shout(sender, group, frames)
+
+
+def converge(n: int, timeout: float) -> dict:
+    """Start n nodes at once and time until every node has every other node's keys."""
+    hub = CountingHub()
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        nodes = []
+        for i in range(n):
+            node = MessageComs(name=f"node-{i}", group=GROUP_NAME, transport=LoopbackTransport(f"node-{i}", hub),
+                               workers=0)
+            for key in KEYS_PER_NODE:
+                node.register_handler(key, lambda msg, sender: None)
+            node.start()
+            nodes.append(node)
+
+        deadline = started + timeout
+        converged = False
+        while time.perf_counter() < deadline:
+            if all(len(node._peer_keys) == n - 1 for node in nodes):
+                converged = True
+                break
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - started
+        messages = hub.delivered
+
+        for node in nodes:
+            node.stop()
+    return {"nodes": n, "seconds": elapsed, "converged": converged, "messages": messages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time for N loopback nodes to converge on each other's keys")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10, 50, 100, 200, 400])
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    print(f"{'nodes':>6} {'seconds':>9} {'messages':>10} {'msgs/node':>10}")
+    for n in args.nodes:
+        result = converge(n, args.timeout)
+        note = "" if result["converged"] else "  (timed out)"
+        print(f"{n:>6} {result['seconds']:>9.3f} {result['messages']:>10} {result['messages'] / n:>10.1f}{note}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import argparse
+import csv
+import json
+import math
+import mmap
+import struct
+import sys
+import threading
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Append-only columnar log
+#
+# File: FILE_MAGIC, u32 schema length, JSON schema {"columns": [[name, type]],
+# "byteorder"}, then blocks. Each block is BLOCK_HEADER (magic, rows, bytes
+# of new symbols, bytes of column data), a JSON list of the symbols first
+# used in this block, then every column in schema order. Sections are padded
+# to 8 bytes so a reader can cast the mapped file to typed views in place.
+#
+# Column types: "f64" and "i64" numbers (None or "" is written as NaN or 0),
+# "sym" strings interned into u32 ids (peers, roles, modes), and "str" for
+# free text (u32 offsets plus UTF-8 data). A block is written once
+# block_rows records are buffered, and at every flush_interval, so a crash
+# loses at most that much; a truncated last block is ignored on read.
+FILE_MAGIC = b"MKTLCOL1"
+BLOCK_MAGIC = b"BLK1"
+BLOCK_HEADER = struct.Struct("<4sIII")
+COLUMN_TYPES = {"f64": "d", "i64": "q", "sym": "I", "str": None}
+DEFAULT_BLOCK_ROWS = 4096
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+Column = Tuple[str, str]     # (name, type)
+
+
+def _padding(n: int) -> bytes:
+    return b"\0" * (-n % 8)
+
+
+class ColumnarLogWriter:
+    """Buffers records into typed columns and appends them to path in blocks.
+
+    append() only touches in-memory arrays, so it is cheap enough to call
+    from handler threads directly; it is thread-safe.
+    """
+
+    def __init__(self, path: str, columns: Sequence[Column], block_rows: int = DEFAULT_BLOCK_ROWS,
+                 flush_interval: Optional[float] = DEFAULT_FLUSH_INTERVAL):
+        for name, kind in columns:
+            if kind not in COLUMN_TYPES:
+                raise ValueError(f"Invalid type for column {name}: {kind}. Must be one of {set(COLUMN_TYPES)}")
+        if block_rows < 1:
+            raise ValueError("block_rows must be at least 1")
+        self.path = path
+        self.columns = list(columns)
+        self.names = [name for name, _ in self.columns]
+        self.block_rows = block_rows
+        self._symbols: Dict[str, int] = {}
+        self._new_symbols: List[str] = []
+        self._lock = threading.Lock()
+        self._reset_buffers()
+        self._rows = 0
+
+        self._fp = open(path, "wb")
+        schema = json.dumps({"columns": self.columns, "byteorder": sys.byteorder}).encode()
+        header = FILE_MAGIC + struct.pack("<I", len(schema)) + schema
+        self._fp.write(header + _padding(len(header)))
+        self._fp.flush()
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if flush_interval:
+            self._thread = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True)
+            self._thread.start()
+
+    def _reset_buffers(self):
+        self._buffers = [array(COLUMN_TYPES[kind]) if COLUMN_TYPES[kind] else [] for _, kind in self.columns]
+
+    def append(self, *values):
+        """Add one record, with a value for every column in schema order."""
+        if len(values) != len(self.columns):
+            raise ValueError(f"Expected {len(self.columns)} values, got {len(values)}")
+        # Convert every value before touching the buffers, so a bad one can't leave a partial row
+        row = []
+        for (name, kind), value in zip(self.columns, values):
+            if kind == "f64":
+                row.append(math.nan if value is None or value == "" else float(value))
+            elif kind == "i64":
+                value = 0 if value is None or value == "" else int(value)
+                if not -(1 << 63) <= value < 1 << 63:
+                    raise OverflowError(f"Value for column {name} out of i64 range: {value}")
+                row.append(value)
+            else:
+                row.append("" if value is None else str(value))
+        with self._lock:
+            for (_, kind), buffer, value in zip(self.columns, self._buffers, row):
+                if kind == "sym":
+                    symbol = self._symbols.get(value)
+                    if symbol is None:
+                        symbol = self._symbols[value] = len(self._symbols)
+                        self._new_symbols.append(value)
+                    value = symbol
+                buffer.append(value)
+            self._rows += 1
+            if self._rows >= self.block_rows:
+                self._write_block()
+
+    def write(self, record: dict):
+        """Add one record given as a dict; missing columns are left empty."""
+        self.append(*(record.get(name) for name in self.names))
+
+    def _write_block(self):
+        # Caller holds _lock
+        if not self._rows:
+            return
+        symbols = json.dumps(self._new_symbols).encode() if self._new_symbols else b""
+        parts = []
+        for (_, kind), buffer in zip(self.columns, self._buffers):
+            if kind == "str":
+                encoded = [value.encode() for value in buffer]
+                offsets = array("I", [0])
+                for item in encoded:
+                    offsets.append(offsets[-1] + len(item))
+                column = offsets.tobytes() + b"".join(encoded)
+            else:
+                column = buffer.tobytes()
+            parts += [column, _padding(len(column))]
+        data = b"".join(parts)
+        self._fp.write(BLOCK_HEADER.pack(BLOCK_MAGIC, self._rows, len(symbols), len(data)))
+        self._fp.write(symbols + _padding(len(symbols)) + data)
+        self._new_symbols.clear()
+        self._reset_buffers()
+        self._rows = 0
+
+    def flush(self):
+        """Write buffered records as a (possibly short) block and flush the file."""
+        with self._lock:
+            if self._fp.closed:
+                return
+            self._write_block()
+            self._fp.flush()
+
+    def _flush_loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[ColumnarLogWriter] Failed to write {self.path}: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._lock:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ColumnarLogReader:
+    """Memory-mapped reader for files written by ColumnarLogWriter.
+
+    Numeric columns come back as typed memoryviews into the mapping, so a
+    block is read without copying or parsing; numpy.frombuffer() accepts
+    them as is.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a columnar log")
+        schema_len, = struct.unpack_from("<I", self._map, len(FILE_MAGIC))
+        start = len(FILE_MAGIC) + 4
+        schema = json.loads(bytes(self._map[start:start + schema_len]))
+        self.columns: List[Column] = [tuple(column) for column in schema["columns"]]
+        self.names = [name for name, _ in self.columns]
+        self._swap = schema["byteorder"] != sys.byteorder
+        self.symbols: List[str] = []
+        self._blocks: List[Tuple[int, int]] = []     # (offset of column data, rows)
+        self._index(start + schema_len + len(_padding(start + schema_len)))
+
+    def _index(self, offset: int):
+        size = len(self._map)
+        while offset + BLOCK_HEADER.size <= size:
+            magic, rows, symbols_len, data_len = BLOCK_HEADER.unpack_from(self._map, offset)
+            data = offset + BLOCK_HEADER.size + symbols_len + len(_padding(symbols_len))
+            if magic != BLOCK_MAGIC or data + data_len > size:
+                break   # Partly written block at the end
+            if symbols_len:
+                self.symbols += json.loads(bytes(self._map[offset + BLOCK_HEADER.size:
+                                                           offset + BLOCK_HEADER.size + symbols_len]))
+            self._blocks.append((data, rows))
+            offset = data + data_len
+
+    def __len__(self) -> int:
+        return sum(rows for _, rows in self._blocks)
+
+    def blocks(self) -> Iterator[Dict[str, object]]:
+        """Yield each block as {column: values}: memoryviews for "f64", "i64"
+        and "sym" (symbol ids, see symbols), lists of str for "str"."""
+        view = memoryview(self._map)
+        for offset, rows in self._blocks:
+            block = {}
+            for name, kind in self.columns:
+                code = COLUMN_TYPES[kind]
+                if code is not None:
+                    nbytes = rows * array(code).itemsize
+                    values = view[offset:offset + nbytes].cast(code)
+                    if self._swap:
+                        values = array(code, values)
+                        values.byteswap()
+                else:
+                    offsets = array("I")
+                    offsets.frombytes(view[offset:offset + (rows + 1) * 4])
+                    if self._swap:
+                        offsets.byteswap()
+                    data = offset + (rows + 1) * 4
+                    values = [str(view[data + offsets[i]:data + offsets[i + 1]], "utf-8") for i in range(rows)]
+                    nbytes = (rows + 1) * 4 + offsets[-1]
+                block[name] = values
+                offset += nbytes + len(_padding(nbytes))
+            yield block
+
+    def column(self, name: str) -> list:
+        """All values of one column, with symbols resolved to their strings."""
+        kind = dict(self.columns)[name]
+        values = []
+        for block in self.blocks():
+            if kind == "sym":
+                values += [self.symbols[i] for i in block[name]]
+            else:
+                values += block[name].tolist() if isinstance(block[name], memoryview) else block[name]
+        return values
+
+    def to_dict(self) -> Dict[str, list]:
+        """Every column by name, e.g. for pandas.DataFrame()."""
+        return {name: self.column(name) for name in self.names}
+
+    def rows(self) -> Iterator[dict]:
+        for block in self.blocks():
+            columns = []
+            for name, kind in self.columns:
+                values = block[name]
+                columns.append([self.symbols[i] for i in values] if kind == "sym" else values)
+            for row in zip(*columns):
+                yield dict(zip(self.names, row))
+
+    def to_csv(self, path: str):
+        """Export as CSV, with empty cells for NaN."""
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.names)
+            for row in self.rows():
+                writer.writerow(["" if isinstance(v, float) and math.isnan(v) else v for v in row.values()])
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            pass    # Views from blocks() are still in use; the mapping goes when they do
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a columnar log as CSV")
+    parser.add_argument("log")
+    parser.add_argument("csv")
+    args = parser.parse_args()
+    with ColumnarLogReader(args.log) as reader:
+        reader.to_csv(args.csv)
+        print(f"Wrote {len(reader)} rows to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import collections
+import hashlib
+import threading
+from typing import Dict, Optional, Set
+
+from buffers import Blob
+
+# Content-addressed blobs
+#
+# A sender that has already given a blob to every receiver of a message
+# replaces it with a reserved BLOB_REF entry {"hash", "size"} in json_data.
+# The first time, the blob goes along with the BLOB_REF so receivers can
+# cache it. A receiver that no longer has the blob parks the message and
+# whispers BLOB_FETCH_KEY to the sender, which answers with BLOB_DATA_KEY
+# carrying the blob (or "missing", if the sender evicted it too). Parked
+# messages are dropped if the blob has not come within BLOB_FETCH_TIMEOUT.
+BLOB_REF = "_blob"
+BLOB_FETCH_KEY = "blob.fetch"
+BLOB_DATA_KEY = "blob.data"
+BLOB_CACHE_FEATURE = "blobcache"
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_CACHE_THRESHOLD = 1024 * 1024
+BLOB_FETCH_TIMEOUT = 10.0        # seconds
+
+
+def blob_digest(blob: Blob) -> str:
+    return hashlib.blake2b(blob, digest_size=16).hexdigest()
+
+
+class BlobCache:
+    """LRU map of digest → blob bounded by the total size of the blobs.
+
+    Blobs are stored as immutable bytes, so callers cannot change a cached
+    blob under its digest. Each entry also tracks the peers known to have
+    the blob, which the sending side uses to decide when a reference will do.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "collections.OrderedDict[str, bytes]" = collections.OrderedDict()
+        self._holders: Dict[str, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._entries
+
+    def get(self, digest: str) -> Optional[bytes]:
+        with self._lock:
+            blob = self._entries.get(digest)
+            if blob is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return blob
+
+    def put(self, digest: str, blob: Blob) -> bytes:
+        """Cache blob under digest and return the stored copy. A blob already
+        cached is not copied again."""
+        with self._lock:
+            if digest in self._entries:
+                self._entries.move_to_end(digest)
+                return self._entries[digest]
+        if not isinstance(blob, bytes):
+            blob = bytes(blob)
+        size = len(blob)
+        with self._lock:
+            if digest in self._entries:
+                # Another thread cached it while we copied
+                self._entries.move_to_end(digest)
+                return self._entries[digest]
+            if size > self.max_bytes:
+                return blob
+            while self.nbytes + size > self.max_bytes:
+                evicted, old = self._entries.popitem(last=False)
+                self._holders.pop(evicted, None)
+                self.nbytes -= len(old)
+            self._entries[digest] = blob
+            self.nbytes += size
+            return blob
+
+    def holders(self, digest: str) -> Set[str]:
+        """Peers known to have the blob; empty if it is not cached."""
+        with self._lock:
+            if digest not in self._entries:
+                return set()
+            return set(self._holders.get(digest, ()))
+
+    def add_holders(self, digest: str, peers):
+        with self._lock:
+            if digest in self._entries:
+                self._holders.setdefault(digest, set()).update(peers)
+
+    def drop_holder(self, peer_id: str):
+        with self._lock:
+            for peers in self._holders.values():
+                peers.discard(peer_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.nbytes, "hits": self.hits, "misses": self.misses}
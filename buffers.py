@@ -0,0 +1,91 @@
+import ctypes
+from typing import Any, Union
+
+# Anything exposing the buffer protocol: bytes, bytearray, memoryview, mmap, numpy arrays...
+Blob = Union[bytes, bytearray, memoryview, Any]
+
+_PyBUF_SIMPLE = 0
+
+
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [
+        ("buf", ctypes.c_void_p),
+        ("obj", ctypes.c_void_p),
+        ("len", ctypes.c_ssize_t),
+        ("itemsize", ctypes.c_ssize_t),
+        ("readonly", ctypes.c_int),
+        ("ndim", ctypes.c_int),
+        ("format", ctypes.c_char_p),
+        ("shape", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("strides", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("suboffsets", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("internal", ctypes.c_void_p),
+    ]
+
+
+_PyObject_GetBuffer = ctypes.pythonapi.PyObject_GetBuffer
+_PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer), ctypes.c_int]
+_PyObject_GetBuffer.restype = ctypes.c_int
+_PyBuffer_Release = ctypes.pythonapi.PyBuffer_Release
+_PyBuffer_Release.argtypes = [ctypes.POINTER(_Py_buffer)]
+_PyBuffer_Release.restype = None
+
+
+def check_blob(blob: Blob) -> Blob:
+    """Validate that blob is a contiguous buffer and return it unchanged."""
+    try:
+        view = memoryview(blob)
+    except TypeError:
+        raise TypeError(f"Binary blob must support the buffer protocol, got {type(blob).__name__}") from None
+    if not view.contiguous:
+        raise ValueError("Binary blob must be a contiguous buffer")
+    return blob
+
+
+def blob_nbytes(blob: Blob) -> int:
+    """Size of blob in bytes (len() is element count for arrays)."""
+    if isinstance(blob, (bytes, bytearray)):
+        return len(blob)
+    return memoryview(blob).nbytes
+
+
+class BufferPin:
+    """Holds a buffer export on obj so its memory can be handed to C without copying.
+
+    The exporting object cannot be resized or freed until release() is called.
+    """
+
+    __slots__ = ("_view", "address", "nbytes")
+
+    def __init__(self, obj: Blob):
+        view = _Py_buffer()
+        _PyObject_GetBuffer(obj, ctypes.byref(view), _PyBUF_SIMPLE)
+        self._view = view
+        self.address = view.buf or 0
+        self.nbytes = view.len
+
+    def release(self):
+        view = getattr(self, "_view", None)
+        if view is not None:
+            self._view = None
+            _PyBuffer_Release(ctypes.byref(view))
+
+    def __del__(self):
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def frame_view(address: int, size: int, owner: Any) -> memoryview:
+    """Expose size bytes at address as a read-only memoryview without copying.
+
+    owner (e.g. the zframe holding the data) is kept alive for as long as
+    the returned view, or any slice of it, is referenced.
+    """
+    array = (ctypes.c_char * size).from_address(address)
+    array._owner = owner
+    return memoryview(array).cast("B").toreadonly()
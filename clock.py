@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+# Per-peer clock offset estimation, NTP style
+#
+# Each ping exchange gives four timestamps: t0 when we sent, t1 when the peer
+# received, t2 when it replied (peer clock) and t3 when the reply arrived.
+# Its offset (peer clock minus ours) is ((t1 - t0) + (t2 - t3)) / 2, known to
+# within half its network delay (t3 - t0) - (t2 - t1), as the two legs may be
+# asymmetric. The estimate uses the lowest-delay samples in a window, the
+# ones queueing distorted least, and fits a line through them to follow
+# drift. Timestamps are now_ns(): the monotonic clock on a wall-clock epoch,
+# so a wall clock stepped by NTP mid-run doesn't corrupt the samples.
+DEFAULT_WINDOW = 64
+BEST_FRACTION = 4            # Fit through the lowest-delay quarter of the window...
+MIN_BEST = 8                 # ...but no fewer samples than this
+MIN_DRIFT_SPAN_NS = 10 ** 9  # Only estimate drift from samples at least a second apart
+
+_EPOCH = time.time_ns() - time.perf_counter_ns()
+
+
+def now_ns() -> int:
+    """Monotonic nanoseconds since the Unix epoch, to exchange with peers."""
+    return _EPOCH + time.perf_counter_ns()
+
+
+@dataclass(frozen=True)
+class ClockEstimate:
+    offset_ns: float     # Peer clock minus ours, at local time at_ns
+    drift: float         # Change in offset per unit of local time (1e-6 is 1 ppm)
+    error_ns: float      # Bound on how far offset_ns may be off
+    at_ns: int
+    samples: int
+
+    def offset_at(self, local_ns: int) -> float:
+        return self.offset_ns + self.drift * (local_ns - self.at_ns)
+
+
+class PeerClock:
+    """Offset and drift of one peer's clock, from a window of ping exchanges."""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self._samples: deque = deque(maxlen=window)   # (local time, offset, delay)
+
+    def add(self, t0: int, t1: int, t2: int, t3: int) -> bool:
+        """Add an exchange; returns False if its timestamps are inconsistent."""
+        delay = (t3 - t0) - (t2 - t1)
+        if delay < 0 or t3 < t0:
+            return False
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self._samples.append(((t0 + t3) // 2, offset, delay))
+        return True
+
+    def estimate(self) -> Optional[ClockEstimate]:
+        if not self._samples:
+            return None
+        best = sorted(self._samples, key=lambda s: s[2])[:max(MIN_BEST, len(self._samples) // BEST_FRACTION)]
+        latest = max(s[0] for s in self._samples)
+        times = [s[0] for s in best]
+        drift = 0.0
+        if len(best) >= 2 and max(times) - min(times) >= MIN_DRIFT_SPAN_NS:
+            # Least squares, around the mean time to keep the numbers small
+            mean_t = sum(times) / len(best)
+            mean_o = sum(s[1] for s in best) / len(best)
+            var = sum((t - mean_t) ** 2 for t in times)
+            drift = sum((s[0] - mean_t) * (s[1] - mean_o) for s in best) / var
+            offset = mean_o + drift * (latest - mean_t)
+            residual = max(abs(s[1] - (mean_o + drift * (s[0] - mean_t))) for s in best)
+        else:
+            offset = best[0][1]
+            residual = max(abs(s[1] - offset) for s in best) if len(best) > 1 else 0.0
+        error = min(s[2] for s in best) / 2 + residual
+        return ClockEstimate(offset, drift, error, latest, len(self._samples))
+
+
+class ClockSync:
+    """PeerClock per peer; safe to feed from several threads."""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self.window = window
+        self._clocks: Dict[str, PeerClock] = {}
+        self._lock = threading.Lock()
+
+    def add(self, peer_id: str, t0: int, t1: int, t2: int, t3: int) -> bool:
+        with self._lock:
+            clock = self._clocks.get(peer_id)
+            if clock is None:
+                clock = self._clocks[peer_id] = PeerClock(self.window)
+            return clock.add(t0, t1, t2, t3)
+
+    def estimate(self, peer_id: str) -> Optional[ClockEstimate]:
+        with self._lock:
+            clock = self._clocks.get(peer_id)
+            return clock.estimate() if clock is not None else None
+
+    def one_way(self, peer_id: str, sent_ns: int, recv_ns: int,
+                sent_by_peer: bool = True) -> Optional[Tuple[float, float]]:
+        """(latency, error bound) in ns of a message between us and peer_id,
+        or None until an exchange with it has completed. sent_ns is on the
+        sender's clock and recv_ns on the receiver's; sent_by_peer says which
+        way the message went."""
+        estimate = self.estimate(peer_id)
+        if estimate is None:
+            return None
+        local = recv_ns if sent_by_peer else sent_ns
+        offset = estimate.offset_at(local)
+        latency = recv_ns - (sent_ns - offset) if sent_by_peer else (recv_ns - offset) - sent_ns
+        return latency, estimate.error_ns
+
+    def drop(self, peer_id: str):
+        with self._lock:
+            self._clocks.pop(peer_id, None)
@@ -0,0 +1,289 @@
+import threading
+import time
+import zlib
+from typing import Dict, Optional, Sequence
+
+from buffers import Blob, blob_nbytes
+
+# Faster codecs are used when installed; zlib is always there to fall back on
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Blob compression
+#
+# Peers advertise the codecs they can decode as "codecs" in "peer.keys". A
+# compressed blob travels with a reserved CODEC_META entry {"name", "size"}
+# in json_data giving the codec and the uncompressed size; receivers strip
+# it and decompress before the handler runs.
+CODEC_META = "_codec"
+
+DEFAULT_MAX_RATIO = 0.9          # Compressed/original above this is not worth it
+DEFAULT_BANDWIDTH = 125_000_000  # Bytes/s of the link compression has to beat (1 Gbit/s)
+PROBE_INTERVAL = 32              # Re-try a key that stopped compressing every this many messages
+_EWMA_ALPHA = 0.25
+
+
+class CodecError(ValueError):
+    pass
+
+
+class Codec:
+    name: str
+
+    def compress(self, data: Blob) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: Blob, size: int) -> bytes:
+        """Decompress data, which must expand to exactly size bytes; never
+        produces much more than that before raising CodecError."""
+        raise NotImplementedError
+
+    def decompressor(self, size: int):
+        """Incremental decompressor with a decompress(chunk) method, for streamed
+        blobs, that raises CodecError once the output would pass size bytes."""
+        raise NotImplementedError
+
+
+def _overrun(name: str, size: int) -> CodecError:
+    return CodecError(f"{name} blob expands past its declared {size}B")
+
+
+class _BoundedDecompressor:
+    # Wraps a zlib or lz4 incremental decompressor, asking each call for at
+    # most one byte more than is left so an overrun is caught without
+    # inflating it
+    def __init__(self, name: str, decompressor, size: int):
+        self._name = name
+        self._decompressor = decompressor
+        self._size = size
+        self._left = size
+
+    def decompress(self, chunk: Blob) -> bytes:
+        data = self._decompressor.decompress(chunk, self._left + 1)
+        if len(data) > self._left:
+            raise _overrun(self._name, self._size)
+        self._left -= len(data)
+        return data
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+
+    def __init__(self, level: int = 1):
+        self.level = level
+
+    def compress(self, data: Blob) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: Blob, size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(data, size + 1)
+        if len(out) > size:
+            raise _overrun(self.name, size)
+        return out
+
+    def decompressor(self, size: int):
+        return _BoundedDecompressor(self.name, zlib.decompressobj(), size)
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+
+    def compress(self, data: Blob) -> bytes:
+        return lz4_frame.compress(data)
+
+    def decompress(self, data: Blob, size: int) -> bytes:
+        # compress() stores the content size in the frame header; lz4 allocates
+        # what the header says, so check it first
+        if lz4_frame.get_frame_info(data)["content_size"] != size:
+            raise CodecError(f"lz4 frame does not declare the expected {size}B")
+        return lz4_frame.decompress(data)
+
+    def decompressor(self, size: int):
+        return _BoundedDecompressor(self.name, lz4_frame.LZ4FrameDecompressor(), size)
+
+
+class _ZstdStreamDecompressor:
+    # zstandard's decompressobj takes no output limit, so the frame header is
+    # checked against size before the first chunk is decoded
+    def __init__(self, size: int):
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self._size = size
+        self._left = size
+        self._checked = False
+
+    def decompress(self, chunk: Blob) -> bytes:
+        if not self._checked:
+            if zstandard.frame_content_size(chunk) != self._size:
+                raise CodecError(f"zstd frame does not declare the expected {self._size}B")
+            self._checked = True
+        data = self._decompressor.decompress(chunk)
+        if len(data) > self._left:
+            raise _overrun("zstd", self._size)
+        self._left -= len(data)
+        return data
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+
+    def __init__(self, level: int = 3):
+        self._level = level
+        self._local = threading.local()   # zstandard contexts are not thread-safe
+
+    def compress(self, data: Blob) -> bytes:
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self._level)
+        return compressor.compress(data)
+
+    def decompress(self, data: Blob, size: int) -> bytes:
+        # Rejects frames declaring another size, or none, as the streamed path does
+        if zstandard.frame_content_size(data) != size:
+            raise CodecError(f"zstd frame does not declare the expected {size}B")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+    def decompressor(self, size: int):
+        return _ZstdStreamDecompressor(size)
+
+
+# Codecs this build can speak, in order of preference
+CODECS: Dict[str, Codec] = {}
+if zstandard is not None:
+    CODECS["zstd"] = ZstdCodec()
+if lz4_frame is not None:
+    CODECS["lz4"] = Lz4Codec()
+CODECS["zlib"] = ZlibCodec()
+SUPPORTED_CODECS = list(CODECS)
+
+
+def negotiate_codec(remote_codecs: Sequence[Sequence[str]]) -> Optional[str]:
+    """Pick our most preferred codec that every receiver advertised, if any."""
+    for name in SUPPORTED_CODECS:
+        if remote_codecs and all(name in codecs for codecs in remote_codecs):
+            return name
+    return None
+
+
+def _checked_codec(meta: dict, max_size: Optional[int]) -> Codec:
+    # The codec for a CODEC_META entry whose declared size is sane
+    codec = CODECS.get(meta.get("name"))
+    if codec is None:
+        raise CodecError(f"Unsupported codec: {meta.get('name')}")
+    size = meta.get("size")
+    if type(size) is not int or size < 0:
+        raise CodecError(f"Invalid uncompressed size: {size!r}")
+    if max_size is not None and size > max_size:
+        raise CodecError(f"Compressed blob expands to {size}B, over the {max_size}B limit")
+    return codec
+
+
+def decompress(blob: Blob, meta: dict, max_size: Optional[int] = None) -> bytes:
+    """Undo compress() given the CODEC_META entry that came with blob. The
+    output is bounded by the declared size, which must be at most max_size."""
+    codec = _checked_codec(meta, max_size)
+    size = meta["size"]
+    data = codec.decompress(blob, size)
+    if len(data) != size:
+        raise CodecError(f"{meta['name']} blob expanded to {len(data)}B, expected {size}B")
+    return data
+
+
+class DecompressingStream:
+    """Wraps a BlobStream of compressed chunks so handlers iterate plain data.
+    Iterating raises CodecError if the data does not expand to exactly the
+    declared size."""
+
+    def __init__(self, stream, meta: dict, max_size: Optional[int] = None):
+        codec = _checked_codec(meta, max_size)
+        self._stream = stream
+        self._codec = codec
+        self.size = meta["size"]
+        self.stream_id = stream.stream_id
+
+    def __iter__(self):
+        decompressor = self._codec.decompressor(self.size)
+        total = 0
+        for chunk in self._stream:
+            data = decompressor.decompress(chunk)
+            if data:
+                total += len(data)
+                yield data
+        if total != self.size:
+            raise CodecError(f"{self._codec.name} stream expanded to {total}B, expected {self.size}B")
+
+    def read_all(self) -> bytearray:
+        data = bytearray()
+        for chunk in self:
+            data += chunk
+        return data
+
+
+class _KeyStats:
+    __slots__ = ("ratio", "gain", "skipped")
+
+    def __init__(self):
+        self.ratio = 0.0      # EWMA of compressed/original size
+        self.gain = 0.0       # EWMA of wire seconds saved minus CPU seconds spent
+        self.skipped = 0
+
+
+class AdaptiveCompressor:
+    """Decides per message key whether compressing its blobs pays off.
+
+    Every key starts out compressed. Each compression updates moving
+    averages of the size ratio and of the net time saved, assuming the link
+    moves `bandwidth` bytes per second. A key whose blobs stop shrinking
+    below max_ratio, or take longer to compress than they save on the wire,
+    is sent raw; every PROBE_INTERVAL-th message is compressed anyway to
+    notice when its content changes.
+    """
+
+    def __init__(self, threshold: int, max_ratio: float = DEFAULT_MAX_RATIO, bandwidth: float = DEFAULT_BANDWIDTH):
+        self.threshold = threshold
+        self.max_ratio = max_ratio
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._stats: Dict[str, _KeyStats] = {}
+
+    def _worth_it(self, key: str) -> bool:
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None or (stats.ratio <= self.max_ratio and stats.gain >= 0):
+                return True
+            stats.skipped += 1
+            if stats.skipped >= PROBE_INTERVAL:
+                stats.skipped = 0
+                return True
+            return False
+
+    def _record(self, key: str, size: int, compressed: int, seconds: float):
+        ratio = compressed / size
+        gain = (size - compressed) / self.bandwidth - seconds
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _KeyStats()
+                stats.ratio, stats.gain = ratio, gain
+            else:
+                stats.ratio += _EWMA_ALPHA * (ratio - stats.ratio)
+                stats.gain += _EWMA_ALPHA * (gain - stats.gain)
+
+    def compress(self, key: str, blob: Blob, codec: str):
+        """Return (blob, meta): blob compressed with codec and its CODEC_META
+        entry, or blob unchanged and None when compressing is not worthwhile."""
+        size = blob_nbytes(blob)
+        if size < self.threshold or not self._worth_it(key):
+            return blob, None
+        started = time.perf_counter()
+        data = CODECS[codec].compress(blob)
+        self._record(key, size, len(data), time.perf_counter() - started)
+        if len(data) > size * self.max_ratio:
+            return blob, None
+        return data, {"name": codec, "size": size}
@@ -0,0 +1,153 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError
+from typing import Dict, List, Optional, Tuple
+
+from message import Message
+
+
+class RemoteError(RuntimeError):
+    """The peer answered a request with an error reply."""
+
+
+class _Pending:
+    __slots__ = ("future", "peer_id", "deadline", "sent")
+
+    def __init__(self, future: Future, peer_id: Optional[str], deadline: Optional[float], sent: float):
+        self.future = future
+        self.peer_id = peer_id
+        self.deadline = deadline
+        self.sent = sent
+
+
+class PendingRequests:
+    """Correlation table mapping req_id → Future for outstanding requests.
+
+    Timeouts live in a single min-heap served by one timer thread, so the
+    cost per request is O(log n) regardless of how many are in flight.
+    Entries for requests that complete early are dropped lazily when they
+    reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: Dict[str, _Pending] = {}
+        self._per_peer: Dict[str, int] = {}
+        self._deadlines: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def outstanding(self, peer_id: str) -> int:
+        return self._per_peer.get(peer_id, 0)
+
+    def add(self, req_id: str, future: Future, timeout: Optional[float], peer_id: Optional[str] = None):
+        now = time.monotonic()
+        deadline = now + timeout if timeout is not None else None
+        with self._cond:
+            self._pending[req_id] = _Pending(future, peer_id, deadline, now)
+            if peer_id is not None:
+                self._per_peer[peer_id] = self._per_peer.get(peer_id, 0) + 1
+            if deadline is not None:
+                wake = not self._deadlines or deadline < self._deadlines[0][0]
+                heapq.heappush(self._deadlines, (deadline, next(self._seq), req_id))
+                self._compact()
+                if self._thread is None:
+                    self._running = True
+                    self._thread = threading.Thread(target=self._expiry_loop, daemon=True)
+                    self._thread.start()
+                elif wake:
+                    self._cond.notify()
+        # A caller cancelling its future frees the slot immediately
+        future.add_done_callback(lambda f: f.cancelled() and self._pop(req_id))
+
+    def _pop(self, req_id: str, peer_id: Optional[str] = None) -> Optional[_Pending]:
+        # With peer_id, only pops a request sent to that peer (or to nobody in particular)
+        with self._cond:
+            entry = self._pending.get(req_id)
+            if entry is None or (peer_id is not None and entry.peer_id not in (None, peer_id)):
+                return None
+            del self._pending[req_id]
+            if entry.peer_id is not None:
+                remaining = self._per_peer.get(entry.peer_id, 1) - 1
+                if remaining:
+                    self._per_peer[entry.peer_id] = remaining
+                else:
+                    self._per_peer.pop(entry.peer_id, None)
+            return entry
+
+    def _compact(self):
+        # Early completions leave stale heap entries; rebuild before they dominate
+        if len(self._deadlines) > 2 * len(self._pending) + 1024:
+            self._deadlines = [d for d in self._deadlines if d[2] in self._pending]
+            heapq.heapify(self._deadlines)
+
+    @staticmethod
+    def _settle(future: Future, result=None, exc: Optional[BaseException] = None):
+        try:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass  # Cancelled by the caller in the meantime
+
+    def resolve(self, req_id: str, reply: Message, peer_id: Optional[str] = None) -> Optional[float]:
+        """Complete the request answered by reply; returns its round-trip time in
+        seconds. With peer_id, the reply is ignored (None is returned) unless
+        the request went to that peer, so no other peer can answer it."""
+        entry = self._pop(req_id, peer_id)
+        if entry is None:
+            return None
+        rtt = time.monotonic() - entry.sent
+        error = reply.json_data.get("error")
+        if error is not None:
+            self._settle(entry.future, exc=RemoteError(error))
+        else:
+            self._settle(entry.future, reply)
+        return rtt
+
+    def fail(self, req_id: str, exc: BaseException):
+        entry = self._pop(req_id)
+        if entry is not None:
+            self._settle(entry.future, exc=exc)
+
+    def fail_peer(self, peer_id: str, exc: BaseException):
+        with self._cond:
+            req_ids = [req_id for req_id, entry in self._pending.items() if entry.peer_id == peer_id]
+        for req_id in req_ids:
+            self.fail(req_id, exc)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            req_ids = list(self._pending)
+            self._cond.notify()
+        for req_id in req_ids:
+            self.fail(req_id, RuntimeError("MessageComs stopped"))
+        if self._thread is not None:
+            self._thread.join()
+
+    def _expiry_loop(self):
+        while True:
+            expired = []
+            with self._cond:
+                while self._running:
+                    now = time.monotonic()
+                    while self._deadlines and self._deadlines[0][0] <= now:
+                        _, _, req_id = heapq.heappop(self._deadlines)
+                        if req_id in self._pending:
+                            expired.append(req_id)
+                    if expired:
+                        break
+                    timeout = self._deadlines[0][0] - now if self._deadlines else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+            for req_id in expired:
+                self.fail(req_id, TimeoutError(f"No reply to request {req_id}"))
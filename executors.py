@@ -0,0 +1,187 @@
+import os
+import pickle
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, List, Optional
+
+from buffers import blob_nbytes
+from message import Message
+
+EXECUTORS = {"thread", "process"}
+SHM_MIN_BLOB = 64 * 1024   # Smaller blobs are cheaper to pickle than to map
+
+
+def check_picklable(handler: Callable):
+    try:
+        pickle.dumps(handler)
+    except Exception as e:
+        raise ValueError(f"Process handlers must be picklable module-level functions: {e}") from None
+
+
+# True in a pool process that started without the node's resource tracker
+_own_tracker = False
+
+
+def _init_child():
+    # A pool process started while the node's resource tracker runs shares
+    # it, and re-registering a segment there is harmless. Otherwise attaching
+    # starts a tracker of its own, which would unlink the node's segments
+    # when the pool process exits.
+    global _own_tracker
+    _own_tracker = resource_tracker._resource_tracker._fd is None
+
+
+def _run_in_child(handler: Callable, msg: Message, sender: str, shm_name: Optional[str], size: int):
+    """Entry point in the pool process: map the blob and call the handler."""
+    if shm_name is None:
+        return handler(msg, sender)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    if _own_tracker:
+        # The node owns the segment, as in shm.SharedBlobImporter.attach
+        resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        blob = shm.buf[:size]
+        try:
+            return handler(msg.replace(binary_blob=blob), sender)
+        finally:
+            blob.release()
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            pass  # Handler kept a view of the blob; the mapping goes away with the process
+
+
+def _respond(msg: Message, future: Future):
+    try:
+        result = future.result()
+        if result is not None:
+            msg.respond(result)
+    except Exception as e:
+        msg.fail(e)
+
+
+class ProcessHandlerPool:
+    """Runs CPU-bound handlers in a ProcessPoolExecutor, outside the GIL of the node.
+
+    Messages are sent to the pool without their MessageComs reference.
+    Blobs of SHM_MIN_BLOB bytes or more are copied once into a
+    multiprocessing.shared_memory segment which the child maps instead of
+    unpickling. The handler's return value comes back through
+    Message.respond as with thread handlers. At most max_in_flight calls are
+    outstanding; beyond that submit() blocks the calling thread, so an event
+    loop must call it from an executor.
+    """
+
+    def __init__(self, processes: Optional[int] = None, max_in_flight: Optional[int] = None):
+        self.processes = processes or os.cpu_count() or 1
+        self._slots = threading.BoundedSemaphore(max_in_flight or 2 * self.processes)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # Started first so pool processes share it; see _init_child
+                resource_tracker.ensure_running()
+                self._pool = ProcessPoolExecutor(max_workers=self.processes, initializer=_init_child)
+            return self._pool
+
+    def submit(self, handler: Callable, msg: Message, sender: str,
+               call_soon: Optional[Callable[..., object]] = None) -> Future:
+        """Run handler(msg, sender) in the pool and respond with its result.
+
+        The reply is sent from the pool's result thread, or through
+        call_soon(fn, *args) if given (e.g. an event loop's
+        call_soon_threadsafe), for a node that must only send from its own
+        thread."""
+        shm = None
+        size = 0
+        portable = msg.replace(coms=None, stream=None)
+        if msg.binary_blob is not None:
+            size = blob_nbytes(msg.binary_blob)
+            if size >= SHM_MIN_BLOB:
+                shm = shared_memory.SharedMemory(create=True, size=size)
+                shm.buf[:size] = memoryview(msg.binary_blob).cast("B")
+                portable = portable.replace(binary_blob=None)
+            else:
+                portable = portable.replace(binary_blob=bytes(msg.binary_blob))
+
+        self._slots.acquire()
+        try:
+            future = self._executor().submit(_run_in_child, handler, portable, sender,
+                                             shm.name if shm else None, size)
+        except Exception:
+            self._slots.release()
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            raise
+
+        def finished(f: Future):
+            self._slots.release()
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            if f.cancelled():
+                return
+            if call_soon is not None:
+                call_soon(_respond, msg, f)
+            else:
+                _respond(msg, f)
+
+        future.add_done_callback(finished)
+        return future
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+class SharedWorkerPool:
+    """Worker threads shared by every MessageComs in a process that is given one.
+
+    Nodes still queue messages in their own lanes, so overload policies,
+    lane weights and metrics stay per node; each queued message posts its
+    node here once, and a pool thread takes that node's next message. The
+    thread count stays fixed however many nodes the process hosts.
+    """
+
+    def __init__(self, threads: int = 4):
+        self.threads = threads
+        self._ready: queue.SimpleQueue = queue.SimpleQueue()
+        self._workers: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the threads; later calls (one per node) do nothing."""
+        with self._lock:
+            if self._workers:
+                return
+            self._workers = [threading.Thread(target=self._work_loop, daemon=True) for _ in range(self.threads)]
+            for thread in self._workers:
+                thread.start()
+
+    def notify(self, coms, count: int = 1):
+        """coms has count more messages queued."""
+        for _ in range(count):
+            self._ready.put(coms)
+
+    def stop(self):
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._ready.put(None)
+        for thread in workers:
+            thread.join()
+
+    def _work_loop(self):
+        while True:
+            coms = self._ready.get()
+            if coms is None:
+                return
+            coms._work_next()
@@ -0,0 +1,211 @@
+import collections
+import queue
+import threading
+from typing import Callable, Dict, Optional
+
+from buffers import blob_nbytes
+import registry
+import streaming
+
+# Lanes in priority order, highest first, with their default dequeue weights
+DEFAULT_LANES = {"control": 8, "reply": 4, "default": 2, "bulk": 1}
+BULK_THRESHOLD = 1024 * 1024     # Messages carrying at least this much blob go to "bulk"
+CONTROL_KEYS = {
+    registry.KEYS_FULL_KEY, registry.KEYS_DELTA_KEY, registry.KEYS_FETCH_KEY,
+    streaming.STREAM_CHUNK_KEY, streaming.STREAM_CREDIT_KEY,
+}
+
+OVERLOAD_POLICIES = {"block", "drop_oldest", "drop_newest", "shed"}
+
+
+def default_lane(msg) -> str:
+    """Classify a received message into one of DEFAULT_LANES. Size comes
+    first, so a big blob never rides the control lane whatever its key."""
+    if msg.stream is not None or (msg.binary_blob is not None and blob_nbytes(msg.binary_blob) >= BULK_THRESHOLD):
+        return "bulk"
+    if msg.is_reply:
+        return "reply"
+    if msg.key in CONTROL_KEYS:
+        return "control"
+    return "default"
+
+
+class LaneQueue:
+    """Receive queue with per-priority lanes and weighted fair dequeuing.
+
+    Drop-in for the queue.Queue of (msg, peer_id) items MessageComs used:
+    put()/put_nowait() classify each item into a lane and get() picks lanes
+    by smooth weighted round robin, so with the default weights control
+    traffic is served 8x as often as bulk traffic when both are backlogged,
+    and no lane starves.
+
+    When an item's lane is full the overload policy decides:
+      block        wait for space (back-pressures the receive thread) until
+                   the queue is closed
+      drop_oldest  evict the oldest item in that lane
+      drop_newest  discard the incoming item
+      shed         evict the oldest item of the lowest-priority non-empty lane
+                   below the incoming one; discard the incoming item if none.
+                   With shed_key, only items whose key it accepts are evicted,
+                   searching up to and including the incoming item's lane
+    Every outcome is counted per lane; see stats().
+    """
+
+    def __init__(self, maxsize: int = 1000, lanes: Optional[Dict[str, int]] = None,
+                 policy: str = "drop_newest", classify: Callable = default_lane,
+                 on_drop: Optional[Callable] = None, shed_key: Optional[Callable[[str], bool]] = None):
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Invalid overload policy: {policy}. Must be one of {OVERLOAD_POLICIES}")
+        self.maxsize = maxsize
+        self.weights = dict(lanes or DEFAULT_LANES)
+        self.policy = policy
+        self.classify = classify
+        self.on_drop = on_drop          # Called with each item dropped or shed, with the lock held
+        self.shed_key = shed_key
+        self._order = list(self.weights)        # Priority order, highest first
+        self._lanes = {name: collections.deque() for name in self._order}
+        self._current = {name: 0 for name in self._order}
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._counters = {
+            name: {"enqueued": 0, "dequeued": 0, "dropped_oldest": 0, "dropped_newest": 0, "shed": 0, "blocked": 0}
+            for name in self._order
+        }
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def close(self):
+        """Wake every put() blocked on a full lane; from now on those fail at once."""
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+
+    def _lane_of(self, item) -> str:
+        lane = self.classify(item[0])
+        return lane if lane in self._lanes else self._order[-1]
+
+    def put_nowait(self, item) -> bool:
+        return self.put(item)
+
+    def put(self, item, timeout: Optional[float] = None) -> bool:
+        """Enqueue item; returns False if it was dropped by the overload policy."""
+        lane = self._lane_of(item)
+        with self._lock:
+            if not self._make_room(lane, timeout):
+                self._dropped(item)
+                return False
+            self._lanes[lane].append(item)
+            self._size += 1
+            self._counters[lane]["enqueued"] += 1
+            self._not_empty.notify()
+            return True
+
+    def put_many(self, items) -> int:
+        """Enqueue several items under one lock acquisition; returns how many were kept."""
+        lanes = [self._lane_of(item) for item in items]
+        kept = 0
+        with self._lock:
+            for lane, item in zip(lanes, items):
+                if not self._make_room(lane, None):
+                    self._dropped(item)
+                    continue
+                self._lanes[lane].append(item)
+                self._size += 1
+                self._counters[lane]["enqueued"] += 1
+                kept += 1
+            if kept:
+                self._not_empty.notify(kept)
+        return kept
+
+    def _make_room(self, lane: str, timeout: Optional[float]) -> bool:
+        # Called with the lock held
+        queue_ = self._lanes[lane]
+        if len(queue_) < self.maxsize:
+            return True
+
+        counters = self._counters[lane]
+        if self.policy == "block":
+            counters["blocked"] += 1
+            self._not_full.wait_for(lambda: self._closed or len(queue_) < self.maxsize, timeout)
+            return len(queue_) < self.maxsize
+        if self.policy == "drop_oldest":
+            self._dropped(queue_.popleft())
+            self._size -= 1
+            counters["dropped_oldest"] += 1
+            return True
+        if self.policy == "shed":
+            if self.shed_key is None:
+                victims = self._order[self._order.index(lane) + 1:]
+            else:
+                victims = self._order[self._order.index(lane):]
+            for victim in reversed(victims):
+                index = self._sheddable(self._lanes[victim])
+                if index is not None:
+                    self._dropped(self._lanes[victim][index])
+                    del self._lanes[victim][index]
+                    self._size -= 1
+                    self._counters[victim]["shed"] += 1
+                    # Unless the victim was in its own lane, the incoming lane goes over by one
+                    return True
+        counters["dropped_newest"] += 1
+        return False
+
+    def _sheddable(self, lane: collections.deque) -> Optional[int]:
+        # Index of the oldest item in lane the shed policy may evict
+        if self.shed_key is None:
+            return 0 if lane else None
+        for index, item in enumerate(lane):
+            if self.shed_key(item[0].key):
+                return index
+        return None
+
+    def _dropped(self, item):
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None):
+        with self._lock:
+            if not self._size:
+                if not block:
+                    raise queue.Empty
+                if not self._not_empty.wait_for(lambda: self._size, timeout):
+                    raise queue.Empty
+            lane = self._pick()
+            item = self._lanes[lane].popleft()
+            self._size -= 1
+            self._counters[lane]["dequeued"] += 1
+            if self.policy == "block":
+                self._not_full.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def _pick(self) -> str:
+        # Smooth weighted round robin over the non-empty lanes
+        total = 0
+        best = None
+        for name in self._order:
+            if not self._lanes[name]:
+                continue
+            weight = self.weights[name]
+            self._current[name] += weight
+            total += weight
+            if best is None or self._current[name] > self._current[best]:
+                best = name
+        self._current[best] -= total
+        return best
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {
+                name: {**counters, "depth": len(self._lanes[name])}
+                for name, counters in self._counters.items()
+            }
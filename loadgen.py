@@ -0,0 +1,267 @@
+import bisect
+import json
+import math
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from message_coms import MessageComs
+from metrics import Histogram
+
+# Open-loop load generation
+#
+# Requests go out at intended times drawn from the schedule, whether or not
+# earlier ones have been answered. Latency is measured from the intended
+# time, not from when the request actually left, so a stall in the sender
+# (a blocked send, a GC pause, a busy core) counts against the requests it
+# delayed instead of vanishing from the numbers: the coordinated-omission
+# correction. Service time (from the actual send) and send lag are kept
+# alongside, so the two can be told apart.
+#
+# Spec strings, as on the PeerNode command line:
+#   schedule  "DURATION:RATE" or "DURATION:START-END" stages, comma
+#             separated: "10:100,60:100-2000,30:2000" (seconds, requests/s)
+#   sizes     "4K", "uniform:1K-64K" or weighted "0=90,1M=9,10M=1"
+#   keys      weighted "perf.echo=9,camera.expose=1"
+ARRIVALS = {"poisson", "constant"}
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+@dataclass(frozen=True)
+class Stage:
+    duration: float
+    start_rate: float
+    end_rate: float
+
+    @property
+    def requests(self) -> float:
+        """Expected number of requests in the stage."""
+        return (self.start_rate + self.end_rate) / 2 * self.duration
+
+    def time_at(self, n: float) -> float:
+        """Seconds into the stage by which n requests are due, with the rate ramping
+        linearly: inverts n = start_rate * t + slope * t**2 / 2."""
+        half_slope = (self.end_rate - self.start_rate) / self.duration / 2
+        if not half_slope:
+            return n / self.start_rate
+        return (math.sqrt(max(self.start_rate ** 2 + 4 * half_slope * n, 0.0)) - self.start_rate) / (2 * half_slope)
+
+
+def parse_schedule(spec: str) -> List[Stage]:
+    stages = []
+    for part in spec.split(","):
+        try:
+            duration, rates = part.split(":")
+            start, _, end = rates.partition("-")
+            stages.append(Stage(float(duration), float(start), float(end or start)))
+        except ValueError:
+            raise ValueError(f"Invalid schedule stage: {part!r}. Expected DURATION:RATE or DURATION:START-END")
+    if any(stage.duration <= 0 or stage.start_rate < 0 or stage.end_rate < 0 for stage in stages):
+        raise ValueError(f"Invalid schedule: {spec!r}. Durations must be positive and rates non-negative")
+    return stages
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def parse_weights(spec: str, convert: Callable[[str], object] = str) -> List[Tuple[object, float]]:
+    """Parse "a=3,b=1" into [(a, 3.0), (b, 1.0)]; a bare "a" has weight 1."""
+    weights = []
+    for part in spec.split(","):
+        value, _, weight = part.partition("=")
+        weights.append((convert(value.strip()), float(weight or 1)))
+    if not weights or any(weight < 0 for _, weight in weights) or not sum(w for _, w in weights):
+        raise ValueError(f"Invalid weights: {spec!r}")
+    return weights
+
+
+class WeightedChoice:
+    def __init__(self, weights: Sequence[Tuple[object, float]]):
+        self.values = [value for value, _ in weights]
+        self._cumulative = []
+        total = 0.0
+        for _, weight in weights:
+            total += weight
+            self._cumulative.append(total)
+
+    def __call__(self, rng: random.Random):
+        return self.values[bisect.bisect_right(self._cumulative, rng.random() * self._cumulative[-1])]
+
+
+class SizeDistribution:
+    """Payload sizes in bytes, drawn from a spec string (see above)."""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        if spec.startswith("uniform:"):
+            low, high = spec[len("uniform:"):].split("-")
+            self._low, self._high = parse_size(low), parse_size(high)
+            if self._low > self._high:
+                raise ValueError(f"Invalid size range: {spec!r}")
+            self._choice = None
+            self.max = self._high
+        else:
+            self._choice = WeightedChoice(parse_weights(spec, parse_size))
+            self.max = max(self._choice.values)
+
+    def __call__(self, rng: random.Random) -> int:
+        if self._choice is not None:
+            return self._choice(rng)
+        return rng.randint(self._low, self._high)
+
+
+class _StageStats:
+    def __init__(self, stage: Stage):
+        self.stage = stage
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.unroutable = 0
+        self.latency = Histogram()      # From the intended send time
+        self.service = Histogram()      # From the actual send time
+        self.send_lag = Histogram()     # Actual minus intended send time
+
+    def summary(self) -> dict:
+        stage = self.stage
+        return {
+            "duration": stage.duration,
+            "start_rate": stage.start_rate,
+            "end_rate": stage.end_rate,
+            "target_rate": (stage.start_rate + stage.end_rate) / 2,
+            "sent": self.sent,
+            "completed": self.completed,
+            "errors": self.errors,
+            "unroutable": self.unroutable,
+            "throughput": self.completed / stage.duration,
+            "latency": self.latency.summary(1e-9),
+            "service": self.service.summary(1e-9),
+            "send_lag": self.send_lag.summary(1e-9),
+        }
+
+
+class LoadGenerator:
+    """Sends requests through coms at the rates of a schedule, open loop.
+
+    Each request goes to a peer that handles its key, chosen by
+    pick_provider(). run() blocks until the schedule is done and every
+    request has been answered or timed out, and returns per-stage results.
+    """
+
+    def __init__(self, coms: MessageComs, schedule: Sequence[Stage], arrivals: str = "poisson",
+                 sizes: str = "0", keys: str = "perf.echo", timeout: float = 30.0,
+                 seed: Optional[int] = None):
+        if arrivals not in ARRIVALS:
+            raise ValueError(f"Invalid arrivals: {arrivals}. Must be one of {ARRIVALS}")
+        self.coms = coms
+        self.schedule = list(schedule)
+        self.arrivals = arrivals
+        self.sizes = SizeDistribution(sizes)
+        self.key_weights = parse_weights(keys)
+        self.keys = WeightedChoice(self.key_weights)
+        self.timeout = timeout
+        self._rng = random.Random(seed)
+        # Payloads are slices of one random buffer at random offsets, so they don't
+        # repeat (and get sent by hash) and no bytes are generated while sending
+        self._payload = memoryview(os.urandom(2 * self.sizes.max)) if self.sizes.max else None
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._idle = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self.stats = [_StageStats(stage) for stage in self.schedule]
+
+    def intended_times(self) -> Iterator[Tuple[int, float]]:
+        """Yield (stage index, offset in seconds from the start) of every request, in order."""
+        start = 0.0
+        for index, stage in enumerate(self.schedule):
+            # Arrivals are spaced evenly (or exponentially, for Poisson) in expected
+            # request count, then mapped to time, which follows ramps exactly
+            n = 0.0
+            while True:
+                n += self._rng.expovariate(1.0) if self.arrivals == "poisson" else 1.0
+                if n >= stage.requests:
+                    break
+                yield index, start + stage.time_at(n)
+            start += stage.duration
+
+    def run(self) -> dict:
+        started = time.perf_counter_ns()
+        for index, offset in self.intended_times():
+            if self._stop.is_set():
+                break
+            intended = started + int(offset * 1e9)
+            delay = (intended - time.perf_counter_ns()) / 1e9
+            if delay > 0:
+                # Running late never waits: catching up is what an open-loop client does
+                if self._stop.wait(delay):
+                    break
+            self._send(index, intended)
+        with self._idle:
+            self._idle.wait_for(lambda: not self._outstanding, timeout=self.timeout + 1)
+        return self.results()
+
+    def stop(self):
+        self._stop.set()
+
+    def _send(self, index: int, intended: int):
+        stats = self.stats[index]
+        key = self.keys(self._rng)
+        peer = self.coms.pick_provider(key)
+        if peer is None:
+            with self._lock:
+                stats.unroutable += 1
+            return
+        size = self.sizes(self._rng)
+        blob = None
+        if size:
+            offset = self._rng.randrange(len(self._payload) - size + 1)
+            blob = self._payload[offset:offset + size]
+        with self._lock:
+            self._outstanding += 1
+        sent = time.perf_counter_ns()
+        try:
+            future = self.coms.request(key, {}, peer, timeout=self.timeout, blob=blob)
+        except Exception:
+            # Never sent (e.g. the peer left or the transport failed): an error, not outstanding
+            with self._lock:
+                stats.errors += 1
+                self._outstanding -= 1
+                if not self._outstanding:
+                    self._idle.notify_all()
+            return
+        with self._lock:
+            stats.sent += 1
+            stats.send_lag.record(sent - intended)
+        future.add_done_callback(lambda f: self._done(f, stats, intended, sent))
+
+    def _done(self, future, stats: _StageStats, intended: int, sent: int):
+        now = time.perf_counter_ns()
+        with self._lock:
+            if future.exception() is None:
+                stats.completed += 1
+                stats.latency.record(now - intended)
+                stats.service.record(now - sent)
+            else:
+                stats.errors += 1
+            self._outstanding -= 1
+            if not self._outstanding:
+                self._idle.notify_all()
+
+    def results(self) -> dict:
+        with self._lock:
+            return {
+                "arrivals": self.arrivals,
+                "sizes": self.sizes.spec,
+                "keys": [list(weight) for weight in self.key_weights],
+                "stages": [stats.summary() for stats in self.stats],
+            }
+
+    def write_results(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.results(), f, indent=1)
@@ -1,23 +1,106 @@
-from dataclasses import dataclass, field, asdict
 from typing import Optional
 from datetime import datetime
 import uuid
 import json
 
+from buffers import Blob, check_blob
+
 # Only transport modes Zyre supports for sending
 VALID_TYPES = {"whisper", "shout"}
 
-@dataclass(frozen=True)
+# Messages are immutable and slotted, so a received message costs one small
+# object. A decoder can hand over the raw JSON payload instead of json_data:
+# it is parsed on first access, so messages that are routed, shed or
+# answered from the envelope alone (key, msg_type, req_id) never pay for it.
+_FIELDS = ("coms", "sender_id", "msg_type", "req_id", "key", "json_data", "binary_blob", "destination",
+           "received_by", "stream", "trace")
+
+
 class Message:
+    __slots__ = ("coms", "sender_id", "msg_type", "req_id", "key", "_json_data", "_payload", "binary_blob",
+                 "destination", "received_by", "stream", "trace")
+
     coms: "MessageComs"                     # Communication context (e.g. Zyre wrapper)
     sender_id: str                          # UUID or logical name of sender
     msg_type: str                           # "whisper" or "shout"
     req_id: str                             # Correlation ID
     key: str                                # Logical routing key (e.g. "camera.expose")
-    json_data: dict                         # Main payload (structured data)
-    binary_blob: Optional[bytes] = None     # Optional binary payload
-    destination: Optional[bytes] = None     # WHISPER target (peer UUID)
-    received_by: Optional[bytes] = None     # Populated by receiving peer if needed
+    binary_blob: Optional[Blob]             # Optional binary payload (any contiguous buffer)
+    destination: Optional[bytes]            # WHISPER target (peer UUID)
+    received_by: Optional[bytes]            # Populated by receiving peer if needed
+    stream: Optional["BlobStream"]          # Chunk iterator for streaming handlers
+    trace: Optional[str]                    # Trace id if this message is sampled for tracing
+
+    def __init__(self, coms: "MessageComs", sender_id: str, msg_type: str, req_id: str, key: str,
+                 json_data: Optional[dict] = None, binary_blob: Optional[Blob] = None,
+                 destination: Optional[bytes] = None, received_by: Optional[bytes] = None,
+                 stream: Optional["BlobStream"] = None, trace: Optional[str] = None,
+                 payload: Optional[bytes] = None):
+        """json_data is the main payload (structured data); pass payload, its
+        undecoded JSON, instead to have it parsed on first access."""
+        set_ = object.__setattr__
+        set_(self, "coms", coms)
+        set_(self, "sender_id", sender_id)
+        set_(self, "msg_type", msg_type)
+        set_(self, "req_id", req_id)
+        set_(self, "key", key)
+        set_(self, "_json_data", json_data if json_data is not None or payload else {})
+        set_(self, "_payload", payload if json_data is None else None)
+        set_(self, "binary_blob", binary_blob)
+        set_(self, "destination", destination)
+        set_(self, "received_by", received_by)
+        set_(self, "stream", stream)
+        set_(self, "trace", trace)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Message is immutable; use replace() to change {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"Message is immutable; use replace() to change {name}")
+
+    @property
+    def json_data(self) -> dict:
+        data = self._json_data
+        if data is None:
+            payload = self._payload
+            if payload is None:
+                # Another thread decoded it after we looked; it sets _json_data before clearing _payload
+                return self._json_data
+            # Two threads may both decode the payload; either result will do
+            data = json.loads(payload)
+            object.__setattr__(self, "_json_data", data)
+            object.__setattr__(self, "_payload", None)
+        return data
+
+    def has_meta(self, name: str) -> bool:
+        """Whether json_data has key name, without decoding a payload that can't contain it."""
+        payload = self._payload
+        if payload is not None and ('"' + name + '"').encode() not in payload:
+            return False
+        return name in self.json_data
+
+    def replace(self, **changes) -> "Message":
+        """Copy with the given fields changed; an undecoded payload stays undecoded."""
+        fields = {name: getattr(self, name) for name in _FIELDS if name != "json_data"}
+        if "json_data" not in changes:
+            payload = self._payload
+            if payload is not None and self._json_data is None:
+                fields["payload"] = payload
+            else:
+                fields["json_data"] = self.json_data
+        fields.update(changes)
+        return Message(**fields)
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def __repr__(self) -> str:
+        return (f"Message(sender_id={self.sender_id!r}, msg_type={self.msg_type!r}, req_id={self.req_id!r}, "
+                f"key={self.key!r}, has_blob={self.binary_blob is not None})")
 
     def to_json(self) -> str:
         """Serialize to JSON string (excluding binary)."""
@@ -67,10 +150,10 @@ class Message:
         reply = MessageBuilder(self.coms) \
             .with_type("whisper") \
             .with_sender_id(self.coms.uuid) \
-            .with_req_id(str(uuid.uuid4())) \
             .with_key(self.key + ".reply") \
             .with_destination(self.sender_id.encode()) \
             .with_json_data({"reply_to": self.req_id, **data}) \
+            .with_trace(self.trace) \
             .build()
         self.coms.send(reply)
 
@@ -82,12 +165,13 @@ class MessageBuilder:
         self._coms = coms
         self._sender_id = coms.uuid
         self._msg_type = None
-        self._req_id = str(uuid.uuid4())
+        self._req_id = None     # Allocated in build() unless given
         self._key = None
         self._json_data = {}
         self._binary_blob = None
         self._destination = None
         self._received_by = None
+        self._trace = None
 
     def with_type(self, msg_type: str):
         if msg_type not in VALID_TYPES:
@@ -100,7 +184,7 @@ class MessageBuilder:
         return self
 
     def with_req_id(self, req_id: Optional[str] = None):
-        self._req_id = req_id or str(uuid.uuid4())
+        self._req_id = req_id
         return self
 
     def with_key(self, key: str):
@@ -111,8 +195,14 @@ class MessageBuilder:
         self._json_data = data
         return self
 
-    def with_binary_blob(self, blob: Optional[bytes]):
-        self._binary_blob = blob
+    def with_binary_blob(self, blob: Optional[Blob]):
+        """Attach a blob. Any buffer-protocol object is sent without a Python-side copy,
+        so it must stay unchanged until the message has left the node, which can be
+        well after send() returns: a batched message goes out when its batch is
+        flushed, a streamed one once its OutgoingStream completes, and a large
+        frame lent to CZMQ when CZMQ releases it. Pass bytes(blob) to reuse the
+        buffer straight away."""
+        self._binary_blob = check_blob(blob) if blob is not None else None
         return self
 
     def with_destination(self, destination: bytes):
@@ -123,20 +213,32 @@ class MessageBuilder:
         self._received_by = received_by
         return self
 
+    def with_trace(self, trace: Optional[str]):
+        """Continue trace (e.g. the request's, on its reply) instead of sampling afresh."""
+        self._trace = trace
+        return self
+
     def build(self) -> Message:
         if not self._msg_type:
             raise ValueError("msg_type is required")
         if not self._key:
             raise ValueError("key is required")
 
+        req_id = self._req_id
+        if not req_id:
+            # The node's cheap sequential ids; anything else gets a UUID
+            next_req_id = getattr(self._coms, "next_req_id", None)
+            req_id = next_req_id() if next_req_id is not None else str(uuid.uuid4())
+
         return Message(
             coms=self._coms,
             sender_id=self._sender_id,
             msg_type=self._msg_type,
-            req_id=self._req_id,
+            req_id=req_id,
             key=self._key,
             json_data=self._json_data,
             binary_blob=self._binary_blob,
             destination=self._destination,
-            received_by=self._received_by
+            received_by=self._received_by,
+            trace=self._trace
         )
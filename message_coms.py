@@ -1,216 +1,950 @@
-import ctypes
+import itertools
+import random
+import statistics
 import threading
+import time
 import queue
+from concurrent.futures import Future
 from typing import Callable, Dict, Optional
 
-from zyre import Zyre, czmq, ZyreEvent
+from buffers import Blob, blob_nbytes
+from correlation import PendingRequests
+from executors import EXECUTORS, ProcessHandlerPool, SharedWorkerPool, check_picklable
+from lanes import LaneQueue
 from message import Message, VALID_TYPES, MessageBuilder
-from ctypes import c_char_p
-
-# Load CZMQ Library
-libczmq = ctypes.CDLL("libczmq.dylib")
-libczmq.zmsg_new.restype = ctypes.c_void_p
-libczmq.zmsg_addmem.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
-libczmq.zmsg_destroy.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
-
-
-def build_zmsg(payload: bytes, blob: Optional[bytes] = None) -> czmq.zmsg_p:
-    raw_ptr = libczmq.zmsg_new()
-    if not raw_ptr:
-        raise RuntimeError("Failed to create zmsg")
-    libczmq.zmsg_addmem(raw_ptr, ctypes.c_char_p(payload), len(payload))
-    if blob:
-        libczmq.zmsg_addmem(raw_ptr, ctypes.c_char_p(blob), len(blob))
-    return ctypes.cast(raw_ptr, czmq.zmsg_p)
-
-
-def destroy_zmsg(zmsg_ptr: czmq.zmsg_p):
-    ptr = ctypes.cast(zmsg_ptr, ctypes.c_void_p)
-    ptr_p = ctypes.pointer(ptr)
-    libczmq.zmsg_destroy(ptr_p)
+from metrics import DEFAULT_EXPORT_INTERVAL, Metrics, MetricsExporter
+from routing import BALANCE_POLICIES, LATENCY_EWMA_ALPHA, KeyRouter, ProviderIndex, Route
+from transport import Transport
+import batching
+import blobcache
+import compression
+import registry
+import shm
+import streaming
+import tracing
+import wire
+
+# Sent by MessageComs itself; never sampled for tracing
+_UNTRACED_KEYS = {registry.KEYS_FULL_KEY, registry.KEYS_DELTA_KEY, blobcache.BLOB_DATA_KEY}
+
+# The receive loop waits at most POLL_INTERVAL for an event, so stop() is
+# noticed promptly, then drains up to RECV_BATCH events that are already
+# waiting and queues their messages in one put_many().
+POLL_INTERVAL = 0.1     # seconds
+RECV_BATCH = 256
 
 
 class MessageComs:
-    def __init__(self, name: str, group: Optional[str] = None, max_queue: int = 1000, workers: int = 2, verbose: bool = True):
-        self.node = Zyre(name.encode())
-        if verbose:
-            self.node.set_verbose()
-        self.node.start()
-
-        self.uuid = self.node.uuid().decode()
+    def __init__(self, name: str, group: Optional[str] = None, max_queue: int = 1000, workers: int = 2, verbose: bool = True,
+                 transport: Optional[Transport] = None, wire_format: str = wire.FORMAT_BIN1,
+                 stream_threshold: Optional[int] = None, chunk_size: int = streaming.DEFAULT_CHUNK_SIZE,
+                 stream_window: int = streaming.DEFAULT_WINDOW,
+                 max_stream_size: int = streaming.DEFAULT_MAX_STREAM_SIZE,
+                 max_reassembly: int = streaming.DEFAULT_MAX_REASSEMBLY,
+                 stream_shout_rate: float = streaming.DEFAULT_SHOUT_RATE,
+                 batch_size: Optional[int] = None, batch_delay_us: int = batching.DEFAULT_BATCH_DELAY_US,
+                 lanes: Optional[Dict[str, int]] = None, overload_policy: str = "drop_newest",
+                 shed_key: Optional[Callable[[str], bool]] = None,
+                 process_workers: Optional[int] = None, shm_threshold: Optional[int] = None,
+                 shm_ttl: float = shm.DEFAULT_SHM_TTL, compress_threshold: Optional[int] = None,
+                 compress_bandwidth: float = compression.DEFAULT_BANDWIDTH, blob_cache_bytes: Optional[int] = None,
+                 blob_cache_threshold: int = blobcache.DEFAULT_CACHE_THRESHOLD,
+                 blob_fetch_timeout: float = blobcache.BLOB_FETCH_TIMEOUT, metrics_path: Optional[str] = None,
+                 metrics_interval: float = DEFAULT_EXPORT_INTERVAL, metrics: bool = True,
+                 metrics_sample_rate: float = 1.0, trace_sample_rate: Optional[float] = None,
+                 trace_path: Optional[str] = None, trace_max_events: int = tracing.DEFAULT_MAX_EVENTS,
+                 worker_pool: Optional[SharedWorkerPool] = None):
+        if transport is None:
+            # Imported lazily so the loopback backend works without Zyre/CZMQ installed
+            from zyre_transport import ZyreTransport
+            transport = ZyreTransport(name, verbose=verbose)
+        self.transport = transport
+
+        self.uuid = self.transport.uuid
+        # Request ids are a random per-instance prefix and a counter; next() on an
+        # itertools.count is atomic, so senders on any thread can share it
+        self._req_prefix = f"{random.getrandbits(32):08x}"
+        self._req_ids = itertools.count(1)
         self.group = group
         if group:
-            self.node.join(group.encode())
-
-        self.queue = queue.Queue(maxsize=max_queue)
+            # Join before starting so the group is announced along with our ENTER
+            self.transport.join(group)
+        self.transport.start()
+
+        # Traffic, latency and error metrics by key and peer; see stats()
+        # metrics=False skips recording entirely; metrics_sample_rate thins the latency histograms
+        self.metrics = Metrics(enabled=metrics, sample_rate=metrics_sample_rate)
+        self._metrics_exporter: Optional[MetricsExporter] = None
+        if metrics_path:
+            self._metrics_exporter = MetricsExporter(self.metrics, metrics_path, metrics_interval)
+
+        # Sampled per-stage tracing; written to trace_path on stop()
+        self.tracer: Optional[tracing.Tracer] = None
+        self.trace_path = trace_path
+        if trace_sample_rate is not None:
+            self.tracer = tracing.Tracer(name, self.uuid, trace_sample_rate, trace_max_events)
+
+        # Per-priority receive lanes; max_queue bounds each lane
+        self.queue = LaneQueue(maxsize=max_queue, lanes=lanes, policy=overload_policy, on_drop=self._on_drop,
+                               shed_key=shed_key)
+        self.metrics.gauge("queue_depth", self.queue.qsize)
         self.handlers: Dict[str, Callable[[Message], None]] = {}
         self._recv_thread = threading.Thread(target=self._recv_loop, daemon=True)
+        # With a shared pool, its threads serve this node's queue instead of our own
+        self._worker_pool = worker_pool
         self._worker_threads = [
             threading.Thread(target=self._worker_loop, daemon=True)
-            for _ in range(workers)
+            for _ in range(workers if worker_pool is None else 0)
         ]
         self._running = False
         self.handlers = {}
+        self._router = KeyRouter()
         self.responded_to: set[str] = set()
         self._peer_keys = {}  # Maps peer_id → list of keys they support
+        self._providers = ProviderIndex()  # And the reverse, key → peers
+        self._peer_latency: Dict[str, float] = {}  # EWMA of request round-trip seconds
+
+        # Wire format negotiated with each peer through "peer.keys"
+        self.wire_format = wire_format
+        self._local_keys: list[str] = []  # Announced key order; interned key ids index into it
+        self._keys_version = 0            # Bumped whenever _local_keys grows
+        self._keys_lock = threading.Lock()
+        self._keys_sent_to: set = set()   # Peers that have our full list, so need deltas
+        self._peer_key_versions: Dict[str, int] = {}
+        self._peer_wire: Dict[str, str] = {}
+        self._peer_key_ids: Dict[str, Dict[str, int]] = {}
+        self._peer_features: Dict[str, set] = {}
+        self._peer_hosts: Dict[str, str] = {}
+        self._peer_codecs: Dict[str, list] = {}
+
+        # Chunked transfer of large blobs
+        self.stream_threshold = stream_threshold
+        self.stream_window = stream_window
+        self.max_stream_size = max_stream_size
+        self.max_reassembly = max_reassembly      # Total bytes of blobs being reassembled at once
+        self._streams = streaming.StreamSender(self, chunk_size, stream_window, shout_rate=stream_shout_rate)
+        self._streams_in: Dict[tuple, streaming._IncomingStream] = {}
+
+        # Blobs handed to peers on this host through shared memory
+        self.shm_threshold = shm_threshold
+        self._shm_out = shm.SharedBlobExporter(shm_ttl)
+        self._shm_in = shm.SharedBlobImporter()
+
+        # Blob compression with a codec every receiver supports, skipped for keys it doesn't pay off on
+        self._compressor: Optional[compression.AdaptiveCompressor] = None
+        if compress_threshold is not None:
+            self._compressor = compression.AdaptiveCompressor(compress_threshold, bandwidth=compress_bandwidth)
+
+        # Content-addressed blobs: ours, to answer fetches, and theirs, to skip resends
+        self.blob_cache_threshold = blob_cache_threshold
+        self._blobs_out: Optional[blobcache.BlobCache] = None
+        self._blobs_in: Optional[blobcache.BlobCache] = None
+        if blob_cache_bytes:
+            self._blobs_out = blobcache.BlobCache(blob_cache_bytes)
+            self._blobs_in = blobcache.BlobCache(blob_cache_bytes)
+        self.blob_fetch_timeout = blob_fetch_timeout
+        # digest → (peer fetched from, parked (msg, sender) pairs, monotonic deadline)
+        self._blob_waiting: Dict[str, tuple] = {}
+        self._blob_lock = threading.Lock()
+
+        self.features = [streaming.STREAM_FEATURE, batching.BATCH_FEATURE, shm.SHM_FEATURE]
+        if self._blobs_in is not None:
+            self.features.append(blobcache.BLOB_CACHE_FEATURE)
+
+        # Outstanding requests made through request(), keyed by req_id
+        self._pending = PendingRequests()
+        self.metrics.gauge("pending_requests", lambda: len(self._pending))
+
+        # Opt-in coalescing of small messages per destination
+        self._batcher: Optional[batching.SendBatcher] = None
+        if batch_size:
+            self._batcher = batching.SendBatcher(self._send_frames, batch_size, batch_delay_us / 1e6)
+
+        # Pool for handlers registered with executor="process", started on first use
+        self._process_pool = ProcessHandlerPool(process_workers)
+
+    def register_handler(self, key: str, handler: Callable[[Message], None], streaming: bool = False,
+                         executor: str = "thread"):
+        """Register handler for key: an exact key, "prefix.*" or "*".
+
+        Exact keys win over prefixes, longer prefixes over shorter ones, and
+        "*" catches everything else. A streaming handler is dispatched as soon
+        as a chunked blob starts arriving and reads it by iterating msg.stream.
+        With executor="process" the handler runs in a process pool; it must be
+        a picklable module-level function and gets a message without coms.
+        """
+        if executor not in EXECUTORS:
+            raise ValueError(f"Invalid executor: {executor}. Must be one of {EXECUTORS}")
+        if executor == "process":
+            if streaming:
+                raise ValueError("Streaming handlers cannot run in a process pool")
+            check_picklable(handler)
+        self._router.add(Route(key, handler, streaming, executor))
+        with self._keys_lock:
+            added = key not in self.handlers
+            self.handlers[key] = handler
+            if added:
+                self._local_keys.append(key)
+                self._keys_version += 1
+                delta = {
+                    "version": self._keys_version,
+                    "added": [key],
+                    "digest": registry.keys_digest(self._local_keys)
+                }
+            # Checked under the lock, so a peer gets either a list with the key or the delta
+            notify = added and bool(self._keys_sent_to)
+        # Peers that already have our list only need the new key
+        if notify and self.group:
+            self.send(Message(
+                coms=self,
+                sender_id=self.uuid,
+                msg_type="shout",
+                req_id="keys",
+                key=registry.KEYS_DELTA_KEY,
+                json_data=delta
+            ))
+
+    def _peers_support(self, feature: str, peer_id: Optional[str]) -> bool:
+        if peer_id is not None:
+            return feature in self._peer_features.get(peer_id, ())
+        peers = list(self._peer_keys)
+        return bool(peers) and all(feature in self._peer_features.get(p, ()) for p in peers)
+
+    def _same_host(self, peer_id: Optional[str]) -> bool:
+        # True if every receiver of a message to peer_id can map our shared memory
+        peers = [peer_id] if peer_id is not None else list(self._peer_keys)
+        return self._peers_support(shm.SHM_FEATURE, peer_id) and all(
+            self._peer_hosts.get(p) == shm.host_id() for p in peers
+        )
 
-    def register_handler(self, key: str, handler: Callable[[Message], None]):
-        self.handlers[key] = handler
-
-    def send(self, msg: Message):
-        payload = msg.to_json().encode()
-        zmsg_ptr = build_zmsg(payload, msg.binary_blob)
-
+    def _encode(self, msg: Message, peer_id: Optional[str] = None) -> list:
+        # "peer.keys" is the negotiation message itself, so it always goes out as JSON
+        if msg.key == registry.KEYS_FULL_KEY:
+            return wire.encode(msg, wire.FORMAT_JSON)
+        if peer_id is not None:
+            return wire.encode(msg, self._peer_wire.get(peer_id, wire.FORMAT_JSON), self._peer_key_ids.get(peer_id))
+        # A shout must be readable by every peer in the group
+        peers = list(self._peer_keys)
+        if peers and all(self._peer_wire.get(p) == self.wire_format for p in peers):
+            return wire.encode(msg, self.wire_format)
+        return wire.encode(msg, wire.FORMAT_JSON)
+
+    def send(self, msg: Message, stream: Optional[bool] = None) -> Optional[streaming.OutgoingStream]:
+        """Send msg. With blob_cache_bytes set, a blob of at least
+        blob_cache_threshold bytes that every receiver already has is replaced
+        by its hash. Blobs of at least shm_threshold bytes go through shared
+        memory when every receiver is on this host. Otherwise blobs of at least
+        stream_threshold bytes (or any blob, with stream=True) go out in chunks
+        when the receivers support it; the returned OutgoingStream completes
+        once the last chunk is sent. With compress_threshold set, blobs are
+        compressed first when that pays off. With trace_sample_rate set, that
+        fraction of requests is traced at every stage on every peer."""
         if msg.msg_type == "whisper":
             if not msg.destination:
                 raise ValueError("WHISPER requires a destination")
-            peer_id_bytes = msg.destination.encode() if isinstance(msg.destination, str) else msg.destination
-            peer_id = c_char_p(peer_id_bytes)
-            self.node.whisper(peer_id, zmsg_ptr)
-            destroy_zmsg(zmsg_ptr)
+            peer_id = msg.destination.decode() if isinstance(msg.destination, bytes) else msg.destination
 
         elif msg.msg_type == "shout":
-            target_group = self.group
-            if not target_group:
+            if not self.group:
                 raise ValueError("No group specified for SHOUT")
-            self.node.shout(target_group.encode(), zmsg_ptr)
-            destroy_zmsg(zmsg_ptr)
+            peer_id = None
 
         else:
             raise ValueError(f"Unsupported msg_type: {msg.msg_type}")
 
+        if self.tracer is not None and msg.trace is None and msg.is_request and msg.key not in _UNTRACED_KEYS:
+            trace = self.tracer.sample()
+            if trace is not None:
+                msg = msg.replace(trace=trace)
+
+        if (msg.binary_blob is not None and self._blobs_out is not None and msg.key != blobcache.BLOB_DATA_KEY
+                and blob_nbytes(msg.binary_blob) >= self.blob_cache_threshold
+                and self._peers_support(blobcache.BLOB_CACHE_FEATURE, peer_id)):
+            msg = self._reference_blob(msg, peer_id)
+
+        if (msg.binary_blob is not None and self.shm_threshold is not None and stream is not True
+                and blob_nbytes(msg.binary_blob) >= self.shm_threshold and self._same_host(peer_id)):
+            self._send_shared(msg, peer_id)
+            return None
+
+        if msg.binary_blob is not None and self._compressor is not None:
+            msg = self._compress(msg, peer_id)
+
+        if msg.binary_blob is not None and stream is not False:
+            if stream is None:
+                stream = self.stream_threshold is not None and blob_nbytes(msg.binary_blob) >= self.stream_threshold
+            if stream and self._peers_support(streaming.STREAM_FEATURE, peer_id):
+                return self._streams.open(msg, peer_id)
+
+        self._send_now(msg, peer_id)
+        return None
+
+    def next_req_id(self) -> str:
+        """A request id unique to this node, much cheaper to make than a UUID."""
+        return f"{self._req_prefix}-{next(self._req_ids):x}"
+
+    def request(self, key: str, data: dict, destination: str, timeout: Optional[float] = 30.0,
+                blob: Optional[Blob] = None) -> Future:
+        """Whisper a request and return a Future resolved with the reply Message.
+
+        The future fails with RemoteError if the peer replies with an error,
+        with TimeoutError if no reply arrives within timeout seconds, and
+        with RuntimeError if the peer leaves first.
+        """
+        msg = (
+            MessageBuilder(self)
+            .with_type("whisper")
+            .with_key(key)
+            .with_destination(destination)
+            .with_json_data(data)
+            .with_binary_blob(blob)
+            .build()
+        )
+        future = Future()
+        self._pending.add(msg.req_id, future, timeout, destination)
+        try:
+            self.send(msg)
+        except Exception as e:
+            self._pending.fail(msg.req_id, e)
+        return future
+
+    def providers(self, key: str) -> list:
+        """Peers that handle key, by the same precedence as local routing."""
+        return self._providers.providers(key)
+
+    def pick_provider(self, key: str, policy: str = "least_outstanding") -> Optional[str]:
+        """Choose the peer to send a request for key to, or None if nobody handles it.
+
+        "least_outstanding" picks the peer with the fewest unanswered
+        requests from us. "latency" weighs each peer's average round-trip
+        time by one plus its outstanding requests, so the fastest peer gets
+        more of the load without getting all of it. Unmeasured peers count
+        as the median of the measured ones, so a burst spreads over them
+        rather than all landing on one. Ties are broken at random.
+        """
+        if policy not in BALANCE_POLICIES:
+            raise ValueError(f"Invalid policy: {policy}. Must be one of {BALANCE_POLICIES}")
+        providers = self._providers.providers(key)
+        if not providers:
+            return None
+        if policy == "least_outstanding":
+            return min(providers, key=lambda p: (self._outstanding(p), random.random()))
+        measured = [self._peer_latency[p] for p in providers if p in self._peer_latency]
+        unmeasured = statistics.median(measured) if measured else 1.0
+        return min(providers, key=lambda p: (self._peer_latency.get(p, unmeasured) * (1 + self._outstanding(p)),
+                                             random.random()))
+
+    def send_to_key(self, key: str, data: dict, timeout: Optional[float] = 30.0, blob: Optional[Blob] = None,
+                    policy: str = "least_outstanding"):
+        """Send a request to whichever peer provides key, chosen by pick_provider().
+
+        Returns the future from request(). Raises LookupError if no peer
+        handles key.
+        """
+        peer_id = self.pick_provider(key, policy)
+        if peer_id is None:
+            raise LookupError(f"No peer handles key {key}")
+        return self.request(key, data, peer_id, timeout=timeout, blob=blob)
+
+    def _outstanding(self, peer_id: str) -> int:
+        return self._pending.outstanding(peer_id)
+
+    def _observe_rtt(self, peer_id: str, rtt: float):
+        average = self._peer_latency.get(peer_id)
+        self._peer_latency[peer_id] = rtt if average is None else average + LATENCY_EWMA_ALPHA * (rtt - average)
+
+    def _send_now(self, msg: Message, peer_id: Optional[str]):
+        started = time.perf_counter_ns()
+        if msg.trace is None:
+            frames = self._encode(msg, peer_id)
+        else:
+            frames = self._encode(msg.replace(json_data={**msg.json_data, tracing.TRACE_META: msg.trace}),
+                                  peer_id)
+        shard = self.metrics.shard()
+        peer = peer_id or "*"
+        if shard is not None:
+            shard.observe("encode", time.perf_counter_ns() - started, msg.key, peer)
+            shard.transfer("out", msg.key, peer, wire.frames_nbytes(frames))
+        if msg.trace is not None:
+            # Measured up to handing the frames over; batching delay shows up in the receiver's decode start
+            self._span(msg, "send", started, peer, tracing.FLOW_START if msg.is_request else tracing.FLOW_STEP)
+        if (self._batcher is not None and msg.key != registry.KEYS_FULL_KEY
+                and self._peers_support(batching.BATCH_FEATURE, peer_id)):
+            if msg.binary_blob is None or blob_nbytes(msg.binary_blob) <= batching.MAX_BATCHED_SIZE:
+                self._batcher.add(peer_id, frames)
+                return
+            # Too big to batch; send what is queued for this destination first to keep order
+            self._batcher.flush(peer_id)
+        self._send_frames(peer_id, frames)
+
+    def _reference_blob(self, msg: Message, peer_id: Optional[str]) -> Message:
+        digest = blobcache.blob_digest(msg.binary_blob)
+        blob = self._blobs_out.put(digest, msg.binary_blob)
+        receivers = {peer_id} if peer_id is not None else set(self._peer_keys)
+        json_data = {**msg.json_data, blobcache.BLOB_REF: {"hash": digest, "size": len(blob)}}
+        if receivers <= self._blobs_out.holders(digest):
+            return msg.replace(json_data=json_data, binary_blob=None)
+        # First time these receivers see it: send it along so they can cache it
+        self._blobs_out.add_holders(digest, receivers)
+        return msg.replace(json_data=json_data, binary_blob=blob)
+
+    def _resolve_blob(self, msg: Message, sender: str) -> Optional[Message]:
+        """Fill in a referenced blob from the cache. Returns None if the
+        message was parked until the blob is fetched from the sender."""
+        digest = msg.json_data[blobcache.BLOB_REF]["hash"]
+        msg = msg.replace(json_data={k: v for k, v in msg.json_data.items() if k != blobcache.BLOB_REF})
+        if msg.binary_blob is not None:
+            if self._blobs_in is None:
+                return msg
+            if blobcache.blob_digest(msg.binary_blob) != digest:
+                # Cached under a wrong hash it would stand in for another blob from now on
+                print(f"[MessageComs] Blob from {sender} does not match its hash {digest}, not caching it")
+                return msg
+            blob = self._blobs_in.put(digest, msg.binary_blob)
+            self._blob_arrived(digest, blob)
+            return msg.replace(binary_blob=blob)
+
+        blob = self._blobs_in.get(digest) if self._blobs_in is not None else None
+        if blob is not None:
+            return msg.replace(binary_blob=blob)
+        self._expire_blob_fetches()
+        with self._blob_lock:
+            source, parked, _ = self._blob_waiting.setdefault(
+                digest, (sender, [], time.monotonic() + self.blob_fetch_timeout))
+            parked.append((msg, sender))
+            fetch = len(parked) == 1
+        if fetch:
+            self._send_now(Message(
+                coms=self,
+                sender_id=self.uuid,
+                msg_type="whisper",
+                req_id=digest,
+                key=blobcache.BLOB_FETCH_KEY,
+                json_data={"hash": digest},
+                destination=source
+            ), source)
+        return None
+
+    def _serve_blob(self, msg: Message, sender: str):
+        digest = msg.json_data["hash"]
+        # No blob in the reply tells the peer we evicted it too
+        blob = self._blobs_out.get(digest) if self._blobs_out is not None else None
+        self.send(Message(
+            coms=self,
+            sender_id=self.uuid,
+            msg_type="whisper",
+            req_id=msg.req_id,
+            key=blobcache.BLOB_DATA_KEY,
+            json_data={"hash": digest},
+            binary_blob=blob,
+            destination=sender
+        ))
+
+    def _on_blob_data(self, msg: Message, sender: str):
+        digest = msg.json_data["hash"]
+        if msg.binary_blob is None or blobcache.blob_digest(msg.binary_blob) != digest:
+            with self._blob_lock:
+                _, parked, _ = self._blob_waiting.pop(digest, (None, [], None))
+            print(f"[MessageComs] Blob {digest} unavailable from {sender}, dropping {len(parked)} message(s)")
+            return
+        blob = self._blobs_in.put(digest, msg.binary_blob) if self._blobs_in is not None else msg.binary_blob
+        self._blob_arrived(digest, blob)
+
+    def _blob_arrived(self, digest: str, blob: bytes):
+        with self._blob_lock:
+            _, parked, _ = self._blob_waiting.pop(digest, (None, [], None))
+        for msg, sender in parked:
+            self._dispatch(msg.replace(binary_blob=blob), sender)
+
+    def _expire_blob_fetches(self):
+        # Drops messages whose blob never came; the fetch or its answer was lost
+        if not self._blob_waiting:
+            return
+        now = time.monotonic()
+        with self._blob_lock:
+            expired = [(digest, self._blob_waiting.pop(digest)) for digest, (_, _, deadline)
+                       in list(self._blob_waiting.items()) if deadline <= now]
+        for digest, (source, parked, _) in expired:
+            print(f"[MessageComs] Blob {digest} not received from {source} in time, dropping {len(parked)} message(s)")
+
+    def _compress(self, msg: Message, peer_id: Optional[str]) -> Message:
+        peers = [peer_id] if peer_id is not None else list(self._peer_keys)
+        codec = compression.negotiate_codec([self._peer_codecs.get(p, ()) for p in peers])
+        if codec is None:
+            return msg
+        blob, meta = self._compressor.compress(msg.key, msg.binary_blob, codec)
+        if meta is None:
+            return msg
+        return msg.replace(json_data={**msg.json_data, compression.CODEC_META: meta}, binary_blob=blob)
+
+    def _decompress(self, msg: Message) -> Message:
+        meta = msg.json_data[compression.CODEC_META]
+        json_data = {k: v for k, v in msg.json_data.items() if k != compression.CODEC_META}
+        if msg.stream is not None:
+            stream = compression.DecompressingStream(msg.stream, meta, self.max_stream_size)
+            return msg.replace(json_data=json_data, stream=stream)
+        blob = compression.decompress(msg.binary_blob, meta, self.max_stream_size)
+        return msg.replace(json_data=json_data, binary_blob=blob)
+
+    def _send_shared(self, msg: Message, peer_id: Optional[str]):
+        holders = {peer_id} if peer_id is not None else set(self._peer_keys)
+        handle = self._shm_out.export(msg.binary_blob, holders)
+        header = msg.replace(json_data={**msg.json_data, shm.SHM_META: handle}, binary_blob=None)
+        self._send_now(header, peer_id)
+
+    def _attach_shared(self, msg: Message, peer_id: str) -> Optional[Message]:
+        json_data = {k: v for k, v in msg.json_data.items() if k != shm.SHM_META}
+        try:
+            blob = self._shm_in.attach(msg.json_data[shm.SHM_META], peer_id)
+        except OSError as e:
+            print(f"[MessageComs] Dropping shared-memory blob from {peer_id}: {e}")
+            return None
+        return msg.replace(json_data=json_data, binary_blob=blob)
+
+    def _send_shm_releases(self):
+        released: Dict[str, list] = {}
+        for peer_id, name in self._shm_in.drain():
+            released.setdefault(peer_id, []).append(name)
+        for peer_id, names in released.items():
+            msg = Message(
+                coms=self,
+                sender_id=self.uuid,
+                msg_type="whisper",
+                req_id="shm-release",
+                key=shm.SHM_RELEASE_KEY,
+                json_data={"names": names},
+                destination=peer_id
+            )
+            self._send_now(msg, peer_id)
+
+    def _send_frames(self, peer_id: Optional[str], frames: list):
+        if peer_id is not None:
+            self.transport.whisper(peer_id, frames)
+        else:
+            self.transport.shout(self.group, frames)
+
+    def _grant_credit(self, peer_id: str, stream_id: str):
+        def grant(credit: int):
+            msg = Message(
+                coms=self,
+                sender_id=self.uuid,
+                msg_type="whisper",
+                req_id=stream_id,
+                key=streaming.STREAM_CREDIT_KEY,
+                json_data={"stream": stream_id, "credit": credit},
+                destination=peer_id
+            )
+            self._send_now(msg, peer_id)
+        return grant
+
+    def _open_incoming_stream(self, msg: Message, peer_id: str) -> Optional[Message]:
+        """Start receiving a chunked blob. Returns the message to dispatch now, if any."""
+        meta = msg.json_data[streaming.STREAM_META]
+        json_data = {k: v for k, v in msg.json_data.items() if k != streaming.STREAM_META}
+        msg = msg.replace(json_data=json_data)
+        route = self._router.lookup(msg.key)
+        reassemble = route is None or not route.streaming
+        # Only reassembled streams hold their whole blob; streaming handlers get a window of chunks
+        available = None
+        if reassemble:
+            available = self.max_reassembly - sum(
+                incoming.size for incoming in self._streams_in.values()
+                if isinstance(incoming, streaming.BlobAssembler))
+        try:
+            streaming.check_meta(meta, self.max_stream_size, available)
+        except streaming.StreamError as e:
+            print(f"[MessageComs] Refusing stream from {peer_id}: {e}")
+            return None
+
+        grant = self._grant_credit(peer_id, meta["id"]) if msg.msg_type == "whisper" else None
+        if not reassemble:
+            incoming = streaming.BlobStream(msg, meta, self.stream_window, grant, max_size=self.max_stream_size)
+            self._streams_in[(peer_id, meta["id"])] = incoming
+            return msg.replace(stream=incoming)
+
+        self._streams_in[(peer_id, meta["id"])] = streaming.BlobAssembler(msg, meta, self.stream_window, grant,
+                                                                           self.max_stream_size, available)
+        return None
+
+    def _on_stream_chunk(self, msg: Message, peer_id: str) -> Optional[Message]:
+        """Feed a chunk to its stream. Returns a fully reassembled message, if any."""
+        stream_key = (peer_id, msg.json_data["stream"])
+        incoming = self._streams_in.get(stream_key)
+        if incoming is None:
+            return None
+        try:
+            complete = incoming.feed(msg.json_data["seq"], msg.binary_blob)
+        except streaming.StreamError as e:
+            print(f"[MessageComs] Dropping stream {stream_key[1]} from {peer_id}: {e}")
+            self._streams_in.pop(stream_key, None)
+            incoming.abort(e)
+            return None
+        if not complete:
+            return None
+        self._streams_in.pop(stream_key, None)
+        if isinstance(incoming, streaming.BlobAssembler):
+            return incoming.header.replace(binary_blob=incoming.buffer)
+        return None
+
     def _recv_loop(self):
         print("[MessageComs] Starting receive loop...")
         while self._running:
-            event = ZyreEvent(self.node)
-            if not event:
-                continue
-
-            ev_type = event.type()
-            if isinstance(ev_type, bytes):
-                ev_type = ev_type.decode()
-
-            print(f"[MessageComs] Received event: {ev_type}")
-            peer_id = event.peer_uuid().decode()
-
-            # Handle peer entry
-            if ev_type == "ENTER":
-                print(f"[MessageComs] Peer ENTERED: {peer_id}, sending group SHOUT")
-
-                # Broadcast our keys to the group
-                msg = (
-                    MessageBuilder(self)
-                    .with_type("shout")
-                    .with_sender_id(self.uuid)
-                    .with_req_id("peer-join")
-                    .with_key("peer.keys")
-                    .with_json_data({
-                        "event": "peer_entered",
-                        "from": self.uuid,
-                        "keys": list(self.handlers.keys())
-                    })
-                    .build()
-                )
-                self.send(msg)
-                continue
-
-            if ev_type == "EXIT" or ev_type == "LEAVE":
-                print(f"[MessageComs] Peer LEFT: {peer_id}")
-                self._peer_keys.pop(peer_id, None)
-                continue
-
-            # Ignore non-message events
-            if ev_type not in ("WHISPER", "SHOUT"):
-                continue
-
-            frames = event.msg()
-            if not frames:
+            events = self.transport.recv_many(RECV_BATCH, POLL_INTERVAL)
+            if not events:
                 continue
 
+            # Queue messages for the workers; a full lane is handled by the overload policy.
+            enqueued = time.perf_counter_ns()
+            kept = self.queue.put_many([(msg, peer_id, enqueued)
+                                        for event in events for msg, peer_id in self._handle_event(event)])
+            # Nothing may keep the frames alive until the next wakeup: zero-copy receive
+            # buffers and shared-memory blobs are released when their handlers finish
+            events = None
+            if kept and self._worker_pool is not None:
+                self._worker_pool.notify(self, kept)
+
+    def _handle_event(self, event) -> list:
+        """Process one transport event; returns the (msg, peer_id) pairs to dispatch."""
+        ev_type = event.type
+        peer_id = event.peer_id
+
+        # Handle peer entry: only the newcomer needs our keys
+        if ev_type == "ENTER":
+            print(f"[MessageComs] Peer ENTERED: {peer_id}, sending our keys")
+            self._send_keys(peer_id)
+            return []
+
+        if ev_type == "EXIT" or ev_type == "LEAVE":
+            print(f"[MessageComs] Peer LEFT: {peer_id}")
+            self._forget_peer(peer_id)
+            return []
+
+        # Ignore non-message events
+        if ev_type not in ("WHISPER", "SHOUT"):
+            return []
+
+        frames = event.frames
+        if not frames:
+            return []
+
+        if wire.is_batch(frames[0]):
             try:
-                json_data = frames.popstr()
-                blob = frames.popmem() if frames.size() > 0 else None
-
-                msg = Message.from_json(
-                    json_data,
-                    coms=self,
-                    blob=blob,
-                    destination=peer_id,
-                    received_by=self.uuid.encode()
-                )
-                # Debug: print full message
-                # try:
-                #     print(f"[MessageComs] Parsed message from {peer_id}: {msg.to_json()}")
-                # except Exception:
-                #     print(f"[MessageComs] Parsed message from {peer_id}: {msg.__dict__}")
-
-                # Automatically track peer key registry
-                if msg.key == "peer.keys":
-                    keys = msg.json_data.get("keys", [])
-                    print(f"[MessageComs] Noted keys from {peer_id}: {keys}")
-                    self._peer_keys[peer_id] = keys
-
-                # Queue message for async consumer
-                self.queue.put_nowait((msg, peer_id))
-
+                batch = wire.unpack_batch(frames)
             except Exception as e:
-                print(f"[MessageComs] Error parsing message: {e}")
+                print(f"[MessageComs] Error unpacking batch: {e}")
+                return []
+            items = (self._handle_frames(message_frames, peer_id) for message_frames in batch)
+            return [item for item in items if item is not None]
+
+        item = self._handle_frames(frames, peer_id)
+        return [item] if item is not None else []
+
+    def _handle_frames(self, frames, peer_id: str) -> Optional[tuple]:
+        started = time.perf_counter_ns()
+        try:
+            msg = wire.decode(
+                frames,
+                coms=self,
+                local_keys=self._local_keys,
+                destination=peer_id,
+                received_by=self.uuid.encode()
+            )
+            shard = self.metrics.shard()
+            if shard is not None:
+                shard.observe("decode", time.perf_counter_ns() - started, msg.key, peer_id)
+                shard.transfer("in", msg.key, peer_id, wire.frames_nbytes(frames))
+            if msg.has_meta(tracing.TRACE_META):
+                msg = self._take_trace(msg)
+                self._span(msg, "decode", started, peer_id)
+            # Debug: print full message
+            # try:
+            #     print(f"[MessageComs] Parsed message from {peer_id}: {msg.to_json()}")
+            # except Exception:
+            #     print(f"[MessageComs] Parsed message from {peer_id}: {msg.__dict__}")
+
+            # Automatically track peer key registry
+            if msg.key == registry.KEYS_DELTA_KEY:
+                keys = registry.apply_delta(self._peer_keys.get(peer_id), self._peer_key_versions.get(peer_id),
+                                            msg.json_data)
+                if keys is None:
+                    self._send_now(Message(
+                        coms=self,
+                        sender_id=self.uuid,
+                        msg_type="whisper",
+                        req_id="keys",
+                        key=registry.KEYS_FETCH_KEY,
+                        json_data={},
+                        destination=peer_id
+                    ), peer_id)
+                    return None
+                self._peer_key_versions[peer_id] = msg.json_data["version"]
+                self._peer_key_ids[peer_id] = wire.key_ids_for(keys)
+                self._peer_keys[peer_id] = keys
+                self._providers.set_keys(peer_id, keys)
+                return None
+            if msg.key == registry.KEYS_FETCH_KEY:
+                self._send_keys(peer_id)
+                return None
+            if msg.key == registry.KEYS_FULL_KEY:
+                keys = msg.json_data.get("keys", [])
+                print(f"[MessageComs] Noted keys from {peer_id}: {keys}")
+                self._peer_key_versions[peer_id] = msg.json_data.get("version")
+                self._peer_key_ids[peer_id] = wire.key_ids_for(keys)
+                self._peer_wire[peer_id] = wire.negotiate_format(msg.json_data.get("wire"), self.wire_format)
+                self._peer_features[peer_id] = set(msg.json_data.get("features", []))
+                self._peer_hosts[peer_id] = msg.json_data.get("host")
+                self._peer_codecs[peer_id] = msg.json_data.get("codecs", [])
+                self._peer_keys[peer_id] = keys
+                self._providers.set_keys(peer_id, keys)
+                return None
+
+            # Chunked transfers are handled here so chunks never queue behind handlers
+            if msg.key == streaming.STREAM_CREDIT_KEY:
+                self._streams.grant(peer_id, msg.json_data["stream"], msg.json_data["credit"])
+                return None
+            if msg.key == shm.SHM_RELEASE_KEY:
+                self._shm_out.release(peer_id, msg.json_data["names"])
+                return None
+            if msg.key == streaming.STREAM_CHUNK_KEY:
+                msg = self._on_stream_chunk(msg, peer_id)
+            elif msg.has_meta(streaming.STREAM_META):
+                msg = self._open_incoming_stream(msg, peer_id)
+            elif msg.has_meta(shm.SHM_META):
+                msg = self._attach_shared(msg, peer_id)
+            if msg is None:
+                return None
+
+            return msg, peer_id
+
+        except Exception as e:
+            self.metrics.count("parse_errors", "", peer_id)
+            print(f"[MessageComs] Error parsing message: {e}")
+            return None
+
+    def _take_trace(self, msg: Message) -> Message:
+        json_data = {k: v for k, v in msg.json_data.items() if k != tracing.TRACE_META}
+        return msg.replace(json_data=json_data, trace=msg.json_data[tracing.TRACE_META])
+
+    def _span(self, msg: Message, name: str, started: int, peer: str, flow: Optional[str] = tracing.FLOW_STEP):
+        """Record stage name of traced msg, from started until now."""
+        if self.tracer is not None:
+            self.tracer.span(msg.trace, name, started, time.perf_counter_ns(), msg.key, peer, flow)
+
+    def _forget_peer(self, peer_id: str):
+        self._peer_keys.pop(peer_id, None)
+        self._peer_key_versions.pop(peer_id, None)
+        with self._keys_lock:
+            self._keys_sent_to.discard(peer_id)
+        self._peer_wire.pop(peer_id, None)
+        self._peer_key_ids.pop(peer_id, None)
+        self._peer_features.pop(peer_id, None)
+        self._peer_hosts.pop(peer_id, None)
+        self._peer_codecs.pop(peer_id, None)
+        self._peer_latency.pop(peer_id, None)
+        self._providers.drop(peer_id)
+        self._streams.drop_peer(peer_id)
+        self._shm_out.drop_peer(peer_id)
+        if self._blobs_out is not None:
+            self._blobs_out.drop_holder(peer_id)
+        with self._blob_lock:
+            for digest in [d for d, (source, _, _) in self._blob_waiting.items() if source == peer_id]:
+                del self._blob_waiting[digest]
+        self._pending.fail_peer(peer_id, RuntimeError(f"Peer {peer_id} left"))
+        for stream_key in [k for k in self._streams_in if k[0] == peer_id]:
+            self._streams_in.pop(stream_key).abort(streaming.StreamError(f"Peer {peer_id} left"))
 
     def _worker_loop(self):
         while self._running:
             try:
-                msg, sender = self.queue.get(timeout=1)
-
-                # Handle request/reply
-                if msg.msg_type == "whisper":
-                    if not msg.destination or msg.destination not in self._peer_keys:
-                        print(f"[WARN] Destination {msg.destination} not found, dropping message")
-                        return
-                    if msg.is_request:
-                        print(f"[MessageComs] Handling request {msg.req_id}")
-                        try:
-                            handler = self.handlers.get(msg.key)
-                            if handler:
-                                result = handler(msg, sender)
-                                if result is not None:
-                                    msg.respond(result)
-                            else:
-                                msg.fail(Exception("No handler for key"))
-                        except Exception as e:
-                            msg.fail(e)
-
-                    elif msg.is_reply:
-                        print(f"[MessageComs] Received reply to {msg.json_data.get('reply_to')}")
-                        pass
+                # Not bound to a local, so a shared-memory blob is released once its handler is done
+                self._work(*self.queue.get(timeout=POLL_INTERVAL))
 
             except queue.Empty:
-                continue
+                pass
             except Exception as e:
                 print(f"[MessageComs] Handler error: {e}")
+            self._send_shm_releases()
+            self._expire_blob_fetches()
+
+    def _work_next(self):
+        """Handle the next queued message, if any; called by a SharedWorkerPool thread."""
+        try:
+            self._work(*self.queue.get_nowait())
+        except queue.Empty:
+            return
+        except Exception as e:
+            print(f"[MessageComs] Handler error: {e}")
+        self._send_shm_releases()
+        self._expire_blob_fetches()
+
+    def _work(self, msg: Message, sender: str, enqueued: int):
+        shard = self.metrics.shard()
+        if shard is not None:
+            shard.observe("queue_wait", time.perf_counter_ns() - enqueued, msg.key, sender)
+        if msg.trace is not None:
+            self._span(msg, "queue", enqueued, sender)
+        self._dispatch(msg, sender)
+
+    def _on_drop(self, item: tuple):
+        self.metrics.count("dropped", item[0].key, item[1])
+
+    def _dispatch(self, msg: Message, sender: str):
+        # Decompressed here rather than on receive so big blobs don't hold up the receive loop
+        if msg.has_meta(compression.CODEC_META):
+            try:
+                msg = self._decompress(msg)
+            except Exception as e:
+                print(f"[MessageComs] Dropping message {msg.req_id} from {sender}: {e}")
+                return
+
+        if msg.key == blobcache.BLOB_FETCH_KEY:
+            self._serve_blob(msg, sender)
+            return
+        if msg.key == blobcache.BLOB_DATA_KEY:
+            self._on_blob_data(msg, sender)
+            return
+        if msg.has_meta(blobcache.BLOB_REF):
+            msg = self._resolve_blob(msg, sender)
+            if msg is None:
+                return
+
+        # Shouts go to a matching handler if there is one; nobody is owed a reply
+        if msg.msg_type == "shout":
+            route = self._router.lookup(msg.key)
+            if route is not None and msg.is_request:
+                self._invoke(route, msg, sender)
+            return
+
+        # Handle request/reply
+        if not msg.destination or msg.destination not in self._peer_keys:
+            print(f"[WARN] Destination {msg.destination} not found, dropping message")
+            return
+        if msg.is_request:
+            route = self._router.lookup(msg.key)
+            if route is not None:
+                self._invoke(route, msg, sender)
+            else:
+                msg.fail(Exception("No handler for key"))
+
+        elif msg.is_reply:
+            self._on_reply(msg)
+
+    def _invoke(self, route: Route, msg: Message, sender: str):
+        if route.executor == "process":
+            started = time.perf_counter_ns()
+            try:
+                future = self._process_pool.submit(route.handler, msg, sender)
+            except Exception as e:
+                msg.fail(e)
+                return
+            future.add_done_callback(lambda f: self._process_handler_done(f, msg, sender, started))
+        else:
+            self._run_handler(route.handler, msg, sender)
 
-    def _send_keys(self, target_uuid: Optional[bytes] = None):
+    def _process_handler_done(self, future: Future, msg: Message, sender: str, started: int):
+        if future.cancelled() or future.exception() is not None:
+            self.metrics.count("handler_errors", msg.key, sender)
+        else:
+            self.metrics.observe("handler", time.perf_counter_ns() - started, msg.key, sender)
+        if msg.trace is not None:
+            self._span(msg, "handler", started, sender)
+
+    def _run_handler(self, handler: Callable, msg: Message, sender: str):
+        shard = self.metrics.shard()
+        started = time.perf_counter_ns()
+        try:
+            result = handler(msg, sender)
+            if shard is not None:
+                shard.observe("handler", time.perf_counter_ns() - started, msg.key, sender)
+            if msg.trace is not None:
+                self._span(msg, "handler", started, sender)
+            if result is not None:
+                msg.respond(result)
+        except Exception as e:
+            self.metrics.count("handler_errors", msg.key, sender)
+            msg.fail(e)
+
+    def stats(self) -> dict:
+        """Snapshot of message and byte counts, latency histograms (encode,
+        decode, queue_wait, handler; in seconds), drops and errors by key and
+        peer, plus gauges and the receive lane counters."""
+        snapshot = self.metrics.snapshot()
+        snapshot["lanes"] = self.queue.stats()
+        return snapshot
+
+    def _on_reply(self, msg: Message):
+        started = time.perf_counter_ns()
+        reply_to = msg.json_data.get("reply_to")
+        # msg.destination is the peer the transport got the reply from
+        rtt = self._pending.resolve(reply_to, msg, msg.destination)
+        if rtt is None:
+            print(f"[MessageComs] Received reply to {reply_to} from {msg.destination}, which is not awaited from it")
+        else:
+            self._observe_rtt(msg.destination, rtt)
+        if msg.trace is not None:
+            self._trace_reply(msg, started, rtt)
+
+    def _trace_reply(self, msg: Message, started: int, rtt: Optional[float]):
+        """Close msg's trace with the resolve stage, plus the whole round trip if it was timed."""
+        self._span(msg, "resolve", started, msg.destination, tracing.FLOW_END)
+        if rtt is not None:
+            self._span(msg, "request", started - int(rtt * 1e9), msg.destination, None)
+
+    def _send_keys(self, peer_id: str):
+        """Whisper our full key list, and what else peers negotiate on, to peer_id."""
+        with self._keys_lock:
+            keys = list(self._local_keys)
+            version = self._keys_version
+            self._keys_sent_to.add(peer_id)
         msg = Message(
             coms=self,
             sender_id=self.uuid,
-            msg_type="whisper" if target_uuid else "shout",
+            msg_type="whisper",
             req_id="keys",
-            key="key.announce",
-            json_data={"announce": "key"},
+            key=registry.KEYS_FULL_KEY,
+            json_data={
+                "from": self.uuid,
+                "keys": keys,
+                "version": version,
+                "digest": registry.keys_digest(keys),
+                "wire": wire.SUPPORTED_FORMATS,
+                "features": self.features,
+                "host": shm.host_id(),
+                "codecs": compression.SUPPORTED_CODECS
+            },
             binary_blob=None,
-            destination=target_uuid.decode() if target_uuid else None,
+            destination=peer_id,
             received_by=None
         )
         self.send(msg)
 
     def start(self):
         self._running = True
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.start()
+        if self._worker_pool is not None:
+            self._worker_pool.start()
         self._recv_thread.start()
         for thread in self._worker_threads:
             thread.start()
 
     def stop(self):
         self._running = False
-        self.node.stop()
+        # Releases a receive loop blocked on a full lane under the "block" policy
+        self.queue.close()
+        self._streams.stop()
+        self._pending.stop()
+        if self._batcher is not None:
+            self._batcher.stop()
+        self._process_pool.shutdown()
+        self._shm_out.stop()
+        # The receive loop notices within POLL_INTERVAL; only then is the transport
+        # stopped, so it is never torn down under a receive in progress
         self._recv_thread.join()
+        self.transport.stop()
         for thread in self._worker_threads:
             thread.join()
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.stop()
+        if self.tracer is not None and self.trace_path:
+            self.tracer.export(self.trace_path)
@@ -0,0 +1,382 @@
+import json
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Log-bucketed histogram layout: values below 2**(SUB_BITS + 1) get a bucket
+# each, larger ones 2**SUB_BITS buckets per power of two, so any recorded
+# value is within 1/2**SUB_BITS (12.5%) of its bucket's lower bound.
+SUB_BITS = 3
+_EXACT = 1 << (SUB_BITS + 1)
+
+EXPORT_FORMATS = {"prometheus", "json"}
+DEFAULT_EXPORT_INTERVAL = 10.0
+PERCENTILES = (50, 90, 99, 99.9)
+
+Label = Tuple[str, str, str]    # (metric name, message key, peer id)
+
+# Keys and peer ids come off the network, so each gets at most MAX_LABELS
+# distinct values; later ones are all counted under OTHER_LABEL.
+MAX_LABELS = 1000
+OTHER_LABEL = "other"
+
+_random = random.random
+
+
+def bucket_of(value: int) -> int:
+    if value < _EXACT:
+        return max(value, 0)
+    shift = value.bit_length() - SUB_BITS - 1
+    return (shift << SUB_BITS) + (value >> shift)
+
+
+_NO_MIN = 1 << 63
+
+
+def bucket_bounds(index: int) -> Tuple[int, int]:
+    """[lower, upper) range of values that land in bucket index."""
+    if index < _EXACT:
+        return index, index + 1
+    shift = (index >> SUB_BITS) - 1
+    mantissa = index - (shift << SUB_BITS)
+    return mantissa << shift, (mantissa + 1) << shift
+
+
+class Histogram:
+    """Mergeable histogram of non-negative integers (nanoseconds, bytes...).
+
+    Buckets are stored sparsely, so memory is bounded by the few hundred
+    buckets a 64-bit range can use and usually far less. Histograms from
+    different threads, processes or files combine exactly with merge().
+    """
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min = _NO_MIN
+        self.max = 0
+
+    def record(self, value: int):
+        # bucket_of(), inlined: this runs several times per message
+        if value < _EXACT:
+            index = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - SUB_BITS - 1
+            index = (shift << SUB_BITS) + (value >> shift)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        for index, n in list(other.counts.items()):
+            self.counts[index] = self.counts.get(index, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Value at percentile q (0-100), to within the bucket resolution."""
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                lower, upper = bucket_bounds(index)
+                # Middle of the bucket, but never outside what was recorded
+                return min(max((lower + upper - 1) / 2, self.min), self.max)
+        return float(self.max)
+
+    def summary(self, scale: float = 1.0) -> dict:
+        """count/mean/min/max and PERCENTILES, with values multiplied by scale."""
+        if not self.count:
+            return {"count": 0}
+        result = {
+            "count": self.count,
+            "mean": self.total / self.count * scale,
+            "min": self.min * scale,
+            "max": self.max * scale,
+        }
+        for q in PERCENTILES:
+            result[f"p{q:g}"] = self.percentile(q) * scale
+        return result
+
+    def to_dict(self) -> dict:
+        return {"counts": {str(k): v for k, v in self.counts.items()}, "count": self.count, "total": self.total,
+                "min": self.min if self.count else None, "max": self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        hist = cls()
+        hist.counts = {int(k): v for k, v in data["counts"].items()}
+        hist.count, hist.total = data["count"], data["total"]
+        hist.min = data["min"] if data["min"] is not None else _NO_MIN
+        hist.max = data["max"] or 0
+        return hist
+
+
+class _LabelSet:
+    """Values admitted as label values, first come, up to limit."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.seen: set = {"", OTHER_LABEL}    # Read without the lock on the hot path
+        self._lock = threading.Lock()
+
+    def admit(self, value: str) -> str:
+        with self._lock:
+            if value in self.seen or len(self.seen) - 2 < self.limit:
+                self.seen.add(value)
+                return value
+        return OTHER_LABEL
+
+
+class Shard:
+    """One thread's counters and histograms; only that thread writes to it.
+
+    With a sample_rate below 1, observe() keeps that fraction of values,
+    picked at random so no stage of a message is favoured; counters stay exact.
+    """
+
+    __slots__ = ("counters", "histograms", "traffic", "sample_rate", "_keys", "_peers")
+
+    def __init__(self, keys: _LabelSet, peers: _LabelSet, sample_rate: float = 1.0):
+        self.counters: Dict[Label, int] = {}
+        self.histograms: Dict[Label, Histogram] = {}
+        self.traffic: Dict[Label, list] = {}
+        self.sample_rate = sample_rate
+        self._keys = keys
+        self._peers = peers
+
+    def _label(self, name: str, key: str, peer: str) -> Label:
+        # Set lookups inline: this runs several times per message
+        if key not in self._keys.seen:
+            key = self._keys.admit(key)
+        if peer not in self._peers.seen:
+            peer = self._peers.admit(peer)
+        return name, key, peer
+
+    def transfer(self, direction: str, key: str, peer: str, nbytes: int):
+        """Count one message of nbytes; reported as messages_<direction> and bytes_<direction>."""
+        label = self._label(direction, key, peer)
+        totals = self.traffic.get(label)
+        if totals is None:
+            self.traffic[label] = [1, nbytes]
+        else:
+            totals[0] += 1
+            totals[1] += nbytes
+
+    def count(self, name: str, key: str = "", peer: str = "", n: int = 1):
+        label = self._label(name, key, peer)
+        counters = self.counters
+        counters[label] = counters.get(label, 0) + n
+
+    def observe(self, name: str, value: int, key: str = "", peer: str = ""):
+        """Record value (nanoseconds for latencies) in the histogram for name/key/peer."""
+        if self.sample_rate < 1.0 and _random() >= self.sample_rate:
+            return
+        label = self._label(name, key, peer)
+        hist = self.histograms.get(label)
+        if hist is None:
+            hist = self.histograms[label] = Histogram()
+        hist.record(value)
+
+
+class Metrics:
+    """Counters and latency histograms labelled by message key and peer.
+
+    Each thread records into its own shard, so recording takes no lock and
+    never contends; snapshots merge the shards. Hot paths fetch their
+    thread's shard once with shard() and record several values into it.
+    Gauges are sampled from callables at snapshot time.
+
+    With enabled=False, shard() returns None and callers skip recording
+    altogether. sample_rate thins the histograms (see Shard). Shards of
+    threads that have exited are folded into one retired shard.
+    """
+
+    def __init__(self, prefix: str = "mktl", enabled: bool = True, sample_rate: float = 1.0,
+                 max_labels: int = MAX_LABELS):
+        if not 0.0 < sample_rate <= 1.0:
+            raise ValueError(f"Invalid sample_rate: {sample_rate}. Must be in (0, 1]")
+        self.prefix = prefix
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self._keys = _LabelSet(max_labels)
+        self._peers = _LabelSet(max_labels)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[Tuple[threading.Thread, Shard]] = []
+        self._retired = self._new_shard()   # What threads that have exited recorded
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def _new_shard(self) -> Shard:
+        return Shard(self._keys, self._peers, self.sample_rate)
+
+    def shard(self) -> Optional[Shard]:
+        """The calling thread's shard, or None if metrics are disabled."""
+        if not self.enabled:
+            return None
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._new_shard()
+            with self._lock:
+                self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire_dead(self):
+        """Fold the shards of exited threads into _retired; caller holds _lock."""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+                continue
+            retired = self._retired
+            for label, n in shard.counters.items():
+                retired.counters[label] = retired.counters.get(label, 0) + n
+            for label, (messages, nbytes) in shard.traffic.items():
+                totals = retired.traffic.setdefault(label, [0, 0])
+                totals[0] += messages
+                totals[1] += nbytes
+            for label, hist in shard.histograms.items():
+                retired.histograms.setdefault(label, Histogram()).merge(hist)
+        self._shards = live
+
+    def count(self, name: str, key: str = "", peer: str = "", n: int = 1):
+        shard = self.shard()
+        if shard is not None:
+            shard.count(name, key, peer, n)
+
+    def observe(self, name: str, value: int, key: str = "", peer: str = ""):
+        shard = self.shard()
+        if shard is not None:
+            shard.observe(name, value, key, peer)
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        self._gauges[name] = fn
+
+    def collect(self) -> Tuple[Dict[Label, int], Dict[Label, Histogram], Dict[str, float]]:
+        """Merge every thread's shard; returns (counters, histograms, gauges)."""
+        with self._lock:
+            self._retire_dead()
+            shards = [self._retired] + [shard for _, shard in self._shards]
+        counters: Dict[Label, int] = {}
+        histograms: Dict[Label, Histogram] = {}
+        for shard in shards:
+            # list() copies under the GIL, so the owning thread may keep recording
+            for label, n in list(shard.counters.items()):
+                counters[label] = counters.get(label, 0) + n
+            for (direction, key, peer), (messages, nbytes) in list(shard.traffic.items()):
+                for label, n in (((f"messages_{direction}", key, peer), messages),
+                                 ((f"bytes_{direction}", key, peer), nbytes)):
+                    counters[label] = counters.get(label, 0) + n
+            for label, hist in list(shard.histograms.items()):
+                histograms.setdefault(label, Histogram()).merge(hist)
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception:
+                continue
+        return counters, histograms, gauges
+
+    def snapshot(self) -> dict:
+        """JSON-serialisable view: counters, latency summaries in seconds, and gauges."""
+        counters, histograms, gauges = self.collect()
+        return {
+            "time": time.time(),
+            "counters": [{"name": n, "key": k, "peer": p, "value": v} for (n, k, p), v in sorted(counters.items())],
+            "histograms": [{"name": n, "key": k, "peer": p, **hist.summary(1e-9)}
+                           for (n, k, p), hist in sorted(histograms.items())],
+            "gauges": gauges,
+        }
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format; histogram values are in seconds."""
+        counters, histograms, gauges = self.collect()
+        lines = []
+        for (name, key, peer), value in sorted(counters.items()):
+            lines.append(f"{self.prefix}_{name}_total{_labels(key, peer)} {value}")
+        for (name, key, peer), hist in sorted(histograms.items()):
+            metric = f"{self.prefix}_{name}_seconds"
+            cumulative = 0
+            for index in sorted(hist.counts):
+                cumulative += hist.counts[index]
+                upper = bucket_bounds(index)[1] * 1e-9
+                lines.append(f"{metric}_bucket{_labels(key, peer, le=f'{upper:.9g}')} {cumulative}")
+            lines.append(f"{metric}_bucket{_labels(key, peer, le='+Inf')} {hist.count}")
+            lines.append(f"{metric}_sum{_labels(key, peer)} {hist.total * 1e-9:.9g}")
+            lines.append(f"{metric}_count{_labels(key, peer)} {hist.count}")
+        for name, value in sorted(gauges.items()):
+            lines.append(f"{self.prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(key: str, peer: str, **extra) -> str:
+    pairs: Iterable[Tuple[str, str]] = [("key", key), ("peer", peer), *extra.items()]
+    parts = [f'{name}="{_escape(value)}"' for name, value in pairs if value]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsExporter:
+    """Rewrites a Prometheus-text or JSON metrics file every interval seconds.
+
+    The file is replaced atomically, so scrapers never read a partial write.
+    """
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = DEFAULT_EXPORT_INTERVAL,
+                 fmt: Optional[str] = None):
+        fmt = fmt or ("json" if path.endswith(".json") else "prometheus")
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Invalid metrics format: {fmt}. Must be one of {EXPORT_FORMATS}")
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.fmt = fmt
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._export_loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.export()
+
+    def export(self):
+        if self.fmt == "json":
+            text = json.dumps(self.metrics.snapshot(), indent=1)
+        else:
+            text = self.metrics.to_prometheus()
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, self.path)
+
+    def _export_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except OSError as e:
+                print(f"[MetricsExporter] Failed to write {self.path}: {e}")
@@ -1,173 +1,209 @@
 import os
 import time
-import csv
 import uuid
-import random
 import argparse
-import threading
-import queue
+from binlog import ColumnarLogReader, ColumnarLogWriter
+from clock import ClockSync, now_ns
+from loadgen import ARRIVALS, LoadGenerator, parse_schedule
 from message_coms import MessageComs
 from message import MessageBuilder
 
 RUN_DURATION_SEC = 30 * 60  # 30 minutes
 WHISPER_INTERVAL = 5        # seconds
+ECHO_TIMEOUT = 60           # seconds before an echo counts as lost
+DISCOVERY_TIMEOUT = 30      # seconds a load run waits for a peer to send to
 SHOUT_INTERVAL = 15         # seconds
-LOG_FIELDS = ["msg_id", "rtt", "sent_time", "recv_time", "peer", "mode", "role"]
+STREAM_THRESHOLD = 4 * 1024 * 1024  # Blobs this large are sent in chunks
+SHM_THRESHOLD = 1024 * 1024         # Blobs this large go through shared memory to same-host peers
+COMPRESS_THRESHOLD = 64 * 1024      # Blobs this large are compressed when it pays off
+BLOB_CACHE_BYTES = 128 * 1024 * 1024  # Repeated blobs are sent by hash and served from this cache
+TRACE_SAMPLE_RATE = 0.01             # Fraction of requests traced stage by stage, see tracing.py
+# RTT rows are echo round trips timed on the sender; one_way is the sender → receiver
+# leg, from the clock offset estimate, and clock_error bounds it. All in seconds.
+# node is the node that logged the row, as several may share one log file.
+LOG_COLUMNS = [("msg_id", "str"), ("rtt", "f64"), ("sent_time", "f64"), ("recv_time", "f64"),
+               ("peer", "sym"), ("mode", "sym"), ("role", "sym"), ("one_way", "f64"), ("clock_error", "f64"),
+               ("node", "sym")]
+
+
+def _timestamp(value):
+    """value if it is a nanosecond timestamp as now_ns() makes them, else None; peers send these."""
+    return value if type(value) is int and 0 < value < 1 << 63 else None
+
 
 class PeerNode:
-    def __init__(self, name, group, role="standard", log_dir="logs"):
+    """One test peer. By default it owns its log file and worker threads; a
+    launcher hosting many nodes in one process passes a shared log writer and
+    SharedWorkerPool (and optionally a transport) instead, see stress_launcher.py."""
+
+    def __init__(self, name, group, role="standard", log_dir="logs", export_csv=False,
+                 log=None, worker_pool=None, transport=None):
         self.name = name
         self.role = role
         self.group = group
         self.uuid = str(uuid.uuid4())
         self.start_time = time.time()
-        self.coms = MessageComs(name=self.name, group=self.group)
+        self.coms = MessageComs(name=self.name, group=self.group, transport=transport,
+                                stream_threshold=STREAM_THRESHOLD,
+                                shm_threshold=SHM_THRESHOLD, compress_threshold=COMPRESS_THRESHOLD,
+                                blob_cache_bytes=BLOB_CACHE_BYTES, overload_policy="shed",
+                                trace_sample_rate=TRACE_SAMPLE_RATE,
+                                trace_path=os.path.join(log_dir, f"{name}.trace.json"),
+                                worker_pool=worker_pool)
         self.log_dir = log_dir
         os.makedirs(self.log_dir, exist_ok=True)
-        self.csv_file = os.path.join(self.log_dir, f"{self.name}.csv")
 
-        self._init_logger()
+        # Records are buffered in columns and written in blocks, see binlog.py
+        self._owns_log = log is None
+        if self._owns_log:
+            self.log_file = os.path.join(self.log_dir, f"{self.name}.mlog")
+            self.csv_file = os.path.join(self.log_dir, f"{self.name}.csv") if export_csv else None
+            self.log = ColumnarLogWriter(self.log_file, LOG_COLUMNS)
+        else:
+            self.log_file = self.csv_file = None
+            self.log = log
+        # Every echo doubles as an NTP-style ping, see clock.py
+        self.clocks = ClockSync()
 
         # Register message handlers
         self.coms.register_handler("peer.hello", self._handle_hello)
         self.coms.register_handler("perf.echo", self._handle_echo)
 
-        self.log_queue = queue.Queue()
-        self.log_thread = threading.Thread(target=self._log_writer_loop, daemon=True)
-        self.log_thread.start()
-
-    def _init_logger(self):
-        self.log_fp = open(self.csv_file, "w", newline="")
-        self.logger = csv.DictWriter(self.log_fp, fieldnames=LOG_FIELDS)
-        self.logger.writeheader()
-
     def _handle_hello(self, msg, sender):
         self.peers.add(sender)
 
     def _handle_echo(self, msg, sender):
-        recv_time = time.time()
-        sent_time = msg.json_data.get("sent_time")
-        rtt = recv_time - sent_time if sent_time else 0.0
+        t1 = now_ns()
+        t0 = _timestamp(msg.json_data.get("t0"))
         peer_id = sender.decode() if isinstance(sender, bytes) else sender
-        self.log_queue.put({
-            "msg_id": msg.req_id,
-            "rtt": f"{rtt:.6f}",
-            "sent_time": sent_time,
-            "recv_time": recv_time,
-            "peer": peer_id,
-            "mode": "RECV",
-            "role": self.role
-        })
-        return {"rtt": rtt, "echoed": True}
-    def run(self):
+        one_way = self.clocks.one_way(peer_id, t0, t1) if t0 else None
+        latency, error = (one_way[0] / 1e9, one_way[1] / 1e9) if one_way else (None, None)
+        self.log.append(msg.req_id, None, t0 / 1e9 if t0 else None, t1 / 1e9, peer_id, "RECV", self.role,
+                        latency, error, self.name)
+        return {"echoed": True, "t1": t1, "t2": now_ns()}
+
+    def _on_echo_reply(self, future, peer, t0, started):
+        """Time the round trip on our own monotonic clock and feed the exchange to the offset estimator."""
+        rtt = (time.perf_counter_ns() - started) / 1e9
+        t3 = now_ns()
+        if future.exception() is not None:
+            self.log.append("", None, t0 / 1e9, None, peer, "LOST", self.role, None, None, self.name)
+            return
+        reply = future.result()
+        t1, t2 = _timestamp(reply.json_data.get("t1")), _timestamp(reply.json_data.get("t2"))
+        latency = error = None
+        if t1 is not None and t2 is not None:
+            self.clocks.add(peer, t0, t1, t2, t3)
+            one_way = self.clocks.one_way(peer, t0, t1, sent_by_peer=False)
+            if one_way:
+                latency, error = one_way[0] / 1e9, one_way[1] / 1e9
+        self.log.append(reply.json_data.get("reply_to", ""), rtt, t0 / 1e9, t3 / 1e9, peer, "RTT", self.role,
+                        latency, error, self.name)
+
+    def start(self):
         print(f"[{self.name}] Starting node in group '{self.group}' with role '{self.role}'")
+        self._last_whisper = 0
+        self._last_shout = 0
         self.coms.start()
-        last_whisper = 0
-        last_shout = 0
 
+    def run(self):
+        self.start()
         try:
             while time.time() - self.start_time < RUN_DURATION_SEC:
-                now = time.time()
-
-                # Periodic SHOUT with role-dependent binary payload
-                if now - last_shout >= SHOUT_INTERVAL:
-                    payload_text = {"role": self.role, "timestamp": now}
-                    binary_blob = None
-
-                    if self.role == "small":
-                        payload_text["status"] = "hello"
-                    elif self.role == "medium":
-                        binary_blob = b"x" * (1 * 1024 * 1024)  # 1 MB
-                        payload_text["status"] = f"{len(binary_blob)}B payload"
-                    elif self.role == "large":
-                        binary_blob = b"x" * (10 * 1024 * 1024)  # 10 MB
-                        payload_text["status"] = f"{len(binary_blob)}B payload"
-                    elif self.role == "x-large":
-                        binary_blob = b"x" * (50 * 1024 * 1024)  # 50 MB
-                        payload_text["status"] = f"{len(binary_blob)}B payload"
-                    else:
-                        payload_text["status"] = "default-status"
-
-                    msg_builder = (
-                        MessageBuilder(self.coms)
-                        .with_type("shout")
-                        .with_sender_id(self.coms.uuid)
-                        .with_req_id(str(uuid.uuid4()))
-                        .with_key("peer.status")
-                        .with_json_data(payload_text)
-                    )
-
-                    if binary_blob is not None:
-                        msg_builder = msg_builder.with_binary_blob(binary_blob)
-
-                    msg = msg_builder.build()
-                    self.coms.send(msg)
-                    last_shout = now
-
-                # Periodic WHISPER to a random known peer
-                known_peers = list(self.coms._peer_keys.keys())
-                if now - last_whisper >= WHISPER_INTERVAL and known_peers:
-                    peer = random.choice(known_peers)
-                    sent_time = time.time()
-                    binary_blob = None
-                    json_payload = {"sent_time": sent_time}
-
-                    if self.role == "small":
-                        json_payload["ping"] = "hi"
-                    elif self.role == "medium":
-                        binary_blob = b"m" * (1 * 1024 * 1024)  # 1 MB
-                        json_payload["ping"] = f"{len(binary_blob)}B blob"
-                    elif self.role == "large":
-                        binary_blob = b"l" * (10 * 1024 * 1024)  # 10 MB
-                        json_payload["ping"] = f"{len(binary_blob)}B blob"
-                    elif self.role == "x-large":
-                        binary_blob = b"x" * (50 * 1024 * 1024)  # 50 MB
-                        json_payload["ping"] = f"{len(binary_blob)}B blob"
-
-                    msg_builder = (
-                        MessageBuilder(self.coms)
-                        .with_type("whisper")
-                        .with_sender_id(self.coms.uuid)
-                        .with_req_id(str(uuid.uuid4()))
-                        .with_key("perf.echo")
-                        .with_destination(peer)
-                        .with_json_data(json_payload)
-                    )
-
-                    if binary_blob:
-                        msg_builder = msg_builder.with_binary_blob(binary_blob)
-
-                    msg = msg_builder.build()
-                    self.coms.send(msg)
-                    self.log_queue.put({
-                        "msg_id": msg.req_id,
-                        "rtt": "",
-                        "sent_time": sent_time,
-                        "recv_time": "",
-                        "peer": peer,
-                        "mode": "SEND",
-                        "role": self.role
-                    })
-                    last_whisper = now
-
+                self.tick(time.time())
                 time.sleep(0.1)
         finally:
-            self.coms.stop()
-            self.log_queue.put(None)
-            self.log_thread.join()
-            self.log_fp.close()
-            print(f"[{self.name}] Shut down complete.")
-
-    def _log_writer_loop(self):
-        while True:
-            entry = self.log_queue.get()
-            if entry is None:
-                break
-            try:
-                self.logger.writerow(entry)
-                self.log_fp.flush()
-            except Exception as e:
-                print(f"[{self.name}] Logging error: {e}")
+            self._shutdown()
+
+    def tick(self, now):
+        """One pass of the periodic shout/whisper loop; run() calls it every 0.1 s."""
+        # Periodic SHOUT with role-dependent binary payload
+        if now - self._last_shout >= SHOUT_INTERVAL:
+            payload_text = {"role": self.role, "timestamp": now}
+            binary_blob = None
+
+            if self.role == "small":
+                payload_text["status"] = "hello"
+            elif self.role == "medium":
+                binary_blob = b"x" * (1 * 1024 * 1024)  # 1 MB
+                payload_text["status"] = f"{len(binary_blob)}B payload"
+            elif self.role == "large":
+                binary_blob = b"x" * (10 * 1024 * 1024)  # 10 MB
+                payload_text["status"] = f"{len(binary_blob)}B payload"
+            elif self.role == "x-large":
+                binary_blob = b"x" * (50 * 1024 * 1024)  # 50 MB
+                payload_text["status"] = f"{len(binary_blob)}B payload"
+            else:
+                payload_text["status"] = "default-status"
+
+            msg_builder = (
+                MessageBuilder(self.coms)
+                .with_type("shout")
+                .with_sender_id(self.coms.uuid)
+                .with_key("peer.status")
+                .with_json_data(payload_text)
+            )
+
+            if binary_blob is not None:
+                msg_builder = msg_builder.with_binary_blob(binary_blob)
+
+            msg = msg_builder.build()
+            self.coms.send(msg)
+            self._last_shout = now
+
+        # Periodic WHISPER to the least loaded peer that handles perf.echo
+        peer = self.coms.pick_provider("perf.echo") if now - self._last_whisper >= WHISPER_INTERVAL else None
+        if peer is not None:
+            binary_blob = None
+            json_payload = {}
+
+            if self.role == "small":
+                json_payload["ping"] = "hi"
+            elif self.role == "medium":
+                binary_blob = b"m" * (1 * 1024 * 1024)  # 1 MB
+                json_payload["ping"] = f"{len(binary_blob)}B blob"
+            elif self.role == "large":
+                binary_blob = b"l" * (10 * 1024 * 1024)  # 10 MB
+                json_payload["ping"] = f"{len(binary_blob)}B blob"
+            elif self.role == "x-large":
+                binary_blob = b"x" * (50 * 1024 * 1024)  # 50 MB
+                json_payload["ping"] = f"{len(binary_blob)}B blob"
+
+            # Timestamped last, so building the payload isn't counted as latency
+            started = time.perf_counter_ns()
+            t0 = json_payload["t0"] = now_ns()
+            future = self.coms.request("perf.echo", json_payload, peer, timeout=ECHO_TIMEOUT,
+                                       blob=binary_blob)
+            future.add_done_callback(lambda f, p=peer, t=t0, s=started: self._on_echo_reply(f, p, t, s))
+            self._last_whisper = now
+
+    def run_load(self, schedule, arrivals="poisson", sizes="0", keys="perf.echo", seed=None):
+        """Open-loop load instead of the periodic whisper/shout loop; see loadgen.py.
+        Per-stage throughput and latency are written to <log_dir>/<name>.load.json."""
+        generator = LoadGenerator(self.coms, parse_schedule(schedule), arrivals, sizes, keys,
+                                  timeout=ECHO_TIMEOUT, seed=seed)
+        print(f"[{self.name}] Starting load run in group '{self.group}': {schedule}")
+        self.coms.start()
+        try:
+            deadline = time.time() + DISCOVERY_TIMEOUT
+            while not all(self.coms.providers(key) for key in generator.keys.values) and time.time() < deadline:
+                time.sleep(0.1)
+            results = generator.run()
+            generator.write_results(os.path.join(self.log_dir, f"{self.name}.load.json"))
+            for stage in results["stages"]:
+                print(f"[{self.name}] target {stage['target_rate']:.0f}/s: {stage['throughput']:.1f}/s done, "
+                      f"p99 {stage['latency'].get('p99', float('nan')) * 1e3:.2f} ms")
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        self.coms.stop()
+        if self._owns_log:
+            self.log.close()
+            if self.csv_file:
+                with ColumnarLogReader(self.log_file) as reader:
+                    reader.to_csv(self.csv_file)
+        print(f"[{self.name}] Shut down complete.")
 
 
 def main():
@@ -176,10 +212,19 @@ def main():
     parser.add_argument("--group", default="mktl-perf")
     parser.add_argument("--role", default="standard")
     parser.add_argument("--log-dir", default="logs")
+    parser.add_argument("--csv", action="store_true", help="Also export the log as CSV on shutdown")
+    parser.add_argument("--schedule", help="Run open-loop load instead, e.g. 10:100,60:100-2000 (seconds:rate)")
+    parser.add_argument("--arrivals", default="poisson", choices=sorted(ARRIVALS))
+    parser.add_argument("--sizes", default="0", help="Payload sizes, e.g. 4K, uniform:1K-64K or 0=90,1M=10")
+    parser.add_argument("--keys", default="perf.echo", help="Key mix, e.g. perf.echo=9,camera.expose=1")
+    parser.add_argument("--seed", type=int)
     args = parser.parse_args()
 
-    node = PeerNode(args.name, args.group, args.role, args.log_dir)
-    node.run()
+    node = PeerNode(args.name, args.group, args.role, args.log_dir, export_csv=args.csv)
+    if args.schedule:
+        node.run_load(args.schedule, args.arrivals, args.sizes, args.keys, args.seed)
+    else:
+        node.run()
 
 if __name__ == "__main__":
     main()
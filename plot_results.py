@@ -1,93 +1,254 @@
-import os
-import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.stats import zscore
+import argparse
+import csv
 import glob
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-# Constants
+from binlog import ColumnarLogReader
+from metrics import PERCENTILES, SUB_BITS, Histogram
+
+# Log analysis
+#
+# Each node's log is reduced in a worker process, a chunk at a time, to
+# RTT histograms keyed by (dimension, value, window): dimension is "all",
+# "role" or "peer", window the start (s) of a fixed-length time window, or
+# None for the whole run. Histograms merge exactly, so the main process
+# only adds them up; no log is ever held in memory whole.
 LOG_DIR = "logs"
-OUT_DIR = "normalized_logs"
-os.makedirs(OUT_DIR, exist_ok=True)
-
-def load_and_concatenate_logs(log_dir):
-    """Load all CSV logs from a directory into a single DataFrame."""
-    csv_files = glob.glob(os.path.join(log_dir, "*.csv"))
-    if not csv_files:
-        raise FileNotFoundError(f"No CSV files found in {log_dir}")
-
-    dfs = []
-    for csv_file in csv_files:
-        df = pd.read_csv(csv_file)
-        df["source_file"] = os.path.basename(csv_file)
-        dfs.append(df)
-    return pd.concat(dfs, ignore_index=True)
-
-def normalize_rtt_by_role(df):
-    """Add z-score normalization for RTT within each role group."""
-    df = df.copy()
-    df["rtt"] = pd.to_numeric(df["rtt"], errors="coerce")
-    df = df[df["mode"] == "RECV"]
-    df = df.dropna(subset=["rtt"])
-    df["rtt_zscore"] = df.groupby("role")["rtt"].transform(zscore)
-    return df
-
-def save_normalized_data(df, out_dir):
-    """Save normalized data per original source file."""
-    os.makedirs(out_dir, exist_ok=True)
-    for file_name, group_df in df.groupby("source_file"):
-        out_file = os.path.join(out_dir, file_name)
-        group_df.to_csv(out_file, index=False)
-
-def plot_rtt_histograms(df):
-    """Plot histogram of RTTs per role."""
-    roles = df["role"].unique()
-    for role in roles:
-        subset = df[df["role"] == role]
-        plt.figure()
-        plt.hist(subset["rtt"], bins=50, alpha=0.7)
-        plt.title(f"RTT Histogram for Role: {role}")
-        plt.xlabel("RTT (sec)")
-        plt.ylabel("Count")
-        plt.grid(True)
-        plt.tight_layout()
-        plt.savefig(f"histogram_{role}.png")
+DEFAULT_WINDOW = 60.0
+DEFAULT_CHUNK_ROWS = 65536
+DIMENSIONS = ("role", "peer")
 
-def plot_rtt_zscore_vs_time(df):
-    """Scatterplot of RTT z-score over elapsed time (minutes) since first receive."""
-    if df is None or df.empty:
-        print("[plot] No data to plot.")
+GroupKey = Tuple[str, str, Optional[float]]
+
+
+def read_chunks(path: str, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> Iterator[Dict[str, list]]:
+    """Yield a log's (mode, role, peer, rtt, recv_time) columns a chunk at a time."""
+    names = ("mode", "role", "peer", "rtt", "recv_time")
+    if path.endswith(".mlog"):
+        with ColumnarLogReader(path) as reader:
+            symbols = reader.symbols
+            for block in reader.blocks():
+                yield {
+                    "mode": [symbols[i] for i in block["mode"]],
+                    "role": [symbols[i] for i in block["role"]],
+                    "peer": [symbols[i] for i in block["peer"]],
+                    "rtt": block["rtt"].tolist(),
+                    "recv_time": block["recv_time"].tolist(),
+                }
         return
+    with open(path, newline="") as f:
+        chunk = {name: [] for name in names}
+        for row in csv.DictReader(f):
+            for name in ("mode", "role", "peer"):
+                chunk[name].append(row.get(name) or "")
+            for name in ("rtt", "recv_time"):
+                try:
+                    chunk[name].append(float(row.get(name) or "nan"))
+                except ValueError:
+                    chunk[name].append(math.nan)
+            if len(chunk["mode"]) >= chunk_rows:
+                yield chunk
+                chunk = {name: [] for name in names}
+        if chunk["mode"]:
+            yield chunk
+
 
-    df = df.copy()
-    df["recv_time"] = pd.to_numeric(df["recv_time"], errors="coerce")
-    df = df.dropna(subset=["recv_time", "rtt_zscore", "role"])
-    if df.empty:
-        print("[plot] No valid rows after cleaning.")
+def record_all(hist: Histogram, values_ns: List[int]):
+    """Histogram.record() for many values; bucketed in one pass with NumPy if available."""
+    if np is None or len(values_ns) < 64:
+        for value in values_ns:
+            hist.record(value)
         return
+    values = np.asarray(values_ns, dtype=np.int64)
+    exact = 1 << (SUB_BITS + 1)
+    large = np.maximum(values, exact)
+    # frexp gives the bit length exactly, where log2 may round up just below a power of two
+    shift = np.frexp(large.astype(np.float64))[1].astype(np.int64) - SUB_BITS - 1
+    indexes = np.where(values < exact, np.maximum(values, 0), (shift << SUB_BITS) + (large >> shift))
+    buckets, counts = np.unique(indexes, return_counts=True)
+    for index, n in zip(buckets.tolist(), counts.tolist()):
+        hist.counts[index] = hist.counts.get(index, 0) + n
+    hist.count += len(values)
+    hist.total += int(values.sum())
+    hist.min = min(hist.min, int(values.min()))
+    hist.max = max(hist.max, int(values.max()))
 
-    # Normalize to elapsed minutes from the first recv_time
-    start = df["recv_time"].min()
-    df["elapsed_min"] = (df["recv_time"] - start) / 60.0
-    df = df.sort_values("elapsed_min")
 
-    plt.figure(figsize=(10, 6))
-    for role in df["role"].dropna().unique():
-        subset = df[df["role"] == role]
-        if subset.empty:
+def summarize_file(path: str, window: float = DEFAULT_WINDOW, chunk_rows: int = DEFAULT_CHUNK_ROWS) -> dict:
+    """Reduce one log to RTT histograms per group, plus its time span and lost echoes.
+
+    Runs in a worker process, so the result is plain data."""
+    hists: Dict[GroupKey, Histogram] = {}
+    lost: Dict[Tuple[str, str], int] = {}
+    first, last = math.inf, -math.inf
+    for chunk in read_chunks(path, chunk_rows):
+        values: Dict[GroupKey, List[int]] = {}
+        for mode, role, peer, rtt, recv_time in zip(chunk["mode"], chunk["role"], chunk["peer"],
+                                                    chunk["rtt"], chunk["recv_time"]):
+            if mode == "LOST":
+                for dimension, value in (("all", ""), ("role", role), ("peer", peer)):
+                    lost[(dimension, value)] = lost.get((dimension, value), 0) + 1
+                continue
+            if mode != "RTT" or rtt != rtt or recv_time != recv_time:    # NaN check
+                continue
+            first, last = min(first, recv_time), max(last, recv_time)
+            start = recv_time - recv_time % window
+            rtt_ns = int(rtt * 1e9)
+            for dimension, value in (("all", ""), ("role", role), ("peer", peer)):
+                values.setdefault((dimension, value, None), []).append(rtt_ns)
+                values.setdefault((dimension, value, start), []).append(rtt_ns)
+        for key, group in values.items():
+            hist = hists.get(key)
+            if hist is None:
+                hist = hists[key] = Histogram()
+            record_all(hist, group)
+    return {
+        "histograms": [(list(key), hist.to_dict()) for key, hist in hists.items()],
+        "lost": [(list(key), n) for key, n in lost.items()],
+        "span": (first, last),
+    }
+
+
+def analyze(paths: List[str], window: float = DEFAULT_WINDOW, jobs: Optional[int] = None,
+            chunk_rows: int = DEFAULT_CHUNK_ROWS) -> dict:
+    """Summarize every log in a process pool and merge the results."""
+    hists: Dict[GroupKey, Histogram] = {}
+    lost: Dict[Tuple[str, str], int] = {}
+    first, last = math.inf, -math.inf
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        partials = pool.map(summarize_file, paths, [window] * len(paths), [chunk_rows] * len(paths))
+        for partial in partials:
+            for key, data in partial["histograms"]:
+                key = tuple(key)
+                hist = Histogram.from_dict(data)
+                if key in hists:
+                    hists[key].merge(hist)
+                else:
+                    hists[key] = hist
+            for key, n in partial["lost"]:
+                lost[tuple(key)] = lost.get(tuple(key), 0) + n
+            first, last = min(first, partial["span"][0]), max(last, partial["span"][1])
+    return {"histograms": hists, "lost": lost, "span": (first, last), "window": window}
+
+
+def report(result: dict) -> dict:
+    """JSON-serialisable table: RTT percentiles (seconds) and throughput (echoes/s)
+    per dimension value, overall and per window."""
+    first, last = result["span"]
+    duration = max(last - first, result["window"]) if first <= last else 0.0
+    rows = []
+    for (dimension, value, start), hist in sorted(result["histograms"].items(),
+                                                  key=lambda item: (item[0][0], item[0][1], item[0][2] or -1)):
+        seconds = result["window"] if start is not None else duration
+        rows.append({
+            "dimension": dimension, "value": value, "window": start,
+            "throughput": hist.count / seconds if seconds else None,
+            "lost": result["lost"].get((dimension, value), 0) if start is None else None,
+            **hist.summary(1e-9),
+        })
+    return {"window": result["window"], "start": first if first <= last else None, "rows": rows}
+
+
+def print_table(table: dict, dimensions: List[str]):
+    header = f"{'group':<40} {'count':>8} {'lost':>6} {'msg/s':>9}"
+    header += "".join(f" {f'p{q:g} ms':>10}" for q in PERCENTILES)
+    print(header)
+    for row in table["rows"]:
+        if row["window"] is not None or (row["dimension"] != "all" and row["dimension"] not in dimensions):
             continue
-        plt.scatter(subset["elapsed_min"], subset["rtt_zscore"], label=role, alpha=0.6, s=10)
+        name = "all" if row["dimension"] == "all" else f"{row['dimension']}={row['value']}"
+        line = f"{name[:40]:<40} {row['count']:>8} {row['lost']:>6} {row['throughput'] or 0:>9.2f}"
+        line += "".join(f" {row[f'p{q:g}'] * 1e3:>10.3f}" for q in PERCENTILES)
+        print(line)
+
+
+def plot(result: dict, table: dict, out_dir: str):
+    """RTT histogram and percentiles over time for each role, as PNGs in out_dir."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from metrics import bucket_bounds
+
+    os.makedirs(out_dir, exist_ok=True)
+    start = table["start"] or 0.0
+    for (dimension, role, window), hist in result["histograms"].items():
+        if dimension != "role" or window is not None:
+            continue
+        plt.figure()
+        indexes = sorted(hist.counts)
+        lowers = [bucket_bounds(i)[0] * 1e-6 for i in indexes]
+        widths = [(bucket_bounds(i)[1] - bucket_bounds(i)[0]) * 1e-6 for i in indexes]
+        plt.bar(lowers, [hist.counts[i] for i in indexes], width=widths, align="edge")
+        plt.xscale("log")
+        plt.title(f"RTT Histogram for Role: {role}")
+        plt.xlabel("RTT (ms)")
+        plt.ylabel("Count")
+        plt.grid(True)
+        plt.tight_layout()
+        plt.savefig(os.path.join(out_dir, f"histogram_{role}.png"))
+        plt.close()
 
-    plt.title("RTT Z-Score Over Time by Role")
+    plt.figure(figsize=(10, 6))
+    for role in sorted({row["value"] for row in table["rows"] if row["dimension"] == "role"}):
+        rows = [row for row in table["rows"] if row["dimension"] == "role" and row["value"] == role
+                and row["window"] is not None]
+        elapsed = [(row["window"] - start) / 60.0 for row in rows]
+        for q, style in ((50, "-"), (99, "--")):
+            plt.plot(elapsed, [row[f"p{q}"] * 1e3 for row in rows], style, label=f"{role} p{q}")
+    plt.title("RTT Percentiles Over Time by Role")
     plt.xlabel("Elapsed Time (minutes)")
-    plt.ylabel("RTT Z-Score")
+    plt.ylabel("RTT (ms)")
+    plt.yscale("log")
     plt.legend()
     plt.grid(True)
     plt.tight_layout()
-    plt.savefig("rtt_zscore_vs_time.png")
+    plt.savefig(os.path.join(out_dir, "rtt_percentiles_vs_time.png"))
+    plt.close()
+
+
+def find_logs(log_dir: str) -> List[str]:
+    """Every node's log, preferring the columnar log where a CSV export of it sits alongside."""
+    mlog_files = sorted(glob.glob(os.path.join(log_dir, "*.mlog")))
+    exported = {os.path.splitext(f)[0] for f in mlog_files}
+    csv_files = [f for f in sorted(glob.glob(os.path.join(log_dir, "*.csv")))
+                 if os.path.splitext(f)[0] not in exported]
+    return mlog_files + csv_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RTT percentiles and throughput from PeerNode logs")
+    parser.add_argument("log_dir", nargs="?", default=LOG_DIR)
+    parser.add_argument("--window", type=float, default=DEFAULT_WINDOW, help="Time window in seconds")
+    parser.add_argument("--by", nargs="+", choices=DIMENSIONS, default=["role"],
+                        help="Groupings to print; the JSON output has all of them")
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes (default: one per core)")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument("--json", help="Write the full table, including every window, here")
+    parser.add_argument("--plot", action="store_true", help="Render PNG plots into --out-dir")
+    parser.add_argument("--out-dir", default=".")
+    args = parser.parse_args()
+
+    paths = find_logs(args.log_dir)
+    if not paths:
+        raise FileNotFoundError(f"No log files found in {args.log_dir}")
+    result = analyze(paths, args.window, args.jobs, args.chunk_rows)
+    table = report(result)
+    print_table(table, args.by)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(table, f, indent=1)
+    if args.plot:
+        plot(result, table, args.out_dir)
 
 
-df_logs = load_and_concatenate_logs(LOG_DIR)
-df_normalized = normalize_rtt_by_role(df_logs)
-save_normalized_data(df_normalized, OUT_DIR)
-plot_rtt_histograms(df_normalized)
-plot_rtt_zscore_vs_time(df_normalized)
+if __name__ == "__main__":
+    main()
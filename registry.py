@@ -0,0 +1,31 @@
+import hashlib
+from typing import Optional, Sequence
+
+# Key registry announcements
+#
+# Every node numbers its announced key list with a version, bumped each time
+# a handler key is added. The full list goes out as KEYS_FULL_KEY: whispered
+# to each peer as it enters, and to any peer that asks with KEYS_FETCH_KEY.
+# Keys registered later are shouted as KEYS_DELTA_KEY {"version", "added",
+# "digest"}. A receiver applies a delta only on top of the version before
+# it, and checks the digest of the result; on a gap or a mismatch it asks
+# for the full list instead. Each node thus parses O(N) announcements as N
+# peers join, rather than a full-list shout from every peer on every ENTER.
+KEYS_FULL_KEY = "peer.keys"
+KEYS_DELTA_KEY = "key.announce"
+KEYS_FETCH_KEY = "key.fetch"
+
+
+def keys_digest(keys: Sequence[str]) -> str:
+    """Short digest of an announced key list; order matters, as key ids index into it."""
+    return hashlib.blake2b("\n".join(keys).encode(), digest_size=8).hexdigest()
+
+
+def apply_delta(keys: Optional[Sequence[str]], version: Optional[int], delta: dict) -> Optional[list]:
+    """Return keys with delta applied, or None if the full list must be fetched."""
+    if keys is None or version is None or delta.get("version") != version + 1:
+        return None
+    updated = list(keys) + list(delta.get("added", []))
+    if keys_digest(updated) != delta.get("digest"):
+        return None
+    return updated
@@ -0,0 +1,156 @@
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+WILDCARD = "*"
+PREFIX_SUFFIX = ".*"
+
+# How send_to_key() picks among the peers providing a key
+BALANCE_POLICIES = {"least_outstanding", "latency"}
+LATENCY_EWMA_ALPHA = 0.2
+
+
+@dataclass(frozen=True)
+class Route:
+    pattern: str                    # "camera.expose", "camera.*" or "*"
+    handler: Callable
+    streaming: bool = False         # Dispatch chunked blobs as msg.stream
+    executor: str = "thread"        # "thread" (worker threads) or "process" (process pool)
+
+
+class _RouteTable:
+    __slots__ = ("exact", "prefixes", "fallback")
+
+    def __init__(self, exact: Dict[str, Route], prefixes: Dict[str, Route], fallback: Optional[Route]):
+        self.exact = exact
+        self.prefixes = prefixes
+        self.fallback = fallback
+
+
+def is_pattern(key: str) -> bool:
+    return key == WILDCARD or key.endswith(PREFIX_SUFFIX)
+
+
+class KeyRouter:
+    """Compiled index from message keys to routes.
+
+    Patterns are exact keys, "prefix.*" (any key below prefix, at any depth)
+    and "*". Precedence: exact match, then the longest matching prefix, then
+    "*". Lookups hash the key and then each of its dotted prefixes, so cost
+    grows with key length, not with the number of routes. The table is
+    rebuilt on change and swapped in with one assignment, so lookups never
+    take a lock or see a half-built index.
+    """
+
+    def __init__(self, routes: Iterable[Route] = ()):
+        self._lock = threading.Lock()
+        self._routes: Dict[str, Route] = {}
+        self._table = _RouteTable({}, {}, None)
+        for route in routes:
+            self.add(route)
+
+    def add(self, route: Route):
+        with self._lock:
+            self._routes[route.pattern] = route
+            self._table = self._compile(self._routes)
+
+    def remove(self, pattern: str):
+        with self._lock:
+            if self._routes.pop(pattern, None) is not None:
+                self._table = self._compile(self._routes)
+
+    @staticmethod
+    def _compile(routes: Dict[str, Route]) -> _RouteTable:
+        exact, prefixes, fallback = {}, {}, None
+        for pattern, route in routes.items():
+            if pattern == WILDCARD:
+                fallback = route
+            elif pattern.endswith(PREFIX_SUFFIX):
+                prefixes[pattern[:-len(PREFIX_SUFFIX)]] = route
+            else:
+                exact[pattern] = route
+        return _RouteTable(exact, prefixes, fallback)
+
+    def lookup(self, key: str) -> Optional[Route]:
+        table = self._table
+        route = table.exact.get(key)
+        if route is not None:
+            return route
+        if table.prefixes:
+            end = key.rfind(".")
+            while end > 0:
+                route = table.prefixes.get(key[:end])
+                if route is not None:
+                    return route
+                end = key.rfind(".", 0, end)
+        return table.fallback
+
+    def __contains__(self, pattern: str) -> bool:
+        return pattern in self._routes
+
+    def __len__(self) -> int:
+        return len(self._routes)
+
+
+class ProviderIndex:
+    """Reverse index from message keys to the peers that handle them.
+
+    Built from the key lists peers announce in "peer.keys", which may hold
+    patterns. providers() applies the same precedence as KeyRouter, so a
+    key goes to the peers with an exact handler if there are any, else to
+    those with the longest matching prefix, else to "*" catch-alls.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: Dict[str, List[str]] = {}
+        self._exact: Dict[str, Set[str]] = {}
+        self._prefixes: Dict[str, Set[str]] = {}
+        self._fallback: Set[str] = set()
+
+    def set_keys(self, peer_id: str, keys: Iterable[str]):
+        """Record the full key list peer_id announced, replacing any earlier one."""
+        with self._lock:
+            self._drop(peer_id)
+            keys = list(keys)
+            self._keys[peer_id] = keys
+            for key in keys:
+                self._index_for(key).add(peer_id)
+
+    def drop(self, peer_id: str):
+        with self._lock:
+            self._drop(peer_id)
+
+    def _index_for(self, key: str) -> Set[str]:
+        if key == WILDCARD:
+            return self._fallback
+        if key.endswith(PREFIX_SUFFIX):
+            return self._prefixes.setdefault(key[:-len(PREFIX_SUFFIX)], set())
+        return self._exact.setdefault(key, set())
+
+    def _drop(self, peer_id: str):
+        # Called with the lock held
+        for key in self._keys.pop(peer_id, ()):
+            peers = self._index_for(key)
+            peers.discard(peer_id)
+            if not peers and key != WILDCARD:
+                if key.endswith(PREFIX_SUFFIX):
+                    del self._prefixes[key[:-len(PREFIX_SUFFIX)]]
+                else:
+                    del self._exact[key]
+
+    def providers(self, key: str) -> List[str]:
+        with self._lock:
+            peers = self._exact.get(key)
+            if peers:
+                return list(peers)
+            end = key.rfind(".")
+            while end > 0:
+                peers = self._prefixes.get(key[:end])
+                if peers:
+                    return list(peers)
+                end = key.rfind(".", 0, end)
+            return list(self._fallback)
+
+    def keys(self, peer_id: str) -> List[str]:
+        return list(self._keys.get(peer_id, ()))
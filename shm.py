@@ -0,0 +1,163 @@
+import collections
+import socket
+import threading
+import time
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional, Set, Tuple
+
+from buffers import Blob, BufferPin, blob_nbytes, frame_view
+
+# Same-host blob handoff
+#
+# A blob sent to peers on the same host is copied once into a
+# multiprocessing.shared_memory segment, and only a handle travels: the
+# caller's json_data plus a reserved SHM_META entry {"name", "size"} and no
+# blob frame. Receivers map the segment and hand handlers a read-only view
+# of it. Once a receiver drops the last reference to that view it whispers
+# SHM_RELEASE_KEY back; the sender unlinks a segment when every receiver
+# has released it, when they have all left, or after a TTL, whichever
+# comes first.
+SHM_META = "_shm"
+SHM_RELEASE_KEY = "shm.release"
+SHM_FEATURE = "shm"
+
+DEFAULT_SHM_THRESHOLD = 1024 * 1024
+DEFAULT_SHM_TTL = 60.0
+
+_host_id: Optional[str] = None
+_created_here: Set[str] = set()   # Segments this process created, and its resource tracker owns
+
+
+def host_id() -> str:
+    """Identifier shared by processes that can map each other's shared memory.
+
+    The machine id alone is not enough: containers on one machine share it
+    but not /dev/shm, and they do get their own hostname.
+    """
+    global _host_id
+    if _host_id is None:
+        machine = ""
+        for path in ("/etc/machine-id", "/var/lib/dbus/machine-id"):
+            try:
+                with open(path) as f:
+                    machine = f.read().strip()
+                break
+            except OSError:
+                continue
+        _host_id = f"{socket.gethostname()}/{machine}"
+    return _host_id
+
+
+class _Segment:
+    __slots__ = ("shm", "holders", "expires")
+
+    def __init__(self, shm: shared_memory.SharedMemory, holders: Set[str], expires: float):
+        self.shm = shm
+        self.holders = holders
+        self.expires = expires
+
+
+class SharedBlobExporter:
+    """Sender side: owns the segments this node has handed out."""
+
+    def __init__(self, ttl: float = DEFAULT_SHM_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._segments: Dict[str, _Segment] = {}
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    def export(self, blob: Blob, holders: Set[str]) -> dict:
+        """Copy blob into a new segment held by the given peers; returns its handle."""
+        size = blob_nbytes(blob)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        shm.buf[:size] = memoryview(blob).cast("B")
+        now = time.monotonic()
+        with self._lock:
+            _created_here.add(shm.name)
+            self._segments[shm.name] = _Segment(shm, set(holders), now + self.ttl)
+            self._expire(now)
+        return {"name": shm.name, "size": size}
+
+    def release(self, peer_id: str, names: List[str]):
+        with self._lock:
+            for name in names:
+                segment = self._segments.get(name)
+                if segment is not None:
+                    segment.holders.discard(peer_id)
+                    if not segment.holders:
+                        self._unlink(name)
+            self._expire(time.monotonic())
+
+    def drop_peer(self, peer_id: str):
+        with self._lock:
+            for name, segment in list(self._segments.items()):
+                segment.holders.discard(peer_id)
+                if not segment.holders:
+                    self._unlink(name)
+
+    def stop(self):
+        with self._lock:
+            for name in list(self._segments):
+                self._unlink(name)
+
+    def _expire(self, now: float):
+        # Called with the lock held
+        for name, segment in list(self._segments.items()):
+            if segment.expires <= now:
+                self._unlink(name)
+
+    def _unlink(self, name: str):
+        # Called with the lock held; receivers that still map it keep their pages
+        segment = self._segments.pop(name)
+        _created_here.discard(name)
+        segment.shm.close()
+        try:
+            segment.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _detach(shm: shared_memory.SharedMemory, pin: BufferPin, releases: collections.deque, peer_id: str):
+    # Runs whenever the last view of the blob is collected, on whatever thread
+    # that happens, so it only unmaps and records; the release is sent later.
+    pin.release()
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    releases.append((peer_id, shm.name))
+
+
+class _Lease:
+    """Kept alive by every view of an attached blob; its collection triggers _detach."""
+    __slots__ = ("__weakref__",)
+
+
+class SharedBlobImporter:
+    """Receiver side: maps segments and collects the releases owed to their senders."""
+
+    def __init__(self):
+        self._releases: collections.deque = collections.deque()
+
+    def attach(self, handle: dict, peer_id: str) -> memoryview:
+        """Map the segment behind handle as a read-only view of the blob."""
+        shm = shared_memory.SharedMemory(name=handle["name"])
+        if shm.name not in _created_here:
+            # Attaching registers the segment with our resource tracker, which
+            # would unlink it at exit; the sender owns it.
+            resource_tracker.unregister(shm._name, "shared_memory")
+        size = handle["size"]
+        pin = BufferPin(shm.buf)
+        lease = _Lease()
+        weakref.finalize(lease, _detach, shm, pin, self._releases, peer_id)
+        return frame_view(pin.address, size, lease)
+
+    def drain(self) -> List[Tuple[str, str]]:
+        """Pop the (peer_id, name) releases recorded since the last call."""
+        released = []
+        while self._releases:
+            released.append(self._releases.popleft())
+        return released
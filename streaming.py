@@ -0,0 +1,342 @@
+import collections
+import itertools
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from message import Message
+
+# Chunked blob transfer
+#
+# A streamed message goes out as a header message carrying the caller's
+# json_data plus a reserved STREAM_META entry (no blob), followed by one
+# STREAM_CHUNK_KEY message per chunk. Whisper streams are flow controlled:
+# the sender starts with `window` credits and the receiver returns credit
+# with STREAM_CREDIT_KEY as its consumer drains chunks. Shout streams have
+# many receivers, so they are paced at shout_rate bytes/s instead, and
+# receivers bound their buffer: a shout streaming handler must keep up
+# with that rate or its stream is dropped.
+STREAM_META = "_stream"
+STREAM_CHUNK_KEY = "stream.chunk"
+STREAM_CREDIT_KEY = "stream.credit"
+STREAM_FEATURE = "stream"
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+DEFAULT_WINDOW = 16
+DEFAULT_MAX_STREAM_SIZE = 1024 * 1024 * 1024
+DEFAULT_MAX_REASSEMBLY = 2 * DEFAULT_MAX_STREAM_SIZE   # Bytes all streams being reassembled may hold
+SHOUT_BUFFER_FACTOR = 4   # Shout receivers buffer up to window * this many chunks
+DEFAULT_SHOUT_RATE = 32 * 1024 * 1024   # Bytes/s per shout stream
+
+
+class StreamError(RuntimeError):
+    pass
+
+
+class OutgoingStream:
+    """Sender-side state of one chunked transfer; wait() blocks until it is fully sent."""
+
+    def __init__(self, stream_id: str, msg: Message, peer_id: Optional[str], chunk_size: int, window: int,
+                 shout_rate: float = DEFAULT_SHOUT_RATE):
+        self.stream_id = stream_id
+        self.msg = msg
+        self.peer_id = peer_id                  # None for shouts
+        self._view = memoryview(msg.binary_blob).cast("B")
+        self.size = self._view.nbytes
+        self.chunk_size = chunk_size
+        self.chunks = max(1, -(-self.size // chunk_size))
+        self.next_seq = 0
+        self.credit = window if peer_id else None
+        # Shouts: the next chunk is due at `due`, chunks go out `interval` seconds apart
+        self.interval = None if peer_id else chunk_size / shout_rate
+        self.due = time.monotonic()
+        self.last_progress = self.due
+        self.error: Optional[Exception] = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.next_seq >= self.chunks
+
+    def meta(self) -> dict:
+        return {"id": self.stream_id, "size": self.size, "chunks": self.chunks, "chunk_size": self.chunk_size}
+
+    def take_chunk(self):
+        seq = self.next_seq
+        offset = seq * self.chunk_size
+        self.next_seq += 1
+        if self.credit is not None:
+            self.credit -= 1
+        else:
+            # From now if we fell behind, so a stalled sender doesn't catch up in a burst
+            self.due = max(self.due, time.monotonic()) + self.interval
+        return seq, self._view[offset:offset + self.chunk_size]
+
+    def ready(self, now: float) -> bool:
+        return self.credit > 0 if self.credit is not None else self.due <= now
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn: Callable[["OutgoingStream"], None]):
+        """Call fn(stream) once the stream completes (immediately if it already has)."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _complete(self, error: Optional[Exception] = None):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class StreamSender:
+    """Sends chunks of all open outgoing streams round-robin from one thread."""
+
+    def __init__(self, coms: "MessageComs", chunk_size: int = DEFAULT_CHUNK_SIZE, window: int = DEFAULT_WINDOW,
+                 timeout: float = 30.0, shout_rate: float = DEFAULT_SHOUT_RATE):
+        if shout_rate <= 0:
+            raise ValueError(f"Invalid shout_rate: {shout_rate}. Must be positive")
+        self.coms = coms
+        self.chunk_size = chunk_size
+        self.window = window
+        self.timeout = timeout
+        self.shout_rate = shout_rate
+        self._cond = threading.Condition()
+        self._streams: Dict[str, OutgoingStream] = {}
+        self._ids = itertools.count(1)
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def open(self, msg: Message, peer_id: Optional[str]) -> OutgoingStream:
+        stream = OutgoingStream(str(next(self._ids)), msg, peer_id, self.chunk_size, self.window, self.shout_rate)
+        header = msg.replace(json_data={**msg.json_data, STREAM_META: stream.meta()}, binary_blob=None)
+        # Sent from the caller's thread so the header is ordered before every chunk
+        self.coms._send_now(header, peer_id)
+        with self._cond:
+            self._streams[stream.stream_id] = stream
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self._send_loop, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return stream
+
+    def grant(self, peer_id: str, stream_id: str, credit: int):
+        with self._cond:
+            stream = self._streams.get(stream_id)
+            if stream is not None and stream.peer_id == peer_id:
+                stream.credit += credit
+                stream.last_progress = time.monotonic()
+                self._cond.notify()
+
+    def drop_peer(self, peer_id: str):
+        with self._cond:
+            for stream_id, stream in list(self._streams.items()):
+                if stream.peer_id == peer_id:
+                    del self._streams[stream_id]
+                    stream._complete(StreamError(f"Peer {peer_id} left during stream {stream_id}"))
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            for stream in self._streams.values():
+                stream._complete(StreamError("MessageComs stopped"))
+            self._streams.clear()
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _expire(self, now: float):
+        for stream_id, stream in list(self._streams.items()):
+            if now - stream.last_progress > self.timeout:
+                del self._streams[stream_id]
+                stream._complete(StreamError(f"Stream {stream_id} stalled waiting for credit"))
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                ready = []
+                while self._running:
+                    now = time.monotonic()
+                    ready = [s for s in self._streams.values() if s.ready(now)]
+                    if ready:
+                        break
+                    # Until the next shout chunk is due, or credit arrives
+                    due = [s.due for s in self._streams.values() if s.credit is None]
+                    self._cond.wait(min(0.5, max(0.0, min(due) - now)) if due else 0.5)
+                    self._expire(time.monotonic())
+                if not self._running:
+                    return
+                # One chunk per stream per round keeps concurrent streams interleaved
+                batch = [(stream, stream.take_chunk()) for stream in ready]
+
+            for stream, (seq, chunk) in batch:
+                msg = Message(
+                    coms=self.coms,
+                    sender_id=self.coms.uuid,
+                    msg_type=stream.msg.msg_type,
+                    req_id=stream.msg.req_id,
+                    key=STREAM_CHUNK_KEY,
+                    json_data={"stream": stream.stream_id, "seq": seq},
+                    binary_blob=chunk,
+                    destination=stream.msg.destination
+                )
+                try:
+                    self.coms._send_now(msg, stream.peer_id)
+                except Exception as e:
+                    with self._cond:
+                        self._streams.pop(stream.stream_id, None)
+                    stream._complete(e)
+                    continue
+                stream.last_progress = time.monotonic()
+                if stream.finished:
+                    with self._cond:
+                        self._streams.pop(stream.stream_id, None)
+                    stream._complete()
+
+            # Let callers sending small messages get the GIL between rounds
+            time.sleep(0)
+
+
+def check_meta(meta: dict, max_size: int = DEFAULT_MAX_STREAM_SIZE, available: Optional[int] = None):
+    """Raise StreamError unless a peer's STREAM_META describes a stream we can
+    take; with available given, the stream must also fit in that many bytes."""
+    try:
+        stream_id, size, chunks, chunk_size = meta["id"], meta["size"], meta["chunks"], meta["chunk_size"]
+    except (KeyError, TypeError):
+        raise StreamError(f"Malformed stream header: {meta!r}") from None
+    if not all(type(value) is int for value in (size, chunks, chunk_size)) or not isinstance(stream_id, str):
+        raise StreamError(f"Malformed stream header: {meta!r}")
+    if not 0 <= size <= max_size:
+        raise StreamError(f"Stream {stream_id} of {size}B is over the {max_size}B limit")
+    if chunk_size < 1 or chunks != max(1, -(-size // chunk_size)):
+        raise StreamError(f"Stream {stream_id}: {chunks} chunks of {chunk_size}B can't make {size}B")
+    if available is not None and size > available:
+        raise StreamError(f"Stream {stream_id} of {size}B is over the {available}B left for reassembly")
+
+
+class _IncomingStream:
+    def __init__(self, header: Message, meta: dict, window: int, grant: Optional[Callable[[int], None]],
+                 max_size: int = DEFAULT_MAX_STREAM_SIZE, available: Optional[int] = None):
+        check_meta(meta, max_size, available)
+        self.header = header
+        self.stream_id = meta["id"]
+        self.size = meta["size"]
+        self.chunks = meta["chunks"]
+        self.next_seq = 0
+        self.received = 0          # Bytes fed so far
+        self._window = window
+        self._grant = grant        # Returns credit to the sender; None for shouts
+        self._owed = 0
+
+    def _consumed(self, count: int = 1):
+        if self._grant is None:
+            return
+        self._owed += count
+        if self._owed >= max(1, self._window // 2):
+            owed, self._owed = self._owed, 0
+            self._grant(owed)
+
+    def _check_chunk(self, seq: int, chunk):
+        # Called before a chunk is stored; a stream must add up to its declared size
+        if seq != self.next_seq:
+            raise StreamError(f"Stream {self.stream_id}: expected chunk {self.next_seq}, got {seq}")
+        if chunk is None:
+            raise StreamError(f"Stream {self.stream_id}: chunk {seq} carries no data")
+        received = self.received + len(chunk)
+        if received > self.size:
+            raise StreamError(f"Stream {self.stream_id} overran its declared size")
+        if seq == self.chunks - 1 and received != self.size:
+            raise StreamError(f"Stream {self.stream_id} ended after {received} of {self.size}B")
+        self.next_seq += 1
+        self.received = received
+
+    @property
+    def complete(self) -> bool:
+        return self.next_seq >= self.chunks
+
+
+class BlobAssembler(_IncomingStream):
+    """Reassembles a stream into one bytearray for handlers that want the whole blob."""
+
+    def __init__(self, header: Message, meta: dict, window: int, grant: Optional[Callable[[int], None]],
+                 max_size: int = DEFAULT_MAX_STREAM_SIZE, available: Optional[int] = None):
+        # Validates size before we allocate it
+        super().__init__(header, meta, window, grant, max_size, available)
+        self.buffer = bytearray(self.size)
+
+    def feed(self, seq: int, chunk) -> bool:
+        """Store a chunk; returns True once the blob is complete."""
+        start = self.received
+        self._check_chunk(seq, chunk)
+        self.buffer[start:self.received] = chunk
+        if not self.complete:
+            self._consumed()
+        return self.complete
+
+    def abort(self, exc: Exception):
+        pass
+
+
+class BlobStream(_IncomingStream):
+    """Receiving end of a chunked blob, handed to streaming handlers as msg.stream.
+
+    Iterate to consume chunks in order. Chunks are buffered up to the flow
+    control window; credit goes back to the sender as they are consumed.
+    """
+
+    def __init__(self, header: Message, meta: dict, window: int, grant: Optional[Callable[[int], None]],
+                 timeout: float = 30.0, max_size: int = DEFAULT_MAX_STREAM_SIZE):
+        super().__init__(header, meta, window, grant, max_size)
+        self.timeout = timeout
+        self._limit = window if grant is not None else window * SHOUT_BUFFER_FACTOR
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._error: Optional[Exception] = None
+
+    def feed(self, seq: int, chunk) -> bool:
+        with self._cond:
+            self._check_chunk(seq, chunk)
+            if len(self._buffer) >= self._limit:
+                raise StreamError(f"Stream {self.stream_id} exceeded its {self._limit}-chunk buffer")
+            self._buffer.append(chunk)
+            self._cond.notify()
+        return self.complete
+
+    def abort(self, exc: Exception):
+        with self._cond:
+            self._error = exc
+            self._cond.notify()
+
+    def __iter__(self):
+        consumed = 0
+        while consumed < self.chunks:
+            with self._cond:
+                if not self._buffer and self._error is None:
+                    self._cond.wait_for(lambda: self._buffer or self._error is not None, self.timeout)
+                if self._buffer:
+                    chunk = self._buffer.popleft()
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    raise StreamError(f"Stream {self.stream_id} timed out after {consumed}/{self.chunks} chunks")
+            consumed += 1
+            if consumed < self.chunks:
+                self._consumed()
+            yield chunk
+
+    def read_all(self) -> bytearray:
+        data = bytearray()
+        for chunk in self:
+            data += chunk
+        return data
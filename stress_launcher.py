@@ -1,11 +1,32 @@
+import argparse
 import multiprocessing
+import os
 import time
-from peer_node import PeerNode  # assuming local import, not subprocess
+from binlog import ColumnarLogWriter
+from executors import SharedWorkerPool
+from peer_node import LOG_COLUMNS, PeerNode  # assuming local import, not subprocess
+from transport import LoopbackHub, LoopbackTransport
 
 RUN_TIME_MINUTES = 30
 GROUP_NAME = "mktl-perf"
 ROLES = ["small", "medium", "large", "x-large"]
 PEERS_PER_ROLE = 25
+POOL_THREADS = 8
+TICK_INTERVAL = 0.1  # seconds, as in PeerNode.run()
+
+# Launch modes
+#
+# "process" starts one process per PeerNode, each with its own interpreter,
+# receive thread, worker threads and log, staggered to ease startup.
+# "hosted" spreads the nodes over one process per core. Each process hosts
+# its share of nodes with one SharedWorkerPool and one log file between
+# them (logs/host-N.mlog; the node column says which node wrote a row) and
+# ticks them all from a single loop. Processes are forked from the
+# launcher, so they start with everything already imported, and nodes
+# start without a stagger. Receive threads are still one per node.
+MODES = {"process", "hosted"}
+TRANSPORTS = {"zyre", "loopback"}
+
 
 def launch_peer(index, role):
     node = PeerNode(
@@ -16,20 +37,54 @@ def launch_peer(index, role):
     )
     node.run()
 
-if __name__ == "__main__":
-    print(f"[launcher] Launching {PEERS_PER_ROLE * len(ROLES)} nodes...")
+
+def host_peers(host, specs, minutes, pool_threads, transport, log_dir="logs"):
+    """Run the (name, role) nodes in specs in this process until minutes have passed."""
+    os.makedirs(log_dir, exist_ok=True)
+    pool = SharedWorkerPool(pool_threads)
+    log = ColumnarLogWriter(os.path.join(log_dir, f"host-{host}.mlog"), LOG_COLUMNS)
+    hub = LoopbackHub() if transport == "loopback" else None
+    nodes = []
+    try:
+        for name, role in specs:
+            nodes.append(PeerNode(name, GROUP_NAME, role, log_dir, log=log, worker_pool=pool,
+                                  transport=LoopbackTransport(name, hub) if hub is not None else None))
+        for node in nodes:
+            node.start()
+        print(f"[launcher] Host {host} (pid {os.getpid()}) running {len(nodes)} nodes")
+        deadline = time.time() + minutes * 60
+        while time.time() < deadline:
+            now = time.time()
+            for node in nodes:
+                node.tick(now)
+            time.sleep(TICK_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for node in nodes:
+            node._shutdown()
+        pool.stop()
+        log.close()
+
+
+def node_specs(count):
+    """(name, role) of count nodes, roles taken in turn."""
+    return [(f"{ROLES[i % len(ROLES)]}-node-{i // len(ROLES)}", ROLES[i % len(ROLES)]) for i in range(count)]
+
+
+def run_processes(nodes, minutes):
+    print(f"[launcher] Launching {nodes} nodes...")
     processes = []
 
-    for role in ROLES:
-        for i in range(PEERS_PER_ROLE):
-            p = multiprocessing.Process(target=launch_peer, args=(i, role))
-            p.start()
-            processes.append(p)
-            time.sleep(0.2)  # stagger to reduce startup contention
+    for index, (_, role) in enumerate(node_specs(nodes)):
+        p = multiprocessing.Process(target=launch_peer, args=(index // len(ROLES), role))
+        p.start()
+        processes.append(p)
+        time.sleep(0.2)  # stagger to reduce startup contention
 
-    print(f"[launcher] All nodes started. Running for {RUN_TIME_MINUTES} minutes...")
+    print(f"[launcher] All nodes started. Running for {minutes} minutes...")
     try:
-        time.sleep(RUN_TIME_MINUTES * 60)
+        time.sleep(minutes * 60)
     except KeyboardInterrupt:
         print("[launcher] Keyboard interrupt received. Terminating processes...")
 
@@ -39,3 +94,56 @@ if __name__ == "__main__":
         p.join()
 
     print("[launcher] All nodes shut down.")
+
+
+def run_hosted(nodes, minutes, processes, pool_threads, transport):
+    if transport == "loopback" and processes != 1:
+        # A LoopbackHub only connects nodes within one process
+        print("[launcher] Loopback transport: hosting all nodes in one process")
+        processes = 1
+    specs = node_specs(nodes)
+    shares = [specs[i::processes] for i in range(processes)]
+    if processes == 1:
+        host_peers(0, shares[0], minutes, pool_threads, transport)
+        return
+
+    # Fork where we can: children start with the modules already imported
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+    print(f"[launcher] Hosting {nodes} nodes in {processes} processes for {minutes} minutes...")
+    hosts = [context.Process(target=host_peers, args=(i, share, minutes, pool_threads, transport))
+             for i, share in enumerate(shares) if share]
+    for p in hosts:
+        p.start()
+    try:
+        for p in hosts:
+            p.join()
+    except KeyboardInterrupt:
+        # The hosts got the interrupt too, and are shutting their nodes down
+        print("[launcher] Keyboard interrupt received. Waiting for hosts to shut down...")
+        for p in hosts:
+            p.join()
+    print("[launcher] All nodes shut down.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Launch many PeerNodes for a stress test")
+    parser.add_argument("--mode", default="process", choices=sorted(MODES))
+    parser.add_argument("--nodes", type=int, default=PEERS_PER_ROLE * len(ROLES))
+    parser.add_argument("--minutes", type=float, default=RUN_TIME_MINUTES)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="Host processes in hosted mode (default: one per core)")
+    parser.add_argument("--pool-threads", type=int, default=POOL_THREADS,
+                        help="Shared worker threads per host process")
+    parser.add_argument("--transport", default="zyre", choices=sorted(TRANSPORTS),
+                        help="Hosted mode only; loopback keeps all nodes in one process")
+    args = parser.parse_args()
+
+    if args.mode == "process":
+        run_processes(args.nodes, args.minutes)
+    else:
+        run_hosted(args.nodes, args.minutes, args.processes, args.pool_threads, args.transport)
+
+
+if __name__ == "__main__":
+    main()
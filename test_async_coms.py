@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+import pytest
+
+from async_coms import AsyncMessageComs
+from correlation import RemoteError
+from message import MessageBuilder
+from test_executors import checksum
+from test_transport import GROUP_NAME
+from transport import LoopbackHub, LoopbackTransport
+
+
+async def wait_for(predicate, timeout=2.0):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return predicate()
+
+
+async def start_pair():
+    hub = LoopbackHub()
+    server = AsyncMessageComs("server", GROUP_NAME, transport=LoopbackTransport("server", hub))
+    client = AsyncMessageComs("client", GROUP_NAME, transport=LoopbackTransport("client", hub))
+
+    async def slow_double(msg, peer):
+        await asyncio.sleep(0.05)
+        return {"value": msg.json_data["value"] * 2}
+
+    def fail(msg, peer):
+        raise ValueError("nope")
+
+    server.register_handler("math.double", slow_double)
+    server.register_handler("math.fail", fail)
+    await server.start()
+    await client.start()
+    assert await wait_for(lambda: server.uuid in client._peer_keys and client.uuid in server._peer_keys)
+    return client, server
+
+
+def test_concurrent_async_requests():
+    async def main():
+        client, server = await start_pair()
+        # 1000 handlers sleeping 50ms each finish together because they run as tasks
+        replies = await asyncio.wait_for(
+            asyncio.gather(*(client.request("math.double", {"value": i}, server.uuid) for i in range(1000))),
+            timeout=5
+        )
+        assert [r.json_data["value"] for r in replies] == [i * 2 for i in range(1000)]
+
+        with pytest.raises(RemoteError):
+            await client.request("math.fail", {}, server.uuid)
+        with pytest.raises(asyncio.TimeoutError):
+            await client.request("math.double", {"value": 1}, "NO-SUCH-PEER", timeout=0.05)
+
+        await client.stop()
+        await server.stop()
+
+    asyncio.run(main())
+
+
+def test_process_handler_replies_from_the_loop():
+    async def main():
+        client, server = await start_pair()
+        server.register_handler("image.reduce", checksum, executor="process")
+        send_threads = set()
+        send = server.send
+        server.send = lambda msg, stream=None: send_threads.add(threading.get_ident()) or send(msg, stream)
+
+        replies = await asyncio.wait_for(asyncio.gather(
+            *(client.request("image.reduce", {"scale": i}, server.uuid, blob=b"\x01" * 1024) for i in range(8))
+        ), timeout=30)
+        assert sorted(r.json_data["scale"] for r in replies) == list(range(8))
+        assert send_threads == {threading.get_ident()}
+
+        await client.stop()
+        await server.stop()
+
+    # Debug mode makes the loop raise on calls from other threads
+    asyncio.run(main(), debug=True)
+
+
+def test_send_before_start_sends_nothing():
+    hub = LoopbackHub()
+    node = AsyncMessageComs("node", GROUP_NAME, transport=LoopbackTransport("node", hub))
+    sent = []
+    node.transport.shout = lambda group, frames: sent.append(frames)
+    msg = MessageBuilder(node).with_type("shout").with_key("peer.status").with_json_data({}).build()
+    with pytest.raises(RuntimeError):
+        node.send(msg)
+    assert sent == []
+    node.transport.stop()
+
+
+def test_handlers_can_respond_from_other_threads():
+    async def main():
+        client, server = await start_pair()
+
+        def respond_later(msg, peer):
+            threading.Thread(target=msg.respond, args=({"from": "thread"},)).start()
+
+        server.register_handler("math.later", respond_later)
+        replies = await asyncio.wait_for(asyncio.gather(
+            *(client.request("math.later", {}, server.uuid) for _ in range(8))
+        ), timeout=5)
+        assert [r.json_data["from"] for r in replies] == ["thread"] * 8
+
+        await client.stop()
+        await server.stop()
+
+    # Debug mode makes the loop raise on calls from other threads
+    asyncio.run(main(), debug=True)
@@ -0,0 +1,14 @@
+from bench import HIGHER, LOWER, compare, result
+
+
+def test_compare_flags_slowdowns_in_either_direction():
+    baseline = {"results": {"micro.dispatch": result(1000, "ns/op", LOWER),
+                            "macro.small.w2.msgs_per_s": result(5000, "msg/s", HIGHER),
+                            "macro.small.w2.p99": result(0.010, "s", LOWER)}}
+    current = {"results": {"micro.dispatch": result(1300, "ns/op", LOWER),
+                           "macro.small.w2.msgs_per_s": result(4000, "msg/s", HIGHER),
+                           "macro.small.w2.p99": result(0.009, "s", LOWER),
+                           "micro.new": result(1, "ns/op", LOWER)}}
+    regressions = compare(baseline, current, threshold=0.15)
+    assert [name for name, *_ in regressions] == ["macro.small.w2.msgs_per_s", "micro.dispatch"]
+    assert compare(baseline, current, threshold=0.5) == []
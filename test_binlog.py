@@ -0,0 +1,72 @@
+import math
+import os
+
+import pytest
+
+from binlog import ColumnarLogReader, ColumnarLogWriter
+from test_transport import wait_for
+
+COLUMNS = [("msg_id", "str"), ("rtt", "f64"), ("peer", "sym"), ("seq", "i64")]
+
+
+def test_blocks_round_trip_through_the_mapped_reader(tmp_path):
+    path = str(tmp_path / "node.mlog")
+    with ColumnarLogWriter(path, COLUMNS, block_rows=3, flush_interval=None) as log:
+        for i in range(7):
+            log.append(f"id-{i}", i / 2 if i % 2 else None, f"peer-{i % 2}", i)
+        log.write({"msg_id": "ünïcode", "peer": "peer-2"})
+
+    with ColumnarLogReader(path) as reader:
+        assert len(reader) == 8
+        assert reader.symbols == ["peer-0", "peer-1", "peer-2"]
+        assert [len(block["seq"]) for block in reader.blocks()] == [3, 3, 2]
+        columns = reader.to_dict()
+        assert columns["msg_id"][-1] == "ünïcode"
+        assert columns["peer"][:3] == ["peer-0", "peer-1", "peer-0"]
+        assert columns["seq"] == [0, 1, 2, 3, 4, 5, 6, 0]
+        assert math.isnan(columns["rtt"][0]) and columns["rtt"][3] == 1.5
+
+        reader.to_csv(str(tmp_path / "node.csv"))
+    lines = (tmp_path / "node.csv").read_text().splitlines()
+    assert lines[:3] == ["msg_id,rtt,peer,seq", "id-0,,peer-0,0", "id-1,0.5,peer-1,1"]
+
+
+def test_partly_written_block_is_ignored(tmp_path):
+    path = str(tmp_path / "node.mlog")
+    with ColumnarLogWriter(path, COLUMNS, block_rows=2, flush_interval=None) as log:
+        for i in range(4):
+            log.append("x", 0.1, "p", i)
+    os.truncate(path, os.path.getsize(path) - 4)
+    with ColumnarLogReader(path) as reader:
+        assert reader.column("seq") == [0, 1]
+
+
+def test_periodic_flush_and_schema_checks(tmp_path):
+    path = str(tmp_path / "node.mlog")
+    log = ColumnarLogWriter(path, COLUMNS, flush_interval=0.05)
+    log.append("x", 0.1, "p", 1)
+
+    def readable():
+        with ColumnarLogReader(path) as reader:
+            return len(reader) == 1
+    assert wait_for(readable)
+    with pytest.raises(ValueError):
+        log.append("too", "few")
+    log.close()
+
+    with pytest.raises(ValueError):
+        ColumnarLogWriter(str(tmp_path / "bad.mlog"), [("rtt", "f32")])
+
+
+def test_rejected_record_leaves_no_partial_row(tmp_path):
+    path = str(tmp_path / "node.mlog")
+    with ColumnarLogWriter(path, COLUMNS, block_rows=2, flush_interval=None) as log:
+        log.append("a", 0.5, "p", 1)
+        with pytest.raises(ValueError):
+            log.append("b", 0.25, "q", "abc")
+        with pytest.raises(OverflowError):
+            log.append("b", 0.25, "q", 1 << 64)
+        log.append("c", 1.5, "p", 3)
+    with ColumnarLogReader(path) as reader:
+        assert reader.to_dict() == {"msg_id": ["a", "c"], "rtt": [0.5, 1.5], "peer": ["p", "p"], "seq": [1, 3]}
+        assert reader.symbols == ["p"]
@@ -0,0 +1,101 @@
+from blobcache import BLOB_REF, BlobCache, blob_digest
+from message import MessageBuilder
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def test_cache_evicts_least_recently_used_by_bytes():
+    cache = BlobCache(max_bytes=100)
+    cache.put("a", b"a" * 40)
+    cache.put("b", bytearray(b"b" * 40))
+    assert cache.get("a") == b"a" * 40       # "b" is now least recently used
+    cache.put("c", b"c" * 40)
+    assert "b" not in cache
+    assert isinstance(cache.get("c"), bytes)
+    assert cache.nbytes == 80
+    cache.put("huge", b"h" * 101)
+    assert "huge" not in cache
+    assert cache.stats()["hits"] == 2
+
+
+def test_put_does_not_copy_a_cached_blob():
+    cache = BlobCache(max_bytes=100)
+    buffer = bytearray(b"a" * 40)
+    stored = cache.put("a", buffer)
+    buffer[:] = b"b" * 40
+    assert cache.put("a", buffer) is stored and cache.nbytes == 40
+
+
+def test_repeated_shouts_send_only_the_hash():
+    hub = LoopbackHub()
+    sender = MessageComs(name="sender", group=GROUP_NAME, transport=LoopbackTransport("sender", hub),
+                         blob_cache_bytes=1024 * 1024, blob_cache_threshold=1024)
+    receivers = [
+        MessageComs(name=f"receiver{i}", group=GROUP_NAME, transport=LoopbackTransport(f"receiver{i}", hub),
+                    blob_cache_bytes=1024 * 1024)
+        for i in range(2)
+    ]
+    received = []
+    for receiver in receivers:
+        receiver.register_handler("peer.status", lambda msg, s, r=receiver.transport.name: received.append(
+            (r, bytes(msg.binary_blob), msg.json_data)))
+    for node in [sender, *receivers]:
+        node.start()
+    assert wait_for(lambda: all(len(node._peer_keys) == 2 for node in [sender, *receivers]))
+
+    shouted = []
+    shout = sender.transport.shout
+    sender.transport.shout = lambda group, frames: (shouted.append(len(frames)), shout(group, frames))
+
+    status = bytes(range(256)) * 64
+
+    def send(seq):
+        sender.send(
+            MessageBuilder(sender)
+            .with_type("shout")
+            .with_key("peer.status")
+            .with_json_data({"seq": seq})
+            .with_binary_blob(status)
+            .build()
+        )
+
+    send(1)
+    assert wait_for(lambda: len(received) == 2)
+    send(2)
+    assert wait_for(lambda: len(received) == 4)
+    assert shouted == [3, 2]   # header, payload and blob; then header and payload only
+    assert all(blob == status for _, blob, _ in received)
+    assert sorted(data["seq"] for _, _, data in received) == [1, 1, 2, 2]
+
+    # A receiver that lost the blob fetches it from the sender
+    receivers[0]._blobs_in = BlobCache(1024 * 1024)
+    send(3)
+    assert wait_for(lambda: len(received) == 6)
+    assert [blob == status for name, blob, data in received if data["seq"] == 3] == [True, True]
+    assert blob_digest(status) in receivers[0]._blobs_in
+
+    # A message whose blob never comes is dropped once the fetch times out
+    receivers[1]._blobs_in = BlobCache(1024 * 1024)
+    receivers[1].blob_fetch_timeout = 0.2
+    sender._serve_blob = lambda msg, s: None
+    send(4)
+    assert wait_for(lambda: receivers[1]._blob_waiting)
+    assert wait_for(lambda: not receivers[1]._blob_waiting)
+    assert [name for name, _, data in received if data["seq"] == 4] == ["receiver0"]
+
+    for node in [sender, *receivers]:
+        node.stop()
+
+
+def test_inline_blob_with_the_wrong_hash_is_not_cached():
+    hub = LoopbackHub()
+    node = MessageComs(name="node", group=GROUP_NAME, transport=LoopbackTransport("node", hub),
+                       blob_cache_bytes=1024 * 1024)
+    claimed = blob_digest(b"real")
+    msg = (MessageBuilder(node).with_type("whisper").with_key("peer.status")
+           .with_json_data({BLOB_REF: {"hash": claimed, "size": 4}}).with_binary_blob(b"fake").build())
+    resolved = node._resolve_blob(msg, "peer")
+    assert bytes(resolved.binary_blob) == b"fake"
+    assert claimed not in node._blobs_in
+    node.transport.stop()
@@ -0,0 +1,48 @@
+import random
+
+from clock import ClockSync, PeerClock
+
+MS = 1_000_000
+
+
+def exchange(local_ns, offset, drift, out_delay, back_delay, service=50_000):
+    """Timestamps of one ping to a peer whose clock reads ours + offset + drift * time."""
+    peer = lambda t: t + offset + drift * t
+    t0 = local_ns
+    t1 = peer(t0 + out_delay)
+    t2 = t1 + service
+    t3 = t0 + out_delay + service + back_delay
+    return t0, int(t1), int(t2), t3
+
+
+def test_offset_and_drift_are_recovered_within_the_error_bound():
+    rng = random.Random(1)
+    clock = PeerClock()
+    offset, drift = 5 * MS, 50e-6
+    for i in range(64):
+        # Mostly symmetric 200us legs, with some exchanges delayed by queueing on one side
+        out_delay = 200_000 + (rng.randrange(20 * MS) if rng.random() < 0.5 else rng.randrange(20_000))
+        back_delay = 200_000 + rng.randrange(20_000)
+        clock.add(*exchange(i * 500 * MS, offset, drift, out_delay, back_delay))
+
+    estimate = clock.estimate()
+    true_offset = offset + drift * estimate.at_ns
+    assert abs(estimate.offset_ns - true_offset) <= estimate.error_ns
+    assert estimate.error_ns < 0.25 * MS     # About half the 400us round trip
+    assert abs(estimate.drift - drift) < 5e-6
+
+
+def test_one_way_latency_in_both_directions():
+    sync = ClockSync()
+    assert sync.one_way("peer", 0, 1) is None
+    for i in range(8):
+        sync.add("peer", *exchange(i * MS, 3 * MS, 0.0, 100_000, 100_000))
+    assert not sync.add("peer", 10, 0, 0, 5)    # Reply before request: a clock jumped, sample dropped
+
+    # Peer stamps 3ms ahead; a message that took 150us
+    latency, error = sync.one_way("peer", 50 * MS + 3 * MS, 50 * MS + 150_000)
+    assert abs(latency - 150_000) <= error
+    latency, error = sync.one_way("peer", 50 * MS, 50 * MS + 150_000 + 3 * MS, sent_by_peer=False)
+    assert abs(latency - 150_000) <= error
+    sync.drop("peer")
+    assert sync.estimate("peer") is None
@@ -0,0 +1,106 @@
+import os
+import zlib
+
+import pytest
+
+import compression
+from message import MessageBuilder
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def test_adaptive_compressor_backs_off_incompressible_keys():
+    compressor = compression.AdaptiveCompressor(threshold=1024)
+    text = b"x" * 100_000
+    blob, meta = compressor.compress("text", text, "zlib")
+    assert meta == {"name": "zlib", "size": len(text)}
+    assert compression.decompress(blob, meta) == text
+
+    noise = os.urandom(100_000)
+    assert compressor.compress("noise", noise, "zlib") == (noise, None)
+    # Once a key is known not to compress, it is only probed now and then
+    probes = sum(compressor._worth_it("noise") for _ in range(compression.PROBE_INTERVAL))
+    assert probes == 1
+
+    assert compressor.compress("text", b"x" * 100, "zlib")[1] is None   # Under threshold
+
+
+class ChunkStream(list):
+    stream_id = "1"
+
+
+def test_decompression_is_bounded_by_the_declared_size():
+    bomb = zlib.compress(bytes(64 * 1024 * 1024), 9)
+    for meta in ({"name": "zlib", "size": 1024}, {"name": "zlib", "size": "big"}, {"name": "zlib", "size": 1 << 40}):
+        with pytest.raises(compression.CodecError):
+            compression.decompress(bomb, meta, max_size=1 << 30)
+
+    chunks = ChunkStream([bomb[i:i + 1024] for i in range(0, len(bomb), 1024)])
+    stream = compression.DecompressingStream(chunks, {"name": "zlib", "size": 1024})
+    with pytest.raises(compression.CodecError):
+        stream.read_all()
+    with pytest.raises(compression.CodecError):
+        compression.DecompressingStream(stream, {"name": "zlib", "size": 1 << 40}, max_size=1 << 30)
+
+
+def test_zstd_frames_must_declare_the_expected_size():
+    zstandard = pytest.importorskip("zstandard")
+    frame = zstandard.ZstdCompressor().compress(bytes(4096))
+    assert compression.ZstdCodec().decompress(frame, 4096) == bytes(4096)
+    with pytest.raises(compression.CodecError):
+        compression.ZstdCodec().decompress(frame, 1024)
+    unsized = zstandard.ZstdCompressor(write_content_size=False).compress(bytes(4096))
+    with pytest.raises(compression.CodecError):
+        compression.ZstdCodec().decompress(unsized, 4096)
+
+
+def test_negotiate_codec_needs_every_receiver():
+    assert compression.negotiate_codec([["zlib"], ["zlib", "lz4"]]) == "zlib"
+    assert compression.negotiate_codec([["zlib"], []]) is None
+    assert compression.negotiate_codec([]) is None
+
+
+def test_blobs_are_compressed_on_the_wire_and_restored():
+    hub = LoopbackHub()
+    sender = MessageComs(name="sender", group=GROUP_NAME, transport=LoopbackTransport("sender", hub),
+                         compress_threshold=1024, stream_threshold=64 * 1024, chunk_size=16 * 1024)
+    receiver = MessageComs(name="receiver", group=GROUP_NAME, transport=LoopbackTransport("receiver", hub))
+    whole, streamed = [], []
+    receiver.register_handler("image.frame", lambda msg, s: whole.append((bytes(msg.binary_blob), msg.json_data)))
+    receiver.register_handler("image.stream", lambda msg, s: streamed.append(bytes(msg.stream.read_all())),
+                              streaming=True)
+    sender.start()
+    receiver.start()
+    assert wait_for(lambda: receiver.uuid in sender._peer_keys and sender.uuid in receiver._peer_keys)
+
+    wire_bytes = []
+    whisper = sender.transport.whisper
+    sender.transport.whisper = lambda peer_id, frames: (
+        wire_bytes.append(sum(len(f) for f in frames)), whisper(peer_id, frames))
+
+    def send(key, blob):
+        sender.send(
+            MessageBuilder(sender)
+            .with_type("whisper")
+            .with_key(key)
+            .with_destination(receiver.uuid)
+            .with_json_data({"seq": 1})
+            .with_binary_blob(blob)
+            .build()
+        )
+
+    small = b"y" * 32 * 1024
+    send("image.frame", small)
+    assert wait_for(lambda: whole)
+    assert whole[0] == (small, {"seq": 1})
+    assert sum(wire_bytes) < len(small) // 10
+
+    # Still over stream_threshold once compressed; a streaming handler reads plain data
+    big = b"".join(os.urandom(1024) + bytes(1024) for _ in range(256))
+    send("image.stream", big)
+    assert wait_for(lambda: streamed)
+    assert streamed[0] == big
+
+    sender.stop()
+    receiver.stop()
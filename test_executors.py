@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from executors import SharedWorkerPool
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def checksum(msg, sender):
+    return {"sum": sum(msg.binary_blob), "pid": os.getpid(), "scale": msg.json_data["scale"]}
+
+
+def test_process_handler_gets_blob_and_replies():
+    hub = LoopbackHub()
+    server = MessageComs(name="server", group=GROUP_NAME, transport=LoopbackTransport("server", hub),
+                         process_workers=2)
+    server.register_handler("image.reduce", checksum, executor="process")
+    client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub))
+    server.start()
+    client.start()
+    assert wait_for(lambda: server.uuid in client._peer_keys and client.uuid in server._peer_keys)
+
+    blob = bytearray(b"\x01" * (256 * 1024))
+    reply = client.request("image.reduce", {"scale": 2}, server.uuid, blob=blob).result(30)
+    assert reply.json_data["sum"] == len(blob)
+    assert reply.json_data["scale"] == 2
+    assert reply.json_data["pid"] != os.getpid()
+
+    client.stop()
+    server.stop()
+
+
+SHARED_BLOB_SCRIPT = """
+from test_executors import checksum
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+hub = LoopbackHub()
+server = MessageComs(name="server", group=GROUP_NAME, transport=LoopbackTransport("server", hub), process_workers=1)
+server.register_handler("image.reduce", checksum, executor="process")
+client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub))
+server.start()
+client.start()
+assert wait_for(lambda: server.uuid in client._peer_keys and client.uuid in server._peer_keys)
+# A small blob starts the pool before any segment exists
+for size in (16, 256 * 1024, 256 * 1024):
+    reply = client.request("image.reduce", {"scale": 1}, server.uuid, blob=bytes(size)).result(30)
+    assert reply.json_data["sum"] == 0
+client.stop()
+server.stop()
+"""
+
+
+def test_shared_blobs_leave_no_resource_tracker_warnings():
+    result = subprocess.run([sys.executable, "-c", SHARED_BLOB_SCRIPT], capture_output=True, text=True, timeout=60,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert result.returncode == 0, result.stderr
+    assert "resource_tracker" not in result.stderr
+
+
+def test_process_handlers_must_be_picklable():
+    hub = LoopbackHub()
+    node = MessageComs(name="node", transport=LoopbackTransport("node", hub))
+    with pytest.raises(ValueError):
+        node.register_handler("image.reduce", lambda msg, sender: None, executor="process")
+    with pytest.raises(ValueError):
+        node.register_handler("image.reduce", checksum, executor="gpu")
+    node.transport.stop()
+
+
+def test_nodes_share_one_worker_pool():
+    hub = LoopbackHub()
+    pool = SharedWorkerPool(threads=2)
+    nodes = [MessageComs(name=f"node-{i}", group=GROUP_NAME, transport=LoopbackTransport(f"node-{i}", hub),
+                         worker_pool=pool) for i in range(5)]
+    for node in nodes:
+        node.register_handler("perf.echo", lambda msg, sender: {"thread": threading.current_thread().name})
+        node.start()
+    assert all(not node._worker_threads for node in nodes)
+    assert wait_for(lambda: all(len(node._peer_keys) == len(nodes) - 1 for node in nodes))
+
+    futures = [a.request("perf.echo", {}, b.uuid) for a in nodes for b in nodes if a is not b]
+    threads = {future.result(5).json_data["thread"] for future in futures}
+    assert threads <= {thread.name for thread in pool._workers}
+
+    for node in nodes:
+        node.stop()
+    pool.stop()
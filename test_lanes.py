@@ -0,0 +1,95 @@
+import queue
+import threading
+
+import pytest
+
+from lanes import LaneQueue, default_lane
+from message import Message
+
+
+def item(key, blob=None):
+    msg = Message(coms=None, sender_id="peer", msg_type="whisper", req_id="r", key=key, json_data={},
+                  binary_blob=blob)
+    return msg, "peer"
+
+
+def drain(q):
+    keys = []
+    while True:
+        try:
+            keys.append(q.get_nowait()[0].key)
+        except queue.Empty:
+            return keys
+
+
+def test_weighted_fair_dequeue_serves_control_first_without_starving_bulk():
+    q = LaneQueue(maxsize=100)
+    for _ in range(10):
+        q.put(item("camera.frame", blob=b"x" * (1024 * 1024)))
+        q.put(item("peer.keys"))
+    order = drain(q)
+    assert order[:2] == ["peer.keys", "peer.keys"]
+    # 8:1 weights: bulk still gets a turn before control is exhausted
+    assert order.index("camera.frame") < 10
+
+
+def test_overload_policies_are_counted():
+    drop_newest = LaneQueue(maxsize=2, policy="drop_newest")
+    assert [drop_newest.put(item(f"k.{i}")) for i in range(3)] == [True, True, False]
+    assert drain(drop_newest) == ["k.0", "k.1"]
+    assert drop_newest.stats()["default"]["dropped_newest"] == 1
+
+    drop_oldest = LaneQueue(maxsize=2, policy="drop_oldest")
+    for i in range(3):
+        drop_oldest.put(item(f"k.{i}"))
+    assert drain(drop_oldest) == ["k.1", "k.2"]
+    assert drop_oldest.stats()["default"]["dropped_oldest"] == 1
+
+    shed = LaneQueue(maxsize=1, policy="shed")
+    shed.put(item("bulk.frame", blob=b"x" * (1024 * 1024)))
+    shed.put(item("camera.expose"))
+    assert shed.put(item("camera.readout"))       # sheds the bulk message
+    assert not shed.put(item("camera.abort"))     # nothing lower left to shed
+    stats = shed.stats()
+    assert stats["bulk"]["shed"] == 1 and stats["default"]["dropped_newest"] == 1
+    assert drain(shed) == ["camera.expose", "camera.readout"]
+
+
+def test_big_blobs_go_to_bulk_whatever_their_key():
+    assert default_lane(item("peer.status", blob=b"x" * (8 * 1024 * 1024))[0]) == "bulk"
+    assert default_lane(item("peer.status")[0]) == "default"
+    assert default_lane(item("key.announce")[0]) == "control"
+
+
+def test_shed_key_picks_the_victims():
+    q = LaneQueue(maxsize=2, policy="shed", shed_key=lambda key: key.startswith("telemetry."))
+    q.put(item("camera.expose"))
+    q.put(item("telemetry.temp"))
+    assert q.put(item("camera.readout"))          # sheds the telemetry message in its own lane
+    assert not q.put(item("camera.abort"))        # nothing sheddable left
+    assert q.stats()["default"]["shed"] == 1
+    assert drain(q) == ["camera.expose", "camera.readout"]
+
+
+def test_block_policy_times_out_when_full():
+    q = LaneQueue(maxsize=1, policy="block")
+    q.put(item("k"))
+    assert not q.put(item("k"), timeout=0.01)
+    assert q.stats()["default"]["blocked"] == 1
+    with pytest.raises(ValueError):
+        LaneQueue(policy="nope")
+
+
+def test_close_releases_a_blocked_put():
+    q = LaneQueue(maxsize=1, policy="block")
+    q.put(item("k"))
+    results = []
+    putter = threading.Thread(target=lambda: results.append(q.put_many([item("k")])))
+    putter.start()
+    putter.join(0.05)
+    assert putter.is_alive()
+    q.close()
+    putter.join(1)
+    assert not putter.is_alive() and results == [0]
+    assert not q.put(item("k"))
+    assert drain(q) == ["k"]
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from loadgen import LoadGenerator, SizeDistribution, Stage, parse_schedule
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def test_specs_and_arrival_schedules():
+    assert parse_schedule("10:100,5:0-50") == [Stage(10, 100, 100), Stage(5, 0, 50)]
+    with pytest.raises(ValueError):
+        parse_schedule("10")
+    sizes = SizeDistribution("0=1,1K=1")
+    assert sizes.max == 1024
+    assert SizeDistribution("uniform:1K-2K").max == 2048
+
+    constant = LoadGenerator(None, parse_schedule("2:100,1:0-100"), arrivals="constant", seed=1)
+    times = list(constant.intended_times())
+    assert sum(1 for stage, _ in times if stage == 0) == 199
+    # A ramp from 0 to 100/s averages 50/s
+    assert 40 <= sum(1 for stage, _ in times if stage == 1) <= 55
+    assert all(a[1] < b[1] for a, b in zip(times, times[1:]))
+    poisson = LoadGenerator(None, parse_schedule("10:100"), seed=1)
+    assert 900 <= len(list(poisson.intended_times())) <= 1100
+
+
+def test_latency_counts_from_the_intended_send_time():
+    hub = LoopbackHub()
+    server = MessageComs(name="server", group=GROUP_NAME, transport=LoopbackTransport("server", hub), workers=1)
+    client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub))
+    # One worker at 20ms a request serves 50/s; offer 100/s and requests queue up
+    server.register_handler("perf.echo", lambda msg, sender: time.sleep(0.02) or {})
+    server.start()
+    client.start()
+    assert wait_for(lambda: client.providers("perf.echo"))
+
+    generator = LoadGenerator(client, parse_schedule("0.5:100"), arrivals="constant", sizes="0=1,1K=1", seed=1)
+    stage = generator.run()["stages"][0]
+    assert stage["sent"] == stage["completed"] == 49
+    assert stage["errors"] == stage["unroutable"] == 0
+    # The last request waits for the ~24 before it, about 0.5s
+    assert stage["latency"]["max"] > 0.3
+    assert stage["throughput"] < 100
+
+    client.stop()
+    server.stop()
+
+
+class FailingComs:
+    def pick_provider(self, key):
+        return "peer"
+
+    def request(self, key, data, destination, timeout=None, blob=None):
+        raise RuntimeError("transport down")
+
+
+def test_failed_sends_count_as_errors():
+    gen = LoadGenerator(FailingComs(), parse_schedule("0.1:100"), arrivals="constant", seed=1)
+    started = time.monotonic()
+    stage = gen.run()["stages"][0]
+    assert time.monotonic() - started < 1
+    assert stage["sent"] == 0 and stage["errors"] == 9
+    assert gen._outstanding == 0
@@ -41,8 +41,8 @@ def test_message_coms():
     print("[TEST] Waiting for peer discovery...")
     time.sleep(3)
 
-    print(f"[DEBUG] node_a peers: {node_a.node.peers()}")
-    print(f"[DEBUG] node_b peers: {node_b.node.peers()}")
+    print(f"[DEBUG] node_a peers: {node_a.transport.peers()}")
+    print(f"[DEBUG] node_b peers: {node_b.transport.peers()}")
 
     print(f"[DEBUG] node_a group: {node_a.group}")
     print(f"[DEBUG] node_b group: {node_b.group}")
@@ -0,0 +1,119 @@
+import json
+import threading
+
+from message_coms import MessageComs
+from metrics import Histogram, Metrics, MetricsExporter, bucket_bounds, bucket_of
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def test_histogram_buckets_percentiles_and_merge():
+    for value in [0, 1, 15, 16, 17, 1000, 123_456_789, 2 ** 40 + 5]:
+        lower, upper = bucket_bounds(bucket_of(value))
+        assert lower <= value < upper
+        assert upper - lower <= max(1, lower / 8)
+
+    a, b = Histogram(), Histogram()
+    for value in range(1, 1001):
+        (a if value % 2 else b).record(value * 1000)
+    merged = Histogram().merge(a).merge(b)
+    assert merged.count == 1000
+    assert merged.min == 1000 and merged.max == 1_000_000
+    assert abs(merged.percentile(50) - 500_000) / 500_000 < 0.13
+    assert abs(merged.percentile(99) - 990_000) / 990_000 < 0.13
+    assert Histogram.from_dict(json.loads(json.dumps(merged.to_dict()))).summary() == merged.summary()
+
+
+def test_shards_from_every_thread_are_merged():
+    metrics = Metrics()
+
+    def record():
+        for _ in range(1000):
+            metrics.count("messages_in", "perf.echo", "A")
+            metrics.observe("handler", 5000, "perf.echo", "A")
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counters, histograms, _ = metrics.collect()
+    assert counters[("messages_in", "perf.echo", "A")] == 4000
+    assert histograms[("handler", "perf.echo", "A")].count == 4000
+
+
+def test_message_coms_records_traffic_and_exports(tmp_path):
+    hub = LoopbackHub()
+    path = tmp_path / "server.prom"
+    server = MessageComs(name="server", group=GROUP_NAME, transport=LoopbackTransport("server", hub),
+                         metrics_path=str(path), metrics_interval=0.05)
+    client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub))
+    server.register_handler("perf.echo", lambda msg, sender: {"ok": True})
+    server.start()
+    client.start()
+    assert wait_for(lambda: server.uuid in client._peer_keys and client.uuid in server._peer_keys)
+
+    for _ in range(3):
+        client.request("perf.echo", {}, server.uuid, blob=b"x" * 100).result(5)
+
+    stats = server.stats()
+    counters = {(c["name"], c["key"], c["peer"]): c["value"] for c in stats["counters"]}
+    assert counters[("messages_in", "perf.echo", client.uuid)] == 3
+    assert counters[("bytes_in", "perf.echo", client.uuid)] > 300
+    assert counters[("messages_out", "perf.echo.reply", client.uuid)] == 3
+    histograms = {(h["name"], h["key"]): h for h in stats["histograms"]}
+    for name in ("decode", "queue_wait", "handler"):
+        assert histograms[(name, "perf.echo")]["count"] == 3
+    assert stats["lanes"]["default"]["dequeued"] == 3
+
+    assert wait_for(lambda: path.exists() and "perf.echo" in path.read_text())
+    text = path.read_text()
+    assert f'mktl_messages_in_total{{key="perf.echo",peer="{client.uuid}"}} 3' in text
+    assert 'mktl_handler_seconds_bucket{key="perf.echo",peer="' in text
+
+    client.stop()
+    server.stop()
+
+
+def test_json_export(tmp_path):
+    metrics = Metrics()
+    metrics.count("dropped", "perf.echo", "A", 2)
+    metrics.gauge("queue_depth", lambda: 7)
+    exporter = MetricsExporter(metrics, str(tmp_path / "metrics.json"))
+    exporter.export()
+    data = json.loads((tmp_path / "metrics.json").read_text())
+    assert data["counters"] == [{"name": "dropped", "key": "perf.echo", "peer": "A", "value": 2}]
+    assert data["gauges"] == {"queue_depth": 7}
+
+
+def test_labels_are_capped_and_dead_thread_shards_folded():
+    metrics = Metrics(max_labels=2)
+
+    def record(key):
+        metrics.count("messages_in", key, "A")
+        metrics.observe("handler", 5000, key, "A")
+
+    for key in ("a", "b", "c", "d"):
+        thread = threading.Thread(target=record, args=(key,))
+        thread.start()
+        thread.join()
+    counters, histograms, _ = metrics.collect()
+    assert counters == {("messages_in", "a", "A"): 1, ("messages_in", "b", "A"): 1,
+                        ("messages_in", "other", "A"): 2}
+    assert histograms[("handler", "other", "A")].count == 2
+    assert not metrics._shards      # All four threads have exited
+
+
+def test_metrics_can_be_disabled_or_sampled():
+    metrics = Metrics(enabled=False)
+    assert metrics.shard() is None
+    metrics.count("dropped", "perf.echo", "A")
+    assert metrics.collect()[0] == {}
+
+    sampled = Metrics(sample_rate=0.1)
+    for _ in range(10000):
+        sampled.count("messages_in", "perf.echo", "A")
+        sampled.observe("handler", 5000, "perf.echo", "A")
+    counters, histograms, _ = sampled.collect()
+    assert counters[("messages_in", "perf.echo", "A")] == 10000
+    assert 500 < histograms[("handler", "perf.echo", "A")].count < 1500
@@ -0,0 +1,40 @@
+import csv
+
+from binlog import ColumnarLogWriter
+from peer_node import LOG_COLUMNS
+from plot_results import analyze, find_logs, report
+
+
+def write_log(path, role, peer, rtts, start=1000.0):
+    with ColumnarLogWriter(str(path), LOG_COLUMNS, block_rows=7, flush_interval=None) as log:
+        for i, rtt in enumerate(rtts):
+            log.append(f"m{i}", rtt, start + i, start + i + rtt, peer, "RTT", role, None, None, "A")
+            log.append(f"r{i}", None, start + i, start + i, peer, "RECV", role, None, None, "A")
+        log.append("", None, start, None, peer, "LOST", role, None, None, "A")
+
+
+def test_logs_are_reduced_in_parallel_to_percentiles_per_group_and_window(tmp_path):
+    write_log(tmp_path / "a.mlog", "small", "B", [0.001] * 90 + [0.1] * 10)
+    write_log(tmp_path / "b.mlog", "large", "A", [0.01] * 100)
+    # A CSV export next to its columnar log is not counted twice
+    (tmp_path / "b.csv").write_text("ignored")
+    with open(tmp_path / "c.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in LOG_COLUMNS])
+        writer.writerows([["m", 0.002, 1000.0, 1000.002, "B", "RTT", "small", "", "", "A"]] * 20)
+
+    paths = find_logs(str(tmp_path))
+    assert [p.rsplit("/", 1)[1] for p in paths] == ["a.mlog", "b.mlog", "c.csv"]
+    table = report(analyze(paths, window=60, jobs=2, chunk_rows=8))
+    rows = {(r["dimension"], r["value"], r["window"]): r for r in table["rows"]}
+
+    assert rows[("all", "", None)]["count"] == 220
+    assert rows[("all", "", None)]["lost"] == 2
+    small = rows[("role", "small", None)]
+    assert small["count"] == 120
+    assert abs(small["p50"] - 0.001) < 0.001 * 0.13
+    assert abs(small["p99"] - 0.1) < 0.1 * 0.13
+    assert rows[("peer", "A", None)]["count"] == 100
+    # 100 one-second-apart echoes from t=1000 fall in the windows starting at 960, 1020 and 1080
+    assert [rows[("role", "large", w)]["count"] for w in (960.0, 1020.0, 1080.0)] == [20, 60, 20]
+    assert rows[("role", "large", 1020.0)]["throughput"] == 1.0
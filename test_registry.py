@@ -0,0 +1,44 @@
+from message_coms import MessageComs
+from registry import apply_delta, keys_digest
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def test_apply_delta_needs_the_previous_version_and_a_matching_digest():
+    keys = ["a", "b"]
+    delta = {"version": 3, "added": ["c"], "digest": keys_digest(["a", "b", "c"])}
+    assert apply_delta(keys, 2, delta) == ["a", "b", "c"]
+    assert apply_delta(keys, 1, delta) is None
+    assert apply_delta(None, None, delta) is None
+    assert apply_delta(["b", "a"], 2, delta) is None
+
+
+def test_keys_registered_later_reach_peers_as_deltas():
+    hub = LoopbackHub()
+    server = MessageComs(name="server", group=GROUP_NAME, transport=LoopbackTransport("server", hub))
+    client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub))
+    server.register_handler("perf.echo", lambda msg, sender: {})
+    server.start()
+    client.start()
+    assert wait_for(lambda: client._peer_keys.get(server.uuid) == ["perf.echo"] and client.uuid in server._peer_keys)
+
+    shouts, whispers = [], []
+    shout, whisper = server.transport.shout, server.transport.whisper
+    server.transport.shout = lambda group, frames: (shouts.append(frames), shout(group, frames))
+    server.transport.whisper = lambda peer_id, frames: (whispers.append(frames), whisper(peer_id, frames))
+
+    server.register_handler("camera.expose", lambda msg, sender: {})
+    assert wait_for(lambda: client._peer_keys[server.uuid] == ["perf.echo", "camera.expose"])
+    assert client._peer_key_versions[server.uuid] == 2
+    assert client.providers("camera.expose") == [server.uuid]
+    assert len(shouts) == 1 and not whispers
+
+    # A peer that missed a delta fetches the full list instead
+    client._peer_key_versions[server.uuid] = 0
+    server.register_handler("camera.readout", lambda msg, sender: {})
+    assert wait_for(lambda: client._peer_keys[server.uuid] == ["perf.echo", "camera.expose", "camera.readout"])
+    assert client._peer_key_versions[server.uuid] == 3
+    assert len(whispers) == 1
+
+    client.stop()
+    server.stop()
@@ -0,0 +1,95 @@
+import threading
+import time
+from concurrent.futures import Future, TimeoutError, wait
+
+import pytest
+
+from correlation import PendingRequests, RemoteError
+from message import MessageBuilder
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def start_pair():
+    hub = LoopbackHub()
+    server = MessageComs(name="server", group=GROUP_NAME, transport=LoopbackTransport("server", hub))
+    client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub))
+    server.register_handler("math.double", lambda msg, peer: {"value": msg.json_data["value"] * 2})
+    server.register_handler("math.fail", lambda msg, peer: 1 / 0)
+    server.start()
+    client.start()
+    assert wait_for(lambda: server.uuid in client._peer_keys and client.uuid in server._peer_keys)
+    return client, server
+
+
+def test_request_pipeline_resolves_by_req_id():
+    client, server = start_pair()
+    futures = [client.request("math.double", {"value": i}, server.uuid, timeout=5) for i in range(500)]
+    done, not_done = wait(futures, timeout=10)
+    assert not not_done
+    assert [f.result().json_data["value"] for f in futures] == [i * 2 for i in range(500)]
+    assert len(client._pending) == 0
+
+    with pytest.raises(RemoteError):
+        client.request("math.fail", {}, server.uuid, timeout=5).result(5)
+
+    client.stop()
+    server.stop()
+
+
+def test_pending_requests_time_out_in_deadline_order():
+    pending = PendingRequests()
+    slow, fast, answered = Future(), Future(), Future()
+    pending.add("slow", slow, timeout=0.3, peer_id="peer")
+    pending.add("fast", fast, timeout=0.05, peer_id="peer")
+    pending.add("answered", answered, timeout=0.05, peer_id="peer")
+    assert pending.outstanding("peer") == 3
+    pending.fail("answered", ValueError("done"))
+
+    with pytest.raises(TimeoutError):
+        fast.result(1)
+    assert not slow.done()
+    with pytest.raises(TimeoutError):
+        slow.result(1)
+    assert pending.outstanding("peer") == 0
+    pending.stop()
+
+
+def test_cancelled_request_frees_its_slot():
+    pending = PendingRequests()
+    future = Future()
+    pending.add("req", future, timeout=None, peer_id="peer")
+    future.cancel()
+    assert len(pending) == 0 and pending.outstanding("peer") == 0
+    pending.stop()
+
+
+def test_replies_only_count_from_the_peer_asked():
+    pending = PendingRequests()
+    future = Future()
+    pending.add("req", future, timeout=None, peer_id="server")
+    assert pending.resolve("req", None, peer_id="impostor") is None
+    assert not future.done() and pending.outstanding("server") == 1
+    pending.stop()
+
+    client, server = start_pair()
+    release = threading.Event()
+    server.register_handler("math.slow", lambda msg, peer: release.wait(5) and {"value": 1})
+    impostor = MessageComs(name="impostor", group=GROUP_NAME,
+                           transport=LoopbackTransport("impostor", client.transport.hub))
+    impostor.start()
+    assert wait_for(lambda: impostor.uuid in client._peer_keys and client.uuid in impostor._peer_keys)
+
+    future = client.request("math.slow", {}, server.uuid, timeout=5)
+    [req_id] = client._pending._pending
+    impostor.send(MessageBuilder(impostor).with_type("whisper").with_key("math.slow.reply")
+                  .with_destination(client.uuid.encode()).with_json_data({"reply_to": req_id, "value": -1})
+                  .build())
+    time.sleep(0.2)
+    assert not future.done()
+    release.set()
+    assert future.result(5).json_data["value"] == 1
+
+    for node in (client, server, impostor):
+        node.stop()
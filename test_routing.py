@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+from message import MessageBuilder
+from message_coms import MessageComs
+from routing import KeyRouter, ProviderIndex, Route
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def route(pattern):
+    return Route(pattern, handler=pattern)
+
+
+def test_precedence_exact_then_longest_prefix_then_wildcard():
+    router = KeyRouter([route("*"), route("camera.*"), route("camera.expose.*"), route("camera.expose")])
+
+    assert router.lookup("camera.expose").pattern == "camera.expose"
+    assert router.lookup("camera.expose.start").pattern == "camera.expose.*"
+    assert router.lookup("camera.readout").pattern == "camera.*"
+    assert router.lookup("camera.readout.fast").pattern == "camera.*"
+    assert router.lookup("camera").pattern == "*"
+    assert router.lookup("dome.open").pattern == "*"
+
+    router.remove("*")
+    assert router.lookup("dome.open") is None
+    assert router.lookup("camera") is None
+
+
+def test_wildcard_fallback_receives_unhandled_keys():
+    hub = LoopbackHub()
+    seen = []
+    done = threading.Event()
+
+    def fallback(msg, sender):
+        seen.append(msg.key)
+        done.set()
+
+    node_b = MessageComs(name="node-b", group=GROUP_NAME, transport=LoopbackTransport("node-b", hub))
+    node_b.register_handler("test.key", lambda msg, sender: None)
+    node_b.register_handler("*", fallback)
+    node_a = MessageComs(name="node-a", group=GROUP_NAME, transport=LoopbackTransport("node-a", hub))
+    node_b.start()
+    node_a.start()
+    assert wait_for(lambda: node_a.uuid in node_b._peer_keys and node_b.uuid in node_a._peer_keys)
+
+    node_a.send(
+        MessageBuilder(node_a)
+        .with_type("whisper")
+        .with_key("dome.open")
+        .with_destination(node_b.uuid)
+        .build()
+    )
+    assert done.wait(2)
+    assert seen == ["dome.open"]
+
+    node_a.stop()
+    node_b.stop()
+
+
+def test_provider_index_follows_announcements_and_precedence():
+    index = ProviderIndex()
+    index.set_keys("A", ["camera.expose", "dome.*"])
+    index.set_keys("B", ["camera.*", "*"])
+    index.set_keys("C", ["camera.expose"])
+
+    assert sorted(index.providers("camera.expose")) == ["A", "C"]
+    assert index.providers("camera.readout") == ["B"]
+    assert index.providers("dome.open.fast") == ["A"]
+    assert index.providers("weather") == ["B"]
+
+    index.set_keys("A", ["dome.*"])
+    assert index.providers("camera.expose") == ["C"]
+    index.drop("C")
+    assert index.providers("camera.expose") == ["B"]
+    index.drop("B")
+    assert index.providers("weather") == []
+
+
+def test_send_to_key_balances_across_providers():
+    hub = LoopbackHub()
+    client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub))
+    servers = [
+        MessageComs(name=f"server{i}", group=GROUP_NAME, transport=LoopbackTransport(f"server{i}", hub))
+        for i in range(3)
+    ]
+    release = threading.Event()
+    for server in servers[:2]:
+        server.register_handler("perf.echo", lambda msg, sender, uuid=server.uuid: release.wait(5) and {"by": uuid})
+    for node in [client, *servers]:
+        node.start()
+    assert wait_for(lambda: len(client._peer_keys) == 3 and all(len(s._peer_keys) == 3 for s in servers))
+
+    # server2 never registered perf.echo, so it is never picked
+    assert sorted(client.providers("perf.echo")) == sorted(s.uuid for s in servers[:2])
+    futures = [client.send_to_key("perf.echo", {}) for _ in range(4)]
+    assert sorted(client._outstanding(s.uuid) for s in servers) == [0, 2, 2]
+    release.set()
+    replies = [f.result(10).json_data["by"] for f in futures]
+    assert sorted(replies) == sorted([servers[0].uuid] * 2 + [servers[1].uuid] * 2)
+    assert set(client._peer_latency) == {s.uuid for s in servers[:2]}
+    assert client.pick_provider("perf.echo", policy="latency") in client._peer_latency
+
+    # Unmeasured peers count as the median latency, and in-flight requests
+    # spread a burst instead of sending it all to one of them
+    client._peer_latency.clear()
+    release.clear()
+    futures = [client.send_to_key("perf.echo", {}, policy="latency") for _ in range(4)]
+    assert sorted(client._outstanding(s.uuid) for s in servers) == [0, 2, 2]
+    client._peer_latency[servers[0].uuid] = 0.001
+    client._peer_latency[servers[1].uuid] = 0.1
+    assert client.pick_provider("perf.echo", policy="latency") == servers[0].uuid
+    release.set()
+    for future in futures:
+        future.result(10)
+
+    with pytest.raises(LookupError):
+        client.send_to_key("camera.expose", {})
+
+    for node in [client, *servers]:
+        node.stop()
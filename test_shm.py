@@ -0,0 +1,80 @@
+from message import MessageBuilder
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+
+def make_pair(hub, **kwargs):
+    sender = MessageComs(name="sender", group=GROUP_NAME, transport=LoopbackTransport("sender", hub),
+                         shm_threshold=1024, **kwargs)
+    receiver = MessageComs(name="receiver", group=GROUP_NAME, transport=LoopbackTransport("receiver", hub))
+    received = []
+    receiver.register_handler("image.frame", lambda msg, sender_id: received.append(
+        (type(msg.binary_blob), bytes(msg.binary_blob), msg.json_data)))
+    sender.start()
+    receiver.start()
+    assert wait_for(lambda: receiver.uuid in sender._peer_keys and sender.uuid in receiver._peer_keys)
+    return sender, receiver, received
+
+
+def frame(coms, destination, blob):
+    return (
+        MessageBuilder(coms)
+        .with_type("whisper")
+        .with_key("image.frame")
+        .with_destination(destination)
+        .with_json_data({"seq": 1})
+        .with_binary_blob(blob)
+        .build()
+    )
+
+
+def test_same_host_blob_goes_through_shared_memory_and_is_released():
+    hub = LoopbackHub()
+    sender, receiver, received = make_pair(hub)
+    sent_frames = []
+    whisper = sender.transport.whisper
+    sender.transport.whisper = lambda peer_id, frames: (sent_frames.append(frames), whisper(peer_id, frames))
+
+    blob = bytes(range(256)) * 256
+    sender.send(frame(sender, receiver.uuid, blob))
+
+    assert wait_for(lambda: received)
+    blob_type, data, json_data = received[0]
+    assert blob_type is memoryview
+    assert data == blob
+    assert json_data == {"seq": 1}
+    assert all(len(f) < 1024 for frames in sent_frames for f in frames)
+
+    # The receiver's release unlinks the segment on the sender
+    assert wait_for(lambda: len(sender._shm_out) == 0)
+
+    sender.stop()
+    receiver.stop()
+
+
+def test_other_host_and_small_blobs_travel_inline():
+    hub = LoopbackHub()
+    sender, receiver, received = make_pair(hub)
+    sender.send(frame(sender, receiver.uuid, b"small"))
+    sender._peer_hosts[receiver.uuid] = "elsewhere/0"
+    sender.send(frame(sender, receiver.uuid, b"y" * 4096))
+
+    assert wait_for(lambda: len(received) == 2)
+    assert [data for _, data, _ in received] == [b"small", b"y" * 4096]
+    assert len(sender._shm_out) == 0
+
+    sender.stop()
+    receiver.stop()
+
+
+def test_segment_is_unlinked_when_holder_leaves():
+    hub = LoopbackHub()
+    sender, receiver, received = make_pair(hub)
+    receiver.stop()
+    handle = sender._shm_out.export(b"z" * 4096, {receiver.uuid})
+    assert len(sender._shm_out) == 1
+    sender._forget_peer(receiver.uuid)
+    assert len(sender._shm_out) == 0
+    assert handle["size"] == 4096
+    sender.stop()
@@ -0,0 +1,162 @@
+import threading
+import time
+
+import pytest
+
+from message import MessageBuilder
+from message_coms import MessageComs
+from streaming import STREAM_META, BlobAssembler, StreamError
+from test_wire import FakeComs
+from test_transport import GROUP_NAME, wait_for
+from transport import LoopbackHub, LoopbackTransport
+
+BLOB = bytes(range(256)) * 4096  # 1 MiB
+
+
+def make_node(name, hub):
+    return MessageComs(name=name, group=GROUP_NAME, transport=LoopbackTransport(name, hub),
+                       chunk_size=64 * 1024, stream_window=4)
+
+
+def start_pair(hub):
+    receiver = make_node("receiver", hub)
+    sender = make_node("sender", hub)
+    return sender, receiver
+
+
+def whisper(sender, receiver, key, blob):
+    msg = (
+        MessageBuilder(sender)
+        .with_type("whisper")
+        .with_key(key)
+        .with_destination(receiver.uuid)
+        .with_json_data({"name": "frame"})
+        .with_binary_blob(blob)
+        .build()
+    )
+    return sender.send(msg, stream=True)
+
+
+def test_stream_reassembled_for_plain_handler():
+    hub = LoopbackHub()
+    sender, receiver = start_pair(hub)
+    got = []
+    done = threading.Event()
+
+    def handle(msg, peer):
+        got.append((msg.json_data, bytes(msg.binary_blob)))
+        done.set()
+
+    receiver.register_handler("camera.frame", handle)
+    receiver.start()
+    sender.start()
+    assert wait_for(lambda: receiver.uuid in sender._peer_keys and sender.uuid in receiver._peer_keys)
+
+    outgoing = whisper(sender, receiver, "camera.frame", BLOB)
+    assert outgoing is not None and outgoing.chunks == 16
+    assert outgoing.wait(5) and outgoing.error is None
+    assert done.wait(5)
+    assert got == [({"name": "frame"}, BLOB)]
+
+    sender.stop()
+    receiver.stop()
+
+
+def test_streaming_handler_iterates_chunks():
+    hub = LoopbackHub()
+    sender, receiver = start_pair(hub)
+    chunks = []
+    done = threading.Event()
+
+    def handle(msg, peer):
+        assert msg.binary_blob is None
+        for chunk in msg.stream:
+            chunks.append(bytes(chunk))
+        done.set()
+
+    receiver.register_handler("camera.frame", handle, streaming=True)
+    receiver.start()
+    sender.start()
+    assert wait_for(lambda: receiver.uuid in sender._peer_keys and sender.uuid in receiver._peer_keys)
+
+    whisper(sender, receiver, "camera.frame", memoryview(BLOB))
+    assert done.wait(5)
+    assert len(chunks) == 16
+    assert b"".join(chunks) == BLOB
+
+    sender.stop()
+    receiver.stop()
+
+
+def test_shout_stream_is_paced():
+    hub = LoopbackHub()
+    receiver = make_node("receiver", hub)
+    sender = MessageComs(name="sender", group=GROUP_NAME, transport=LoopbackTransport("sender", hub),
+                         chunk_size=64 * 1024, stream_shout_rate=4 * 1024 * 1024)
+    got = []
+    done = threading.Event()
+
+    def handle(msg, peer):
+        got.append(bytes(msg.binary_blob))
+        done.set()
+
+    receiver.register_handler("camera.frame", handle)
+    receiver.start()
+    sender.start()
+    assert wait_for(lambda: receiver.uuid in sender._peer_keys and sender.uuid in receiver._peer_keys)
+
+    msg = (MessageBuilder(sender).with_type("shout").with_key("camera.frame")
+           .with_json_data({}).with_binary_blob(BLOB).build())
+    started = time.monotonic()
+    outgoing = sender.send(msg, stream=True)
+    assert outgoing is not None and outgoing.wait(5) and outgoing.error is None
+    # 16 chunks at 64 per second: the first goes at once, the last 15/64 s later
+    assert time.monotonic() - started >= 0.2
+    assert done.wait(5)
+    assert got == [BLOB]
+
+    sender.stop()
+    receiver.stop()
+
+
+def test_stream_headers_are_checked_before_allocating():
+    header = MessageBuilder(FakeComs()).with_type("whisper").with_key("camera.frame").build()
+    meta = {"id": "1", "size": 1 << 40, "chunks": 1 << 22, "chunk_size": 256 * 1024}
+    with pytest.raises(StreamError):
+        BlobAssembler(header, meta, 4, None)
+    for bad in ({"id": "1", "size": "10", "chunks": 1, "chunk_size": 16},
+                {"id": "1", "size": 100, "chunks": 1, "chunk_size": 16},
+                {"id": "1", "size": 100}):
+        with pytest.raises(StreamError):
+            BlobAssembler(header, bad, 4, None)
+    assert len(BlobAssembler(header, {"id": "1", "size": 100, "chunks": 7, "chunk_size": 16}, 4, None).buffer) == 100
+    with pytest.raises(StreamError):
+        BlobAssembler(header, {"id": "1", "size": 100, "chunks": 7, "chunk_size": 16}, 4, None, available=99)
+
+
+def test_short_or_empty_chunks_fail_the_stream():
+    header = MessageBuilder(FakeComs()).with_type("whisper").with_key("camera.frame").build()
+    meta = {"id": "1", "size": 40, "chunks": 3, "chunk_size": 16}
+    short = BlobAssembler(header, meta, 4, None)
+    assert not short.feed(0, b"a" * 16)
+    assert not short.feed(1, b"b" * 16)
+    with pytest.raises(StreamError):
+        short.feed(2, b"c" * 4)      # 36 of 40 bytes
+    with pytest.raises(StreamError):
+        BlobAssembler(header, meta, 4, None).feed(0, None)
+
+    whole = BlobAssembler(header, meta, 4, None)
+    assert [whole.feed(i, chunk) for i, chunk in enumerate([b"a" * 16, b"b" * 16, b"c" * 8])] == [False, False, True]
+    assert whole.buffer == b"a" * 16 + b"b" * 16 + b"c" * 8
+
+
+def test_reassembly_budget_is_shared_by_concurrent_streams():
+    hub = LoopbackHub()
+    node = MessageComs(name="node", group=GROUP_NAME, transport=LoopbackTransport("node", hub),
+                       max_reassembly=3 * 1024 * 1024)
+    header = MessageBuilder(node).with_type("whisper").with_key("camera.frame").build()
+    for i in range(4):
+        meta = {"id": str(i), "size": 1024 * 1024, "chunks": 4, "chunk_size": 256 * 1024}
+        node._open_incoming_stream(header.replace(json_data={STREAM_META: meta}), "peer")
+    assert sorted(stream_id for _, stream_id in node._streams_in) == ["0", "1", "2"]
+    node.transport.stop()
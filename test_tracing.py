@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from message_coms import MessageComs
+from test_transport import GROUP_NAME, wait_for
+from tracing import Tracer, merge
+from transport import LoopbackHub, LoopbackTransport
+
+
+def test_sample_rate_bounds_what_is_traced():
+    assert all(Tracer("n", "a", 1.0).sample() for _ in range(100))
+    assert not any(Tracer("n", "a", 0.0).sample() for _ in range(100))
+    with pytest.raises(ValueError):
+        Tracer("n", "a", 1.5)
+
+
+def test_request_spans_join_up_across_peers(tmp_path):
+    hub = LoopbackHub()
+    seen = []
+    server = MessageComs(name="server", group=GROUP_NAME, transport=LoopbackTransport("server", hub),
+                         trace_sample_rate=0.0, trace_path=str(tmp_path / "server.json"))
+    client = MessageComs(name="client", group=GROUP_NAME, transport=LoopbackTransport("client", hub),
+                         trace_sample_rate=1.0, trace_path=str(tmp_path / "client.json"))
+    server.register_handler("perf.echo", lambda msg, sender: seen.append(msg) or {"ok": True})
+    server.start()
+    client.start()
+    assert wait_for(lambda: server.uuid in client._peer_keys and client.uuid in server._peer_keys)
+
+    reply = client.request("perf.echo", {"n": 1}, server.uuid).result(5)
+    assert seen[0].json_data == {"n": 1} and seen[0].trace is not None
+    assert reply.trace == seen[0].trace
+    client.stop()
+    server.stop()
+
+    merge([str(tmp_path / "client.json"), str(tmp_path / "server.json")], str(tmp_path / "merged.json"))
+    events = json.loads((tmp_path / "merged.json").read_text())["traceEvents"]
+    spans = [(e["pid"], e["name"]) for e in events if e["ph"] == "X" and e["args"]["trace"] == reply.trace]
+    assert spans == [(client.tracer.pid, "send"), (client.tracer.pid, "decode"), (client.tracer.pid, "queue"),
+                     (client.tracer.pid, "resolve"), (client.tracer.pid, "request"),
+                     (server.tracer.pid, "decode"), (server.tracer.pid, "queue"), (server.tracer.pid, "handler"),
+                     (server.tracer.pid, "send")]
+    flows = sorted((e["ts"], e["ph"]) for e in events if e["ph"] in "stf" and e.get("id") == reply.trace)
+    assert [ph for _, ph in flows] == ["s", "t", "t", "t", "t", "t", "t", "f"]
+    assert {e["args"]["name"] for e in events if e["ph"] == "M"} == {"client", "server"}
@@ -0,0 +1,180 @@
+import threading
+import time
+
+from message import MessageBuilder
+from message_coms import MessageComs
+from transport import LoopbackHub, LoopbackTransport
+
+GROUP_NAME = "mktl-test"
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def make_node(name, hub):
+    return MessageComs(name=name, group=GROUP_NAME, transport=LoopbackTransport(name, hub))
+
+
+def test_loopback_membership_events():
+    hub = LoopbackHub()
+    a = LoopbackTransport("a", hub)
+    b = LoopbackTransport("b", hub)
+    a.join(GROUP_NAME)
+    b.join(GROUP_NAME)
+    a.start()
+    b.start()
+
+    event = a.recv(timeout=1)
+    assert (event.type, event.peer_id) == ("ENTER", b.uuid)
+    event = a.recv(timeout=1)
+    assert (event.type, event.group) == ("JOIN", GROUP_NAME)
+    assert a.peers() == [b.uuid]
+
+    b.stop()
+    event = a.recv(timeout=1)
+    assert (event.type, event.peer_id) == ("EXIT", b.uuid)
+    a.stop()
+
+
+def test_loopback_frames_are_not_copied():
+    hub = LoopbackHub()
+    a = LoopbackTransport("a", hub)
+    b = LoopbackTransport("b", hub)
+    a.start()
+    b.start()
+    while a.recv(timeout=0.1):
+        pass
+
+    blob = bytearray(b"x" * 1024)
+    b.whisper(a.uuid, [b"{}", blob])
+    event = a.recv(timeout=1)
+    assert event.type == "WHISPER"
+    assert event.frames[1] is blob
+    a.stop()
+    b.stop()
+
+
+def test_message_coms_whisper_over_loopback():
+    hub = LoopbackHub()
+    received = []
+    done = threading.Event()
+
+    def handle(msg, sender):
+        received.append((msg.key, msg.json_data, sender))
+        done.set()
+
+    node_b = make_node("node-b", hub)
+    node_b.register_handler("test.key", handle)
+    node_a = make_node("node-a", hub)
+    node_b.start()
+    node_a.start()
+
+    assert wait_for(lambda: node_a.uuid in node_b._peer_keys and node_b.uuid in node_a._peer_keys)
+    assert node_a._peer_keys[node_b.uuid] == ["test.key"]
+    assert node_a._peer_wire[node_b.uuid] == "bin1"
+
+    msg = (
+        MessageBuilder(node_a)
+        .with_type("whisper")
+        .with_key("test.key")
+        .with_destination(node_b.uuid)
+        .with_json_data({"hello": "loopback"})
+        .build()
+    )
+    node_a.send(msg)
+
+    assert done.wait(2)
+    assert received == [("test.key", {"hello": "loopback"}, node_a.uuid)]
+
+    node_a.stop()
+    node_b.stop()
+
+
+class CountingTransport(LoopbackTransport):
+    def __init__(self, name, hub):
+        super().__init__(name, hub)
+        self.whispers = 0
+
+    def _deliver(self, event):
+        if event is not None and event.type == "WHISPER":
+            self.whispers += 1
+        super()._deliver(event)
+
+
+def test_small_messages_are_coalesced_into_batches():
+    hub = LoopbackHub()
+    received = []
+    done = threading.Event()
+
+    def handle(msg, sender):
+        received.append(msg.json_data["seq"])
+        if len(received) == 50:
+            done.set()
+
+    receiver_transport = CountingTransport("node-b", hub)
+    node_b = MessageComs(name="node-b", group=GROUP_NAME, transport=receiver_transport, workers=1)
+    node_b.register_handler("test.key", handle)
+    node_a = MessageComs(name="node-a", group=GROUP_NAME, transport=LoopbackTransport("node-a", hub),
+                         batch_size=10, batch_delay_us=50_000)
+    node_b.start()
+    node_a.start()
+    assert wait_for(lambda: node_a.uuid in node_b._peer_keys and node_b.uuid in node_a._peer_keys)
+    whispers = receiver_transport.whispers   # Key announcements are whispered too
+
+    for seq in range(50):
+        node_a.send(
+            MessageBuilder(node_a)
+            .with_type("whisper")
+            .with_key("test.key")
+            .with_destination(node_b.uuid)
+            .with_json_data({"seq": seq})
+            .build()
+        )
+
+    assert done.wait(2)
+    assert received == list(range(50))
+    assert receiver_transport.whispers - whispers == 5
+
+    node_a.stop()
+    node_b.stop()
+
+
+def test_builder_takes_sequential_request_ids_from_the_node():
+    hub = LoopbackHub()
+    node = make_node("a", hub)
+    ids = [MessageBuilder(node).with_type("shout").with_key("perf.echo").build().req_id for _ in range(3)]
+    prefix = ids[0].rsplit("-", 1)[0]
+    assert ids == [f"{prefix}-{n:x}" for n in range(1, 4)]
+    assert MessageBuilder(node).with_req_id("mine").with_type("shout").with_key("k").build().req_id == "mine"
+    node.transport.stop()
+
+
+def test_recv_many_drains_waiting_events_up_to_max():
+    hub = LoopbackHub()
+    a = LoopbackTransport("a", hub)
+    b = LoopbackTransport("b", hub)
+    a.start()
+    b.start()
+    assert [e.type for e in a.recv_many(10, timeout=1)] == ["ENTER"]
+    for i in range(5):
+        b.whisper(a.uuid, [str(i).encode()])
+    assert [e.frames[0] for e in a.recv_many(3, timeout=1)] == [b"0", b"1", b"2"]
+    assert [e.frames[0] for e in a.recv_many(3, timeout=1)] == [b"3", b"4"]
+    assert a.recv_many(3, timeout=0.01) == []
+    a.stop()
+    b.stop()
+
+
+def test_stop_is_prompt_when_idle():
+    node = make_node("a", LoopbackHub())
+    node.start()
+    time.sleep(0.05)
+    started = time.perf_counter()
+    node.stop()
+    assert time.perf_counter() - started < 0.5
@@ -0,0 +1,151 @@
+import array
+import ctypes
+import pickle
+import threading
+import uuid
+
+import pytest
+
+import wire
+from buffers import BufferPin, blob_nbytes, frame_view
+from message import MessageBuilder
+
+
+class FakeComs:
+    uuid = uuid.uuid4().hex.upper()
+
+
+def build(key="camera.expose", **json_data):
+    return (
+        MessageBuilder(FakeComs())
+        .with_type("whisper")
+        .with_key(key)
+        .with_destination(b"peer")
+        .with_json_data(json_data)
+    )
+
+
+def test_binary_round_trip():
+    msg = build(exptime=1.5).with_binary_blob(b"\x00" * 16).build()
+    frames = wire.encode(msg, wire.FORMAT_BIN1)
+    assert wire.is_binary(frames[0])
+
+    decoded = wire.decode(frames, coms=None)
+    assert decoded.sender_id == msg.sender_id
+    assert decoded.req_id == msg.req_id
+    assert decoded.key == "camera.expose"
+    assert decoded.msg_type == "whisper"
+    assert decoded.json_data == {"exptime": 1.5}
+    assert decoded.binary_blob == b"\x00" * 16
+
+
+def test_binary_header_uses_raw_uuids_and_interned_keys():
+    msg = build(key="perf.echo").build()
+    header = wire.encode(msg, wire.FORMAT_BIN1)[0]
+    # fixed header + 16 byte sender + 16 byte req_id, no inline key
+    assert len(header) == 7 + 16 + 16
+
+
+def test_peer_announced_key_ids():
+    local_keys = ["camera.expose", "camera.readout"]
+    msg = build(key="camera.readout").with_req_id("req-001").build()
+    frames = wire.encode(msg, wire.FORMAT_BIN1, wire.key_ids_for(local_keys))
+    assert b"camera.readout" not in frames[0]
+
+    decoded = wire.decode(frames, coms=None, local_keys=local_keys)
+    assert decoded.key == "camera.readout"
+    assert decoded.req_id == "req-001"
+
+
+def test_json_fallback():
+    msg = build(hello="zyre!").build()
+    frames = wire.encode(msg, wire.FORMAT_JSON)
+    assert frames[0].startswith(b"{")
+    assert wire.decode(frames, coms=None).json_data == {"hello": "zyre!"}
+
+
+def test_negotiate_format():
+    assert wire.negotiate_format(["bin1", "json"]) == wire.FORMAT_BIN1
+    assert wire.negotiate_format(None) == wire.FORMAT_JSON
+    assert wire.negotiate_format(["bin1"], preferred=wire.FORMAT_JSON) == wire.FORMAT_JSON
+
+
+def test_buffer_blobs_are_not_copied():
+    blob = array.array("d", [1.0, 2.0, 3.0])
+    msg = build().with_binary_blob(blob).build()
+    frames = wire.encode(msg, wire.FORMAT_BIN1)
+    assert frames[2] is blob
+
+    decoded = wire.decode(frames, coms=None)
+    assert decoded.binary_blob is blob
+    assert blob_nbytes(decoded.binary_blob) == 24
+
+
+def test_blob_must_support_buffer_protocol():
+    with pytest.raises(TypeError):
+        build().with_binary_blob("not a buffer")
+
+
+def test_buffer_pin_and_frame_view():
+    data = bytearray(b"zero-copy")
+    with BufferPin(data) as pin:
+        assert ctypes.string_at(pin.address, pin.nbytes) == b"zero-copy"
+        with pytest.raises(BufferError):
+            data.extend(b"!")
+
+    owner = ctypes.create_string_buffer(b"frame data", 10)
+    view = frame_view(ctypes.addressof(owner), 10, owner)
+    del owner
+    assert view.readonly
+    assert bytes(view[6:]) == b"data"
+
+
+def test_batch_round_trip():
+    messages = [
+        wire.encode(build(seq=i).build(), wire.FORMAT_BIN1)
+        for i in range(3)
+    ]
+    frames = wire.pack_batch(messages)
+    assert wire.is_batch(frames[0]) and not wire.is_binary(frames[0])
+    unpacked = wire.unpack_batch(frames)
+    assert [wire.decode(m, coms=None).json_data["seq"] for m in unpacked] == [0, 1, 2]
+
+
+def test_payload_is_decoded_on_first_access():
+    msg = build(exptime=1.5, _trace="abc").build()
+    decoded = wire.decode(wire.encode(msg, wire.FORMAT_BIN1), coms=None)
+    assert decoded._json_data is None
+    assert not decoded.has_meta("_stream")
+    assert decoded._json_data is None       # Ruled out from the raw payload
+    moved = decoded.replace(key="camera.readout")
+    assert moved._json_data is None
+    assert moved.json_data == {"exptime": 1.5, "_trace": "abc"}
+    assert decoded.has_meta("_trace")
+
+    with pytest.raises(AttributeError):
+        decoded.key = "other"
+    assert pickle.loads(pickle.dumps(decoded)).json_data == decoded.json_data
+
+
+def test_payload_decodes_once_under_concurrent_readers():
+    frames = wire.encode(build(exptime=1.5).build(), wire.FORMAT_BIN1)
+    errors = []
+
+    def read(msg, barrier):
+        barrier.wait()
+        try:
+            assert msg.has_meta("exptime")
+            assert msg.json_data == {"exptime": 1.5}
+            assert msg.replace(key="other").json_data == {"exptime": 1.5}
+        except Exception as e:
+            errors.append(e)
+
+    for _ in range(200):
+        msg = wire.decode(frames, coms=None)
+        barrier = threading.Barrier(4)
+        threads = [threading.Thread(target=read, args=(msg, barrier)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert not errors
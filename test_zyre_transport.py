@@ -0,0 +1,36 @@
+import ctypes
+
+import pytest
+
+import wire
+from test_wire import build
+
+try:
+    from zyre import czmq
+    from zyre_transport import ZERO_COPY_MIN, build_zmsg, pop_frames
+except (ImportError, OSError) as e:
+    pytest.skip(f"Zyre unavailable: {e}", allow_module_level=True)
+
+
+def round_trip(frames, zero_copy=True):
+    # The zmsg as Zyre hands it over in an event; it owns and frees the frames
+    msg = czmq.Zmsg(ctypes.cast(build_zmsg(frames), ctypes.c_void_p), True)
+    return pop_frames(msg, zero_copy)
+
+
+def test_bin1_header_with_nul_bytes_survives_czmq():
+    msg = build(exptime=1.5).with_binary_blob(b"\x00" * (ZERO_COPY_MIN + 1)).build()
+    frames = wire.encode(msg, wire.FORMAT_BIN1)
+    assert b"\x00" in frames[0]
+    popped = round_trip(frames)
+    assert bytes(popped[0]) == frames[0]
+    decoded = wire.decode(popped, coms=None)
+    assert decoded.req_id == msg.req_id
+    assert decoded.json_data == {"exptime": 1.5}
+    assert bytes(decoded.binary_blob) == bytes(msg.binary_blob)
+
+
+def test_batch_header_survives_czmq():
+    batch = wire.pack_batch([wire.encode(build(seq=i).build(), wire.FORMAT_BIN1) for i in range(3)])
+    popped = round_trip(batch, zero_copy=False)
+    assert [wire.decode(m, coms=None).json_data["seq"] for m in wire.unpack_batch(popped)] == [0, 1, 2]
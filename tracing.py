@@ -0,0 +1,100 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Optional, Sequence
+
+# Sampled message tracing
+#
+# A sampled message carries its trace id in json_data under TRACE_META; the
+# receiver strips it into Message.trace and replies carry it back, so every
+# stage on every peer is stamped under the same id. Stages are "X" slices in
+# Chrome trace-event JSON, joined across peers by flow events (s → t → f)
+# sharing the trace id. Stamps are perf_counter_ns(), shifted by a wall
+# clock offset taken once at startup so files from different processes line
+# up when merged. Open the merged file in Perfetto (ui.perfetto.dev).
+TRACE_META = "_trace"
+TRACE_CATEGORY = "mktl"
+DEFAULT_MAX_EVENTS = 100_000
+
+FLOW_START, FLOW_STEP, FLOW_END = "s", "t", "f"
+
+
+class Tracer:
+    """Collects spans for a sample of messages, keeping the newest max_events.
+
+    sample() is the only cost for unsampled messages: one random() call.
+    Spans may be recorded from any thread.
+    """
+
+    def __init__(self, name: str, process_id: str, sample_rate: float, max_events: int = DEFAULT_MAX_EVENTS):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError(f"Invalid sample_rate: {sample_rate}. Must be between 0 and 1")
+        self.name = name
+        self.sample_rate = sample_rate
+        self.pid = zlib.crc32(process_id.encode())
+        self._events: deque = deque(maxlen=max_events)
+        self._epoch = time.time_ns() - time.perf_counter_ns()
+
+    def sample(self) -> Optional[str]:
+        """A new trace id for a message that should be traced, else None."""
+        if random.random() < self.sample_rate:
+            return f"{random.getrandbits(64):016x}"
+        return None
+
+    def span(self, trace: str, name: str, start: int, end: int, key: str = "", peer: str = "",
+             flow: Optional[str] = FLOW_STEP):
+        """Record stage name of trace from start to end (perf_counter_ns()).
+
+        flow links the span into the trace's chain across peers: FLOW_START
+        where the message originates, FLOW_END where its reply resolves,
+        None to leave it out of the chain.
+        """
+        ts = (start + self._epoch) / 1000
+        tid = threading.get_native_id()
+        self._events.append({
+            "name": name, "cat": TRACE_CATEGORY, "ph": "X", "ts": ts, "dur": (end - start) / 1000,
+            "pid": self.pid, "tid": tid, "args": {"trace": trace, "key": key, "peer": peer}
+        })
+        if flow is not None:
+            # Bound to the enclosing slice, i.e. the one just recorded
+            self._events.append({
+                "name": "message", "cat": TRACE_CATEGORY, "ph": flow, "id": trace, "ts": ts,
+                "pid": self.pid, "tid": tid, "bp": "e"
+            })
+
+    def events(self) -> list:
+        """Recorded events, preceded by the metadata that names this process."""
+        meta = {"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": self.name}}
+        return [meta, *list(self._events)]
+
+    def export(self, path: str):
+        """Write recorded events as a Chrome trace-event JSON file."""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ns"}, f)
+
+
+def merge(paths: Sequence[str], out_path: str):
+    """Combine trace files from several peers into one, so their spans join up."""
+    events = []
+    for path in paths:
+        with open(path) as f:
+            events.extend(json.load(f)["traceEvents"])
+    with open(out_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ns"}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge per-peer trace files for viewing in Perfetto")
+    parser.add_argument("output")
+    parser.add_argument("traces", nargs="+")
+    args = parser.parse_args()
+    merge(args.traces, args.output)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
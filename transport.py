@@ -0,0 +1,239 @@
+import os
+import queue
+import threading
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Set
+
+# Event types delivered by every transport backend (mirrors Zyre's event names)
+EVENT_TYPES = {"ENTER", "EXIT", "JOIN", "LEAVE", "WHISPER", "SHOUT"}
+
+
+@dataclass
+class TransportEvent:
+    type: str                                   # One of EVENT_TYPES
+    peer_id: str                                # UUID of the remote peer
+    peer_name: str = ""                         # Logical name of the remote peer
+    group: Optional[str] = None                 # Group for SHOUT/JOIN/LEAVE
+    frames: List[bytes] = field(default_factory=list)  # Message frames (WHISPER/SHOUT)
+    peer_addr: Optional[str] = None             # Endpoint of the remote peer, if known
+
+
+class Transport:
+    """Interface between MessageComs and the network.
+
+    A backend moves lists of frames between peers and reports peer
+    membership changes as TransportEvents. MessageComs owns framing,
+    serialization and dispatch; the backend owns nothing but delivery.
+    """
+
+    uuid: str
+    name: str
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def join(self, group: str):
+        raise NotImplementedError
+
+    def whisper(self, peer_id: str, frames: Sequence[bytes]):
+        raise NotImplementedError
+
+    def shout(self, group: str, frames: Sequence[bytes]):
+        raise NotImplementedError
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[TransportEvent]:
+        """Block for the next event; return None on timeout or shutdown.
+
+        timeout=0 never blocks.
+        """
+        raise NotImplementedError
+
+    def recv_many(self, max_events: int, timeout: Optional[float] = None) -> List[TransportEvent]:
+        """Wait like recv() for one event, then take whatever else is already
+        waiting, up to max_events in all; [] on timeout or shutdown."""
+        event = self.recv(timeout)
+        events = []
+        while event is not None:
+            events.append(event)
+            if len(events) >= max_events:
+                break
+            event = self.recv(timeout=0)
+        return events
+
+    def fileno(self) -> int:
+        """File descriptor that becomes readable when events may be pending.
+
+        Readiness is edge-like: after a wakeup, call recv(timeout=0) until it
+        returns None before waiting on the descriptor again.
+        """
+        raise NotImplementedError
+
+    def peers(self) -> List[str]:
+        raise NotImplementedError
+
+
+class LoopbackHub:
+    """In-process rendezvous point shared by LoopbackTransports."""
+
+    def __init__(self, name: str = "loopback"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._nodes: Dict[str, "LoopbackTransport"] = {}
+        self._groups: Dict[str, Set[str]] = {}
+
+    def attach(self, node: "LoopbackTransport"):
+        with self._lock:
+            existing = list(self._nodes.values())
+            self._nodes[node.uuid] = node
+            for group in node.groups:
+                self._groups.setdefault(group, set()).add(node.uuid)
+        # Same ordering Zyre gives: ENTER, then JOIN for each group the peer is in
+        for other in existing:
+            other._deliver_membership(node)
+            node._deliver_membership(other)
+
+    def detach(self, node: "LoopbackTransport"):
+        with self._lock:
+            if self._nodes.pop(node.uuid, None) is None:
+                return
+            for members in self._groups.values():
+                members.discard(node.uuid)
+            remaining = list(self._nodes.values())
+        for other in remaining:
+            other._deliver(TransportEvent("EXIT", node.uuid, node.name, peer_addr=node.addr))
+
+    def join(self, node: "LoopbackTransport", group: str):
+        with self._lock:
+            if node.uuid not in self._nodes:
+                return
+            self._groups.setdefault(group, set()).add(node.uuid)
+            others = [n for uid, n in self._nodes.items() if uid != node.uuid]
+        for other in others:
+            other._deliver(TransportEvent("JOIN", node.uuid, node.name, group=group, peer_addr=node.addr))
+
+    def whisper(self, sender: "LoopbackTransport", peer_id: str, frames: List[bytes]):
+        target = self._nodes.get(peer_id)
+        if target is None:
+            return  # Zyre silently drops whispers to unknown peers
+        target._deliver(TransportEvent("WHISPER", sender.uuid, sender.name, frames=frames, peer_addr=sender.addr))
+
+    def shout(self, sender: "LoopbackTransport", group: str, frames: List[bytes]):
+        with self._lock:
+            members = [self._nodes[uid] for uid in self._groups.get(group, ()) if uid != sender.uuid]
+        for target in members:
+            target._deliver(TransportEvent("SHOUT", sender.uuid, sender.name, group=group, frames=frames, peer_addr=sender.addr))
+
+    def peers(self, node: "LoopbackTransport") -> List[str]:
+        with self._lock:
+            return [uid for uid in self._nodes if uid != node.uuid]
+
+
+default_hub = LoopbackHub()
+
+
+class LoopbackTransport(Transport):
+    """Zero-copy in-process transport.
+
+    Frames are handed to the receiving peer by reference, so no bytes are
+    copied between send and receive. Useful for benchmarking the
+    serialization and dispatch path, and for running many simulated peers
+    in one process.
+    """
+
+    def __init__(self, name: str, hub: Optional[LoopbackHub] = None):
+        self.name = name
+        self.hub = hub or default_hub
+        self.uuid = uuid.uuid4().hex.upper()  # Same format as Zyre UUIDs
+        self.addr = f"loopback://{self.hub.name}/{self.uuid}"
+        self.groups: Set[str] = set()
+        self._events: "queue.Queue[Optional[TransportEvent]]" = queue.Queue()
+        self._started = False
+        self._wakeup_r: Optional[int] = None   # Self-pipe, created on first fileno()
+        self._wakeup_w: Optional[int] = None
+
+    def _deliver(self, event: Optional[TransportEvent]):
+        self._events.put(event)
+        if self._wakeup_w is not None:
+            self._signal()
+
+    def _signal(self):
+        fd = self._wakeup_w
+        try:
+            os.write(fd, b"\x01")
+        except BlockingIOError:
+            pass  # Pipe already full, so already readable
+        except (OSError, TypeError):
+            pass  # Closed by stop() in the meantime
+
+    def _deliver_membership(self, peer: "LoopbackTransport"):
+        self._deliver(TransportEvent("ENTER", peer.uuid, peer.name, peer_addr=peer.addr))
+        for group in peer.groups:
+            self._deliver(TransportEvent("JOIN", peer.uuid, peer.name, group=group, peer_addr=peer.addr))
+
+    def start(self):
+        self._started = True
+        self.hub.attach(self)
+
+    def stop(self):
+        if not self._started:
+            return
+        self._started = False
+        self.hub.detach(self)
+        self._deliver(None)  # Wake any blocked recv()
+        if self._wakeup_r is not None:
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_r = self._wakeup_w = None
+
+    def join(self, group: str):
+        self.groups.add(group)
+        if self._started:
+            self.hub.join(self, group)
+
+    def whisper(self, peer_id: str, frames: Sequence[bytes]):
+        self.hub.whisper(self, peer_id, list(frames))
+
+    def shout(self, group: str, frames: Sequence[bytes]):
+        self.hub.shout(self, group, list(frames))
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[TransportEvent]:
+        if timeout == 0:
+            return self._recv_nowait()
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _recv_nowait(self) -> Optional[TransportEvent]:
+        try:
+            return self._events.get_nowait()
+        except queue.Empty:
+            pass
+        if self._wakeup_r is None:
+            return None
+        # Clear the wakeup pipe, then look again so an event delivered in between isn't missed
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        try:
+            return self._events.get_nowait()
+        except queue.Empty:
+            return None
+
+    def fileno(self) -> int:
+        if self._wakeup_r is None:
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            os.set_blocking(self._wakeup_r, False)
+            os.set_blocking(self._wakeup_w, False)
+            if not self._events.empty():
+                self._signal()
+        return self._wakeup_r
+
+    def peers(self) -> List[str]:
+        return self.hub.peers(self)
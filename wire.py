@@ -0,0 +1,270 @@
+import json
+import struct
+import uuid
+from typing import Dict, List, Optional, Sequence
+
+from buffers import blob_nbytes
+from message import Message
+
+# Wire formats this build can speak, in order of preference. Peers advertise
+# theirs in the "peer.keys" announcement and fall back to JSON otherwise.
+FORMAT_JSON = "json"
+FORMAT_BIN1 = "bin1"
+SUPPORTED_FORMATS = [FORMAT_BIN1, FORMAT_JSON]
+
+# Binary envelope, version 1
+#
+#   frame 0: header
+#       magic     2s   b"MK"
+#       version   B    1
+#       flags     B    FLAG_* bits
+#       msg_type  B    index into MSG_TYPES
+#       key_id    H    interned key, or KEY_INLINE
+#       sender         16 raw UUID bytes if FLAG_SENDER_UUID, else H-prefixed UTF-8
+#       req_id         16 raw UUID bytes if FLAG_REQ_UUID, else H-prefixed UTF-8
+#       key            H-prefixed UTF-8, only if key_id == KEY_INLINE
+#   frame 1: JSON payload (empty frame means {})
+#   frame 2: binary blob, only if FLAG_HAS_BLOB
+MAGIC = b"MK"
+VERSION = 1
+
+FLAG_HAS_BLOB = 0x01
+FLAG_SENDER_UUID = 0x02
+FLAG_REQ_UUID = 0x04
+
+MSG_TYPES = ("whisper", "shout")
+_MSG_TYPE_IDS = {name: i for i, name in enumerate(MSG_TYPES)}
+
+_HEADER = struct.Struct("<2sBBBH")
+_LEN = struct.Struct("<H")
+
+# Batch of coalesced messages
+#
+#   frame 0: magic b"MB", version B, count H, then one B per message giving its frame count
+#   frames 1..: each message's frames, back to back
+BATCH_MAGIC = b"MB"
+BATCH_VERSION = 1
+_BATCH_HEADER = struct.Struct("<2sBH")
+
+# Keys every node knows; ids below PEER_KEY_BASE never need negotiating.
+WELL_KNOWN_KEYS = (
+    "peer.keys",
+    "peer.hello",
+    "peer.status",
+    "perf.echo",
+    "perf.echo.reply",
+    "key.announce",
+)
+_WELL_KNOWN_IDS = {key: i for i, key in enumerate(WELL_KNOWN_KEYS)}
+
+# Ids from PEER_KEY_BASE up index into the *receiver's* announced key list.
+PEER_KEY_BASE = 256
+KEY_INLINE = 0xFFFF
+
+
+def negotiate_format(remote_formats: Optional[Sequence[str]], preferred: str = FORMAT_BIN1) -> str:
+    """Pick the wire format to use towards a peer that advertised remote_formats."""
+    if preferred != FORMAT_JSON and remote_formats and preferred in remote_formats:
+        return preferred
+    return FORMAT_JSON
+
+
+def key_ids_for(keys: Sequence[str]) -> Dict[str, int]:
+    """Build the key → id map for a peer from the key list it announced."""
+    return {key: PEER_KEY_BASE + i for i, key in enumerate(keys) if PEER_KEY_BASE + i < KEY_INLINE}
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode()
+    return _LEN.pack(len(raw)) + raw
+
+
+def _unpack_str(buf, offset: int):
+    (length,) = _LEN.unpack_from(buf, offset)
+    offset += _LEN.size
+    return bytes(buf[offset:offset + length]).decode(), offset + length
+
+
+def _sender_bytes(sender_id: str) -> Optional[bytes]:
+    # Zyre UUIDs are 32 upper-case hex digits
+    if len(sender_id) == 32 and sender_id.isupper():
+        try:
+            return bytes.fromhex(sender_id)
+        except ValueError:
+            return None
+    return None
+
+
+def _req_id_bytes(req_id: str) -> Optional[bytes]:
+    # Only canonical str(uuid.uuid4()) values round-trip through 16 bytes
+    if len(req_id) == 36 and req_id[8] == "-":
+        try:
+            value = uuid.UUID(req_id)
+        except ValueError:
+            return None
+        if str(value) == req_id:
+            return value.bytes
+    return None
+
+
+def encode_binary(msg: Message, key_ids: Optional[Dict[str, int]] = None) -> List[bytes]:
+    """Encode msg as binary envelope frames.
+
+    key_ids maps keys to the ids the receiving peer announced; keys missing
+    from it and from WELL_KNOWN_KEYS are sent inline.
+    """
+    flags = 0
+    parts = []
+
+    sender = _sender_bytes(msg.sender_id)
+    if sender is not None:
+        flags |= FLAG_SENDER_UUID
+        parts.append(sender)
+    else:
+        parts.append(_pack_str(msg.sender_id))
+
+    req_id = _req_id_bytes(msg.req_id)
+    if req_id is not None:
+        flags |= FLAG_REQ_UUID
+        parts.append(req_id)
+    else:
+        parts.append(_pack_str(msg.req_id))
+
+    key_id = _WELL_KNOWN_IDS.get(msg.key)
+    if key_id is None and key_ids:
+        key_id = key_ids.get(msg.key)
+    if key_id is None:
+        key_id = KEY_INLINE
+        parts.append(_pack_str(msg.key))
+
+    if msg.binary_blob is not None:
+        flags |= FLAG_HAS_BLOB
+
+    header = _HEADER.pack(MAGIC, VERSION, flags, _MSG_TYPE_IDS[msg.msg_type], key_id) + b"".join(parts)
+    payload = json.dumps(msg.json_data).encode() if msg.json_data else b""
+    frames = [header, payload]
+    if msg.binary_blob is not None:
+        frames.append(msg.binary_blob)
+    return frames
+
+
+def encode(msg: Message, fmt: str = FORMAT_JSON, key_ids: Optional[Dict[str, int]] = None) -> List[bytes]:
+    """Encode msg into transport frames using the given wire format."""
+    if fmt == FORMAT_BIN1:
+        return encode_binary(msg, key_ids)
+    frames = [msg.to_json().encode()]
+    if msg.binary_blob is not None:
+        frames.append(msg.binary_blob)
+    return frames
+
+
+def _as_bytes(frame) -> bytes:
+    # Large frames may arrive as memoryviews; json.loads only takes str/bytes
+    return frame if isinstance(frame, (bytes, str)) else bytes(frame)
+
+
+def frames_nbytes(frames: Sequence[bytes]) -> int:
+    # A loop rather than sum() over a generator: this runs for every message sent and received
+    total = 0
+    for f in frames:
+        total += len(f) if type(f) is bytes else blob_nbytes(f)
+    return total
+
+
+def is_binary(frame) -> bool:
+    return frame[:2] == MAGIC
+
+
+def decode_binary(
+    frames: Sequence[bytes],
+    coms: "MessageComs",
+    local_keys: Sequence[str] = (),
+    destination: Optional[bytes] = None,
+    received_by: Optional[bytes] = None
+) -> Message:
+    header = frames[0]
+    magic, version, flags, type_id, key_id = _HEADER.unpack_from(header, 0)
+    if version != VERSION:
+        raise ValueError(f"Unsupported envelope version: {version}")
+    offset = _HEADER.size
+
+    if flags & FLAG_SENDER_UUID:
+        sender_id = bytes(header[offset:offset + 16]).hex().upper()
+        offset += 16
+    else:
+        sender_id, offset = _unpack_str(header, offset)
+
+    if flags & FLAG_REQ_UUID:
+        req_id = str(uuid.UUID(bytes=bytes(header[offset:offset + 16])))
+        offset += 16
+    else:
+        req_id, offset = _unpack_str(header, offset)
+
+    if key_id == KEY_INLINE:
+        key, offset = _unpack_str(header, offset)
+    elif key_id < PEER_KEY_BASE:
+        key = WELL_KNOWN_KEYS[key_id]
+    else:
+        key = local_keys[key_id - PEER_KEY_BASE]
+
+    payload = frames[1] if len(frames) > 1 else b""
+    blob = frames[2] if flags & FLAG_HAS_BLOB and len(frames) > 2 else None
+
+    return Message(
+        coms=coms,
+        sender_id=sender_id,
+        msg_type=MSG_TYPES[type_id],
+        req_id=req_id,
+        key=key,
+        payload=_as_bytes(payload),     # Decoded on first access to json_data
+        binary_blob=blob,
+        destination=destination,
+        received_by=received_by
+    )
+
+
+def decode(
+    frames: Sequence[bytes],
+    coms: "MessageComs",
+    local_keys: Sequence[str] = (),
+    destination: Optional[bytes] = None,
+    received_by: Optional[bytes] = None
+) -> Message:
+    """Decode transport frames in either wire format into a Message."""
+    if is_binary(frames[0]):
+        return decode_binary(frames, coms, local_keys, destination, received_by)
+    return Message.from_json(
+        _as_bytes(frames[0]),
+        coms=coms,
+        blob=frames[1] if len(frames) > 1 else None,
+        destination=destination,
+        received_by=received_by
+    )
+
+
+def is_batch(frame) -> bool:
+    return frame[:2] == BATCH_MAGIC
+
+
+def pack_batch(messages: Sequence[Sequence[bytes]]) -> List[bytes]:
+    """Combine the frames of several encoded messages into one multi-part message."""
+    header = _BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, len(messages)) + bytes(len(m) for m in messages)
+    frames = [header]
+    for message_frames in messages:
+        frames.extend(message_frames)
+    return frames
+
+
+def unpack_batch(frames: Sequence[bytes]) -> List[Sequence[bytes]]:
+    """Split a batch produced by pack_batch back into per-message frame lists."""
+    header = frames[0]
+    magic, version, count = _BATCH_HEADER.unpack_from(header, 0)
+    if version != BATCH_VERSION:
+        raise ValueError(f"Unsupported batch version: {version}")
+    sizes = header[_BATCH_HEADER.size:_BATCH_HEADER.size + count]
+    messages = []
+    offset = 1
+    for size in sizes:
+        messages.append(frames[offset:offset + size])
+        offset += size
+    return messages
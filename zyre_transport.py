@@ -0,0 +1,198 @@
+import ctypes
+import ctypes.util
+import itertools
+import select
+import threading
+import time
+from ctypes import c_char_p
+from typing import Dict, List, Optional, Sequence
+
+from zyre import Zyre, czmq, ZyreEvent
+from buffers import Blob, BufferPin, frame_view
+from transport import Transport, TransportEvent
+from zyre_utils import get_peer_uuids
+
+
+def _load_libczmq() -> ctypes.CDLL:
+    try:
+        lib = ctypes.CDLL("libczmq.dylib")
+    except OSError:
+        path = ctypes.util.find_library("czmq")
+        if not path:
+            raise
+        lib = ctypes.CDLL(path)
+    lib.zmsg_new.restype = ctypes.c_void_p
+    lib.zmsg_addmem.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+    lib.zmsg_destroy.argtypes = [ctypes.POINTER(ctypes.c_void_p)]
+    try:
+        # DRAFT API in some CZMQ builds; without it large frames fall back to zmsg_addmem
+        lib.zframe_frommem.restype = ctypes.c_void_p
+        lib.zframe_frommem.argtypes = [ctypes.c_void_p, ctypes.c_size_t, _ZFRAME_DESTRUCTOR, ctypes.c_void_p]
+        lib.zmsg_append.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p)]
+    except AttributeError:
+        pass
+    return lib
+
+
+# typedef void (zframe_destructor_fn) (void **hint);
+_ZFRAME_DESTRUCTOR = ctypes.CFUNCTYPE(None, ctypes.POINTER(ctypes.c_void_p))
+
+# Buffers lent to CZMQ, keyed by the hint passed to zframe_frommem
+_pinned: Dict[int, BufferPin] = {}
+_pinned_lock = threading.Lock()
+_pin_ids = itertools.count(1)
+
+
+@_ZFRAME_DESTRUCTOR
+def _release_pinned(hint_p):
+    # Called by CZMQ (possibly from a ZeroMQ I/O thread) once the frame is sent or dropped
+    with _pinned_lock:
+        pin = _pinned.pop(hint_p[0], None)
+    if pin is not None:
+        pin.release()
+
+
+# Load CZMQ Library
+libczmq = _load_libczmq()
+HAVE_ZFRAME_FROMMEM = hasattr(libczmq, "zframe_frommem") and hasattr(libczmq, "zmsg_append")
+
+# Frames at least this large are lent to CZMQ instead of copied
+ZERO_COPY_MIN = 64 * 1024
+
+ZMQ_POLLIN = 1
+
+
+def _append_borrowed(raw_ptr, frame: Blob) -> bool:
+    pin = BufferPin(frame)
+    if not HAVE_ZFRAME_FROMMEM:
+        # zmsg_addmem still copies on the C side, but not into an intermediate Python bytes
+        with pin:
+            libczmq.zmsg_addmem(raw_ptr, pin.address, pin.nbytes)
+        return True
+
+    pin_id = next(_pin_ids)
+    with _pinned_lock:
+        _pinned[pin_id] = pin
+    zframe = libczmq.zframe_frommem(pin.address, pin.nbytes, _release_pinned, pin_id)
+    if not zframe:
+        with _pinned_lock:
+            _pinned.pop(pin_id, None)
+        pin.release()
+        return False
+    # zmsg_append takes ownership of the frame; CZMQ calls _release_pinned when done with it
+    libczmq.zmsg_append(raw_ptr, ctypes.byref(ctypes.c_void_p(zframe)))
+    return True
+
+
+def build_zmsg(frames: Sequence[Blob]) -> czmq.zmsg_p:
+    raw_ptr = libczmq.zmsg_new()
+    if not raw_ptr:
+        raise RuntimeError("Failed to create zmsg")
+    for frame in frames:
+        if isinstance(frame, bytes) and len(frame) < ZERO_COPY_MIN:
+            libczmq.zmsg_addmem(raw_ptr, ctypes.c_char_p(frame), len(frame))
+        elif not _append_borrowed(raw_ptr, frame):
+            raise RuntimeError("Failed to create zframe")
+    return ctypes.cast(raw_ptr, czmq.zmsg_p)
+
+
+def destroy_zmsg(zmsg_ptr: czmq.zmsg_p):
+    ptr = ctypes.cast(zmsg_ptr, ctypes.c_void_p)
+    ptr_p = ctypes.pointer(ptr)
+    libczmq.zmsg_destroy(ptr_p)
+
+
+def pop_frames(msg, zero_copy: bool = True) -> List[Blob]:
+    """Pop every frame of a received zmsg as bytes, or as memoryviews over the
+    zframes for large frames if zero_copy."""
+    if not msg:
+        return []
+    frames = []
+    while msg.size() > 0:
+        frame = msg.pop()
+        size = frame.size()
+        if zero_copy and size >= ZERO_COPY_MIN:
+            address = ctypes.cast(frame.data(), ctypes.c_void_p).value
+            frames.append(frame_view(address, size, owner=frame))
+        else:
+            # Raw bytes, never popstr(): bin1 and batch headers contain NUL bytes, and
+            # the JSON envelope decodes just as well from bytes
+            frames.append(ctypes.string_at(frame.data(), size))
+    return frames
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else (value or "")
+
+
+class ZyreTransport(Transport):
+    """Transport backed by a Zyre node.
+
+    With zero_copy enabled, received frames of at least ZERO_COPY_MIN bytes
+    are returned as read-only memoryviews over the zframe instead of being
+    copied into bytes; the zframe is freed once the last view is dropped.
+    """
+
+    def __init__(self, name: str, verbose: bool = True, zero_copy: bool = True):
+        self.name = name
+        self.zero_copy = zero_copy
+        self.node = Zyre(name.encode())
+        if verbose:
+            self.node.set_verbose()
+        self.uuid = self.node.uuid().decode()
+
+    def start(self):
+        self.node.start()
+
+    def stop(self):
+        self.node.stop()
+
+    def join(self, group: str):
+        self.node.join(group.encode())
+
+    def whisper(self, peer_id: str, frames: Sequence[bytes]):
+        zmsg_ptr = build_zmsg(frames)
+        self.node.whisper(c_char_p(peer_id.encode()), zmsg_ptr)
+        destroy_zmsg(zmsg_ptr)
+
+    def shout(self, group: str, frames: Sequence[bytes]):
+        zmsg_ptr = build_zmsg(frames)
+        self.node.shout(group.encode(), zmsg_ptr)
+        destroy_zmsg(zmsg_ptr)
+
+    def fileno(self) -> int:
+        # ZMQ_FD of the node's actor pipe; edge-triggered, so check ZMQ_EVENTS before reading
+        return self.node.socket().fd()
+
+    def _readable(self, timeout: float) -> bool:
+        sock = self.node.socket()
+        deadline = time.monotonic() + timeout
+        while True:
+            if sock.events() & ZMQ_POLLIN:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            select.select([sock.fd()], [], [], remaining)
+
+    def recv(self, timeout: Optional[float] = None) -> Optional[TransportEvent]:
+        if timeout is not None and not self._readable(timeout):
+            return None
+        event = ZyreEvent(self.node)
+        if not event:
+            return None
+
+        ev_type = _decode(event.type())
+        result = TransportEvent(
+            type=ev_type,
+            peer_id=_decode(event.peer_uuid()),
+            peer_name=_decode(event.peer_name()),
+            group=_decode(event.group()) or None,
+            peer_addr=_decode(event.peer_addr()) or None,
+        )
+        if ev_type in ("WHISPER", "SHOUT"):
+            result.frames = pop_frames(event.msg(), self.zero_copy)
+        return result
+
+    def peers(self) -> List[str]:
+        return get_peer_uuids(self.node.peers())